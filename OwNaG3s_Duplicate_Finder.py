@@ -37,31 +37,3559 @@ import random
 import datetime
 import traceback
 import uuid
+import errno
+import filecmp
+import gzip
+import io
+import heapq
+import fnmatch
+import re
+import struct
+import zipfile
+import tarfile
+import ctypes
+import platform
+import select
+import socket
+import socketserver
+import stat
+import argparse
+import multiprocessing
+import secrets
+import hmac
+import importlib.util
+import http.client
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from array import array
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+
+
+def module_available(name):
+    # Finds an optional module without importing it
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+# The heavy optional modules are only located here; each one is imported the
+# first time its feature is used, so they never slow down startup.
+THEMES_AVAILABLE = module_available("ttkthemes")
+PYGAME_AVAILABLE = module_available("pygame")
+SEND2TRASH_AVAILABLE = module_available("send2trash")
+PIL_AVAILABLE = module_available("PIL")
+NUMPY_AVAILABLE = module_available("numpy")
+Image = None
+numpy = None
 
 try:
-    from ttkthemes import ThemedStyle
-    THEMES_AVAILABLE = True
+    import zstandard
+    ZSTD_AVAILABLE = True
 except ImportError:
-    THEMES_AVAILABLE = False
+    ZSTD_AVAILABLE = False
 
 try:
-    import pygame
-    PYGAME_AVAILABLE = True
+    import fcntl
+    FCNTL_AVAILABLE = True
 except ImportError:
-    PYGAME_AVAILABLE = False
+    FCNTL_AVAILABLE = False
+
+FICLONE = 0x40049409  # Linux ioctl used by Btrfs/XFS for copy-on-write clones
+FS_IOC_FIEMAP = 0xC020660B  # Linux ioctl that reports a file's physical extents
+
+
+def load_numpy():
+    global numpy
+    if numpy is None:
+        import numpy
+    return numpy
+
+
+def load_pillow():
+    global Image
+    if Image is None:
+        from PIL import Image
+    return Image
+
+
+def send_to_trash(path):
+    from send2trash import send2trash
+    send2trash(path)
+
+
+# -- Result export helpers --
+
+def digest_hex(digest):
+    return digest.hex() if isinstance(digest, bytes) else str(digest)
+
+
+def open_export_stream(path):
+    # Text stream for exports; the file name picks gzip/zstd compression.
+    lower = path.lower()
+    if lower.endswith(".gz"):
+        return gzip.open(path, "wt", encoding="utf-8", newline="")
+    if lower.endswith(".zst"):
+        if not ZSTD_AVAILABLE:
+            raise RuntimeError("zstandard is not installed; use .gz or an uncompressed file")
+        raw = open(path, "wb")
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(raw), encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="", buffering=1024 * 1024)
+
+
+def open_import_stream(path):
+    lower = path.lower()
+    if lower.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    if lower.endswith(".zst"):
+        if not ZSTD_AVAILABLE:
+            raise RuntimeError("zstandard is not installed; cannot read .zst files")
+        raw = open(path, "rb")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(raw), encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="", buffering=1024 * 1024)
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def iter_import_records(path, fmt):
+    # Yields (group_key, path, size, mtime, algorithm). Files written before
+    # exports carried sizes/digests still load, with size and mtime as None.
+    if fmt == "json":
+        with open(path, encoding="utf-8") as f:
+            groups = json.load(f)
+        for group_key, files in groups.items():
+            for filepath in files:
+                yield str(group_key), filepath, None, None, ""
+        return
+
+    with open_import_stream(path) as f:
+        if fmt == "csv":
+            for row in csv.DictReader(f):
+                digest = row.get("Digest") or ""
+                group_key = digest or str(row.get("Group"))
+                yield (group_key, row.get("File Path"), parse_int(row.get("Size")),
+                       parse_float(row.get("Modified")), row.get("Algorithm") or "")
+        else:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                digest = record.get("digest") or ""
+                group_key = digest or str(record.get("group"))
+                yield (group_key, record.get("path"), record.get("size"),
+                       record.get("mtime"), record.get("algorithm") or "")
+
+
+def stat_or_none(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+# -- Scan roots --
+
+def normalize_roots(folders):
+    # Resolves each folder and drops duplicates and folders nested inside
+    # another root, so every file is walked once.
+    resolved = sorted({os.path.realpath(folder.strip()) for folder in folders if folder.strip()}, key=len)
+    roots = []
+    for folder in resolved:
+        key = os.path.normcase(folder)
+        if any(key == os.path.normcase(root) or key.startswith(os.path.normcase(root).rstrip(os.sep) + os.sep)
+               for root in roots):
+            continue
+        roots.append(folder)
+    return roots
+
+
+def root_of(path, roots):
+    for root in roots:
+        if path == root or path.startswith(root.rstrip(os.sep) + os.sep):
+            return root
+    return ""
+
+
+# -- Scan filters --
+
+class ScanFilter:
+    # Advanced filter settings compiled once per scan. Excluded folders are
+    # case-insensitive substrings of the path, or glob patterns (*, ?, [])
+    # matched against a folder's name or full path. Excluded folders are
+    # pruned from the walk instead of being filtered file by file.
+    GLOB_CHARS = set("*?[")
+
+    def __init__(self, enabled=False, min_size=0, extensions=None, excluded_folders=()):
+        self.enabled = enabled
+        self.min_size = min_size
+        self.extensions = extensions
+
+        substrings = []
+        globs = []
+        for folder in excluded_folders:
+            folder = folder.strip()
+            if not folder:
+                continue
+            if self.GLOB_CHARS & set(folder):
+                globs.append(fnmatch.translate(folder))
+            else:
+                substrings.append(re.escape(folder))
+        self.excluded_re = re.compile("|".join(substrings), re.IGNORECASE) if substrings else None
+        self.glob_re = re.compile("|".join(globs), re.IGNORECASE) if globs else None
+
+    @classmethod
+    def from_settings(cls, settings):
+        if not settings.get("use_filters", False):
+            return cls()
+        try:
+            min_kb = int(settings.get("filter_min_size_kb", 0))
+        except (TypeError, ValueError):
+            min_kb = 0
+        extensions = {
+            ext.strip().lower().lstrip(".")
+            for ext in settings.get("filter_extensions", "").split(",")
+        }
+        extensions.discard("")
+        return cls(True, min_kb * 1024, extensions or None, settings.get("filter_excluded_folders", []))
 
-try:
-    import send2trash
-    SEND2TRASH_AVAILABLE = True
-except ImportError:
-    SEND2TRASH_AVAILABLE = False
+    def prune_dir(self, path):
+        if not self.enabled:
+            return False
+        if self.excluded_re and self.excluded_re.search(path):
+            return True
+        if self.glob_re and (self.glob_re.match(os.path.basename(path)) or self.glob_re.match(path)):
+            return True
+        return False
+
+    def accepts_name(self, path, name):
+        # Name checks run before the file is stat'ed; min_size is checked
+        # by the walker against the stat result it already has
+        if not self.enabled:
+            return True
+        if self.extensions is not None:
+            if os.path.splitext(name)[1].lower().lstrip(".") not in self.extensions:
+                return False
+        # A pattern can still straddle the folder/file boundary of the path
+        if self.excluded_re and self.excluded_re.search(path):
+            return False
+        return True
+
+
+# -- Compact file index --
+
+class FileRecord:
+    __slots__ = ("file_id", "path", "size", "mtime", "inode", "dev")
+
+    def __init__(self, file_id, path, size, mtime, inode, dev=0):
+        self.file_id = file_id
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.inode = inode
+        self.dev = dev
+
+
+class FileIndex:
+    # Column store for every walked file. A file is a parent directory id plus
+    # a basename; sizes, mtimes and inodes live in typed arrays. size_groups
+    # maps a size to a single file id, or to an array of ids once it collides.
+    # The device (st_dev) is stored per directory, not per file.
+    __slots__ = ("dir_paths", "dir_ids", "dir_devs", "parents", "names", "sizes", "mtimes", "inodes", "size_groups")
+
+    def __init__(self):
+        self.dir_paths = []
+        self.dir_ids = {}
+        self.dir_devs = array("Q")
+        self.parents = array("I")
+        self.names = []
+        self.sizes = array("q")
+        self.mtimes = array("d")
+        self.inodes = array("Q")
+        self.size_groups = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern_dir(self, path, dev=0):
+        dir_id = self.dir_ids.get(path)
+        if dir_id is None:
+            dir_id = len(self.dir_paths)
+            self.dir_paths.append(path)
+            self.dir_ids[path] = dir_id
+            self.dir_devs.append(dev)
+        return dir_id
+
+    def add(self, dir_id, name, st):
+        file_id = len(self.names)
+        self.parents.append(dir_id)
+        self.names.append(name)
+        self.sizes.append(st.st_size)
+        self.mtimes.append(st.st_mtime)
+        self.inodes.append(st.st_ino)
+        self.group(file_id, st.st_size)
+        return file_id
+
+    def update(self, file_id, st):
+        self.ungroup(file_id, self.sizes[file_id])
+        self.sizes[file_id] = st.st_size
+        self.mtimes[file_id] = st.st_mtime
+        self.inodes[file_id] = st.st_ino
+        self.group(file_id, st.st_size)
+
+    def group(self, file_id, size):
+        current = self.size_groups.get(size)
+        if current is None:
+            self.size_groups[size] = file_id
+        elif isinstance(current, int):
+            self.size_groups[size] = array("I", (current, file_id))
+        else:
+            current.append(file_id)
+
+    def ungroup(self, file_id, size):
+        current = self.size_groups.get(size)
+        if isinstance(current, int):
+            if current == file_id:
+                del self.size_groups[size]
+        elif current is not None and file_id in current:
+            current.remove(file_id)
+
+    def candidate_groups(self):
+        for group in self.size_groups.values():
+            if not isinstance(group, int) and len(group) > 1:
+                yield group
+
+    def path(self, file_id):
+        return os.path.join(self.dir_paths[self.parents[file_id]], self.names[file_id])
+
+    def dev(self, file_id):
+        return self.dir_devs[self.parents[file_id]]
+
+    def record(self, file_id):
+        return FileRecord(file_id, self.path(file_id), self.sizes[file_id], self.mtimes[file_id], self.inodes[file_id],
+                          self.dev(file_id))
+
+    # Checkpoint files, one per column: typed arrays are stored raw, names and
+    # directory paths as NUL-terminated bytes. A scan only ever appends to
+    # the index, so each checkpoint just appends what was added since the
+    # last one. saved maps a column to [entries, bytes] already on disk.
+    CHECKPOINT_COLUMNS = (("dirs", "dir_paths"), ("dir_devs", "dir_devs"), ("parents", "parents"),
+                          ("names", "names"), ("sizes", "sizes"), ("mtimes", "mtimes"), ("inodes", "inodes"))
+
+    def save_columns(self, data_dir, saved):
+        for column, attr in self.CHECKPOINT_COLUMNS:
+            values = getattr(self, attr)
+            count, nbytes = saved.get(column, (0, 0))
+            if isinstance(values, array):
+                data = values[count:].tobytes()
+            else:
+                data = b"".join(os.fsencode(value) + b"\0" for value in islice(values, count, None))
+            append_checkpoint_file(os.path.join(data_dir, column + ".bin"), nbytes, data)
+            saved[column] = [len(values), nbytes + len(data)]
+
+    @classmethod
+    def load_columns(cls, data_dir, saved):
+        # Size groups are rebuilt from the sizes; they only change by add()
+        # while a scan runs
+        index = cls()
+        for column, attr in cls.CHECKPOINT_COLUMNS:
+            count, nbytes = saved[column]
+            values = getattr(index, attr)
+            raw = read_checkpoint_file(os.path.join(data_dir, column + ".bin"), nbytes)
+            if isinstance(values, array):
+                values.frombytes(raw)
+            else:
+                values.extend(os.fsdecode(value) for value in raw.split(b"\0")[:-1])
+            if len(values) != count:
+                raise ValueError("Scan session data is damaged.")
+        index.dir_ids = {path: dir_id for dir_id, path in enumerate(index.dir_paths)}
+        for file_id, size in enumerate(index.sizes):
+            index.group(file_id, size)
+        return index
+
+
+def append_checkpoint_file(path, offset, data):
+    # Cuts off anything written after the last complete checkpoint, then appends
+    with open(path, "r+b" if offset else "wb") as f:
+        if os.fstat(f.fileno()).st_size < offset:
+            raise ValueError(f"Checkpoint file is shorter than recorded: {path}")
+        f.truncate(offset)
+        f.seek(offset)
+        f.write(data)
+
+
+def read_checkpoint_file(path, nbytes):
+    if not nbytes:
+        return b""
+    with open(path, "rb") as f:
+        raw = f.read(nbytes)
+    if len(raw) != nbytes:
+        raise ValueError("Scan session data is incomplete.")
+    return raw
+
+
+# -- Out-of-core size grouping --
+
+class SizeSpill:
+    # External merge sort of walked files by size. Records go to sorted run
+    # files on disk and are merged back as a stream, so only same-size groups
+    # are ever held in memory. Runs replaced by a compaction are only retired:
+    # the last checkpoint may still list them, so they are deleted once a
+    # newer checkpoint has been saved (release_retired).
+    HEADER = struct.Struct("<qdQQH")
+    MAX_RUNS = 64
+
+    def __init__(self, run_dir, buffer_records, runs=None, fresh=False):
+        self.run_dir = run_dir
+        self.buffer_records = buffer_records
+        self.buffer = []
+        self.runs = list(runs or [])
+        self.retired = []
+        self.records_read = 0
+        if fresh:
+            shutil.rmtree(run_dir, ignore_errors=True)
+        os.makedirs(run_dir, exist_ok=True)
+        if runs is not None:
+            # Runs written after the checkpoint being resumed belong to no one
+            listed = {os.path.normcase(os.path.abspath(path)) for path in self.runs}
+            for name in os.listdir(run_dir):
+                path = os.path.join(run_dir, name)
+                if name.startswith("run_") and os.path.normcase(os.path.abspath(path)) not in listed:
+                    os.remove(path)
+
+    def add(self, size, mtime, inode, dev, filepath):
+        self.buffer.append((size, mtime, inode, dev, filepath))
+        if len(self.buffer) >= self.buffer_records:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        self.buffer.sort(key=lambda record: record[0])
+        self.runs.append(self.write_run(self.buffer))
+        self.buffer = []
+        if len(self.runs) > self.MAX_RUNS:
+            self.compact()
+
+    def write_run(self, records):
+        path = os.path.join(self.run_dir, f"run_{uuid.uuid4().hex}.bin")
+        header = self.HEADER
+        with open(path, "wb", buffering=1024 * 1024) as f:
+            for size, mtime, inode, dev, filepath in records:
+                raw = os.fsencode(filepath)
+                f.write(header.pack(size, mtime, inode, dev, len(raw)))
+                f.write(raw)
+        return path
+
+    def read_run(self, path):
+        header = self.HEADER
+        with open(path, "rb", buffering=1024 * 1024) as f:
+            while True:
+                head = f.read(header.size)
+                if len(head) < header.size:
+                    return
+                size, mtime, inode, dev, length = header.unpack(head)
+                yield size, mtime, inode, dev, os.fsdecode(f.read(length))
+
+    def merged(self):
+        return heapq.merge(*(self.read_run(path) for path in self.runs), key=lambda record: record[0])
+
+    def compact(self):
+        merged_path = self.write_run(self.merged())
+        self.retired.extend(self.runs)
+        self.runs = [merged_path]
+
+    def release_retired(self):
+        for path in self.retired:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Error removing spill run {path}: {e}")
+        self.retired = []
+
+    def groups(self):
+        # records_read counts the records of every finished group, singletons included
+        self.flush()
+        self.records_read = 0
+        group = []
+        for record in self.merged():
+            if group and record[0] != group[0][0]:
+                self.records_read += len(group)
+                if len(group) > 1:
+                    yield [FileRecord(None, r[4], r[0], r[1], r[2], r[3]) for r in group]
+                group = []
+            group.append(record)
+        self.records_read += len(group)
+        if len(group) > 1:
+            yield [FileRecord(None, r[4], r[0], r[1], r[2], r[3]) for r in group]
+
+    def cleanup(self):
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+
+# -- Scan control --
+
+class ScanCancelled(Exception):
+    pass
+
+
+class ScanControl:
+    # Cancel and pause flags shared by the scan thread and its hash workers.
+    # checkpoint() is cheap enough to call between every chunk; while paused
+    # it blocks on the condition instead of polling.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.cancelled = False
+        self.paused = False
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def pause(self):
+        with self.condition:
+            self.paused = True
+
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    def checkpoint(self):
+        # Returns False once the scan is cancelled
+        if self.paused and not self.cancelled:
+            with self.condition:
+                while self.paused and not self.cancelled:
+                    self.condition.wait()
+        return not self.cancelled
+
+    def sleep(self, seconds):
+        # Waits up to seconds; returns early on cancel
+        with self.condition:
+            self.condition.wait_for(lambda: self.cancelled, timeout=seconds)
+
+
+# -- Per-device I/O scheduling --
+
+FIEMAP_REQUEST = struct.Struct("=QQIIII")
+FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")
+
+
+def physical_offset(path):
+    # Disk offset of the first extent via FIEMAP, or None where unsupported
+    if not FCNTL_AVAILABLE:
+        return None
+    buf = bytearray(FIEMAP_REQUEST.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT.size))
+    try:
+        with open(path, "rb") as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buf)
+    except OSError:
+        return None
+    if FIEMAP_REQUEST.unpack_from(buf)[3] == 0:
+        return None
+    return FIEMAP_EXTENT.unpack_from(buf, FIEMAP_REQUEST.size)[1]
+
+
+def seek_order_key(offset, record):
+    # Files FIEMAP can place sort by disk offset; the rest follow by inode
+    return (0, offset) if offset is not None else (1, record.inode)
+
+
+class DeviceScheduler:
+    # Runs hash jobs with one worker pool per device (st_dev), sized for the
+    # storage behind it: a spinning disk gets a single stream so it is not
+    # seeking between files, SSDs, NVMe and network shares get many.
+    DEFAULT_LIMITS = {"hdd": 1, "ssd": 8, "nvme": 16, "network": 8, "unknown": 4}
+    ORDER_PROGRESS_EVERY = 500
+    NETWORK_FS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph", "glusterfs",
+                  "fuse.sshfs", "fuse.rclone"}
+
+    def __init__(self, overrides=None, seek_order=True):
+        # overrides maps a device kind ("hdd", "ssd", ...) or a mount point to a stream count
+        self.seek_order = seek_order
+        self.limits = dict(self.DEFAULT_LIMITS)
+        self.mount_limits = {}
+        for key, value in (overrides or {}).items():
+            try:
+                value = max(1, int(value))
+            except (TypeError, ValueError):
+                continue
+            if key in self.limits:
+                self.limits[key] = value
+            else:
+                self.mount_limits[os.path.normpath(key)] = value
+        self.mounts = self.read_mountinfo()
+        self.device_kinds = {}
+        self.device_limits = {}
+        # dev -> {inode: disk offset}, so files handed to run() again aren't probed twice
+        self.offsets = {}
+
+    @staticmethod
+    def read_mountinfo():
+        # "major:minor" -> (mount point, fs type, source), Linux only
+        mounts = {}
+        try:
+            with open("/proc/self/mountinfo", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    left, _, right = line.partition(" - ")
+                    fields = left.split()
+                    extra = right.split()
+                    if len(fields) < 5 or len(extra) < 2:
+                        continue
+                    mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[4])
+                    mounts.setdefault(fields[2], (mount_point, extra[0], extra[1]))
+        except OSError:
+            pass
+        return mounts
+
+    @staticmethod
+    def block_kind(block):
+        # Partitions have no queue directory of their own; their parent disk does
+        sys_path = os.path.join("/sys/dev/block", block)
+        for queue_dir in (os.path.join(sys_path, "queue"), os.path.join(sys_path, "..", "queue")):
+            try:
+                with open(os.path.join(queue_dir, "rotational")) as f:
+                    rotational = f.read().strip() == "1"
+            except OSError:
+                continue
+            if rotational:
+                return "hdd"
+            return "nvme" if "nvme" in os.path.realpath(sys_path) else "ssd"
+        return "unknown"
+
+    def device_key(self, dev):
+        if not hasattr(os, "major"):
+            return None
+        return f"{os.major(dev)}:{os.minor(dev)}"
+
+    def kind(self, dev):
+        kind = self.device_kinds.get(dev)
+        if kind is not None:
+            return kind
+        kind = "unknown"
+        key = self.device_key(dev)
+        if key:
+            mount = self.mounts.get(key)
+            if mount and mount[1] in self.NETWORK_FS:
+                kind = "network"
+            else:
+                block = key
+                if os.major(dev) == 0:
+                    # btrfs and other anonymous device numbers: look at the backing device
+                    block = None
+                    if mount and mount[2].startswith("/dev/"):
+                        try:
+                            rdev = os.stat(mount[2]).st_rdev
+                            block = f"{os.major(rdev)}:{os.minor(rdev)}"
+                        except OSError:
+                            pass
+                if block:
+                    kind = self.block_kind(block)
+        self.device_kinds[dev] = kind
+        return kind
+
+    def limit_for(self, dev):
+        limit = self.device_limits.get(dev)
+        if limit is None:
+            limit = self.limits[self.kind(dev)]
+            mount = self.mounts.get(self.device_key(dev) or "")
+            if mount and os.path.normpath(mount[0]) in self.mount_limits:
+                limit = self.mount_limits[os.path.normpath(mount[0])]
+            self.device_limits[dev] = limit
+        return limit
+
+    def seek_ordered(self, dev):
+        return self.seek_order and self.kind(dev) == "hdd"
+
+    def order(self, dev, jobs, control, progress=None):
+        # Reads on a spinning disk go in on-disk order so a pass is mostly
+        # sequential. Finding the offsets opens every file, so it stops on
+        # pause and cancel (returning None) and reports progress as it goes.
+        if not self.seek_ordered(dev):
+            return jobs
+        offsets = self.offsets.setdefault(dev, {})
+        total = len(jobs)
+        keys = []
+        for done, record in enumerate(jobs):
+            if not control.checkpoint():
+                return None
+            if progress and done % self.ORDER_PROGRESS_EVERY == 0:
+                progress(done, total)
+            if record.inode and record.inode in offsets:
+                offset = offsets[record.inode]
+            else:
+                offset = physical_offset(record.path)
+                if record.inode:
+                    offsets[record.inode] = offset
+            keys.append(seek_order_key(offset, record))
+        return [jobs[i] for i in sorted(range(total), key=keys.__getitem__)]
+
+    def run(self, jobs_by_device, work, control, thread_init=None, progress=None):
+        # Yields (job, result) in completion order. Jobs are FileRecords and
+        # work() must not raise. thread_init runs first on every worker.
+        # progress(done, total) is called while spinning disks are put in order;
+        # their workers start last so the other devices aren't kept waiting.
+        results = queue.Queue()
+        threads = []
+        for dev, jobs in sorted(jobs_by_device.items(), key=lambda item: self.seek_ordered(item[0])):
+            jobs = self.order(dev, jobs, control, progress)
+            if jobs is None:
+                break
+            pending = deque(jobs)
+            for _ in range(min(self.limit_for(dev), len(pending))):
+                thread = threading.Thread(target=self.worker, args=(pending, work, results, control, thread_init),
+                                          daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        remaining = sum(len(jobs) for jobs in jobs_by_device.values())
+        while remaining:
+            try:
+                item = results.get(timeout=0.2)
+            except queue.Empty:
+                if not any(thread.is_alive() for thread in threads):
+                    break
+                continue
+            remaining -= 1
+            yield item
+        # Workers stopped early; hand back whatever they finished
+        while not results.empty():
+            yield results.get()
+
+    @staticmethod
+    def worker(pending, work, results, control, thread_init):
+        if thread_init:
+            thread_init()
+        while control.checkpoint():
+            try:
+                job = pending.popleft()
+            except IndexError:
+                return
+            result = work(job)
+            if control.cancelled:
+                # The job may have been cut short; it is redone on resume
+                return
+            results.put((job, result))
+
+
+# -- Background priority --
+
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314, "ppc64le": 273}
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_WHO_PROCESS = 1
+
+
+class TokenBucket:
+    # Rate limiter shared by all workers. Callers may take more than the
+    # bucket holds; the debt is paid off by sleeping.
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount, control):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            control.sleep(wait)
+
+
+class ScanThrottle:
+    # Background-priority scans: MB/s and files/s caps, dropping hashed files
+    # from the page cache and running the scan threads at idle priority.
+    def __init__(self, mb_per_sec=0, files_per_sec=0, lower_priority=True, drop_cache=True):
+        self.bytes = TokenBucket(mb_per_sec * 1024 * 1024) if mb_per_sec > 0 else None
+        self.files = TokenBucket(files_per_sec) if files_per_sec > 0 else None
+        self.lower_priority = lower_priority
+        self.drop_cache = drop_cache and hasattr(os, "posix_fadvise")
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            parse_float(settings.get("background_mb_per_sec", 0)) or 0,
+            parse_float(settings.get("background_files_per_sec", 0)) or 0,
+            settings.get("background_lower_priority", True),
+        )
+
+    def take_file(self, control):
+        if self.files:
+            self.files.take(1, control)
+
+    def take_bytes(self, count, control):
+        if self.bytes and count:
+            self.bytes.take(count, control)
+
+    def release_cache(self, fd):
+        if self.drop_cache:
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
+
+    def enter_thread(self):
+        # On Linux both calls apply to the calling thread only
+        if not self.lower_priority:
+            return
+        thread_id = threading.get_native_id()
+        if hasattr(os, "setpriority"):
+            try:
+                os.setpriority(os.PRIO_PROCESS, thread_id, 19)
+            except OSError:
+                pass
+        syscall_nr = IOPRIO_SET_SYSCALLS.get(platform.machine())
+        if sys.platform.startswith("linux") and syscall_nr:
+            try:
+                libc = ctypes.CDLL(None, use_errno=True)
+                libc.syscall(syscall_nr, IOPRIO_WHO_PROCESS, thread_id, IOPRIO_CLASS_IDLE << 13)
+            except (OSError, AttributeError):
+                pass
+
+
+# -- Archive members --
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ARCHIVE_CACHE_VERSION = 1
+
+
+def is_archive_name(name):
+    return name.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def is_archive_dir(dirpath):
+    # Members of archive.zip are indexed under the virtual folder "archive.zip!"
+    return dirpath.endswith("!") and is_archive_name(dirpath[:-1])
+
+
+def split_archive_path(path):
+    # "archive.zip!/dir/file" -> ("archive.zip", "dir/file"); (None, None) for real files
+    marker = "!" + os.sep
+    pos = path.find(marker)
+    while pos != -1:
+        if is_archive_name(path[:pos]):
+            return path[:pos], path[pos + len(marker):]
+        pos = path.find(marker, pos + 1)
+    return None, None
+
+
+def list_archive(archive_path):
+    # Regular-file members as [name, size, mtime]. Tar archives are read as a
+    # stream, so compressed ones are decompressed once, front to back.
+    members = []
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    members.append([info.filename, info.file_size, time.mktime(info.date_time + (0, 0, -1))])
+    else:
+        with tarfile.open(archive_path, "r|*") as tf:
+            for member in tf:
+                if member.isfile():
+                    members.append([member.name, member.size, float(member.mtime)])
+    return members
+
+
+def open_archive_members(archive_path, names):
+    # Yields (name, file object) for the wanted members without extracting
+    # anything to disk; each stream is only valid until the next one is yielded
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            for name in names:
+                with zf.open(name) as f:
+                    yield name, f
+    else:
+        with tarfile.open(archive_path, "r|*") as tf:
+            for member in tf:
+                if member.isfile() and member.name in names:
+                    yield member.name, tf.extractfile(member)
+
+
+class MemberStat:
+    # Stands in for os.stat_result when indexing archive members
+    __slots__ = ("st_size", "st_mtime", "st_ino", "st_dev")
+
+    def __init__(self, size, mtime, dev):
+        self.st_size = size
+        self.st_mtime = mtime
+        self.st_ino = 0
+        self.st_dev = dev
+
+
+class ArchiveCache:
+    # Member listings and digests per archive, trusted for as long as the
+    # archive's (size, mtime, inode) signature is unchanged
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == ARCHIVE_CACHE_VERSION:
+                self.entries = data.get("archives", {})
+        except (OSError, ValueError):
+            pass
+
+    def entry(self, archive_path, st):
+        signature = [st.st_size, st.st_mtime_ns, st.st_ino]
+        entry = self.entries.get(archive_path)
+        if entry is None or entry["signature"] != signature:
+            entry = self.entries[archive_path] = {"signature": signature, "members": None, "digests": {}}
+            self.dirty = True
+        return entry
+
+    def members(self, archive_path, st):
+        entry = self.entry(archive_path, st)
+        if entry["members"] is None:
+            entry["members"] = list_archive(archive_path)
+            self.dirty = True
+        return entry["members"]
+
+    def digests(self, archive_path, st, algorithm):
+        # {member name: hex digest}; callers set dirty when they add to it
+        return self.entry(archive_path, st)["digests"].setdefault(algorithm, {})
+
+    def save(self):
+        if not self.dirty:
+            return
+        # Archives that are gone are dropped from the cache
+        self.entries = {path: entry for path, entry in self.entries.items() if os.path.exists(path)}
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": ARCHIVE_CACHE_VERSION, "archives": self.entries}, f, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except Exception as e:
+            print(f"Error saving archive cache: {e}")
+
+
+# -- Scan engine --
+
+class ScanEngine:
+    # Walks and hashes on the scan thread and reports through out_queue.
+    # Its state can be checkpointed to a session file and resumed later;
+    # engines built without a session path are not checkpointed.
+    # LIVE_UPDATES marks results that watch mode can keep current.
+    LIVE_UPDATES = True
+    CHECKPOINT_INTERVAL = 30
+    CHECKPOINT_COST_RATIO = 10
+    SESSION_VERSION = 5
+    HASH_RECORD = struct.Struct("<I?16s")
+    SPILL_BUFFER_RECORDS = 500000
+    SPILL_HASH_BATCH = 1024
+    HASH_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, roots, hash_size, scan_filter, out_queue, control, session_path,
+                 spill_dir=None, scheduler=None, throttle=None, find_folders=False, archive_cache=None):
+        self.roots = list(roots or [])
+        self.hash_size = hash_size
+        self.scan_filter = scan_filter
+        self.out_queue = out_queue
+        self.control = control
+        self.session_path = session_path
+        self.spill_dir = spill_dir
+        self.scheduler = scheduler or DeviceScheduler()
+        self.throttle = throttle
+        self.find_folders = find_folders
+        self.archive_cache = archive_cache
+
+        self.phase = "walk"
+        self.pending_dirs = list(reversed(self.roots))
+        self.index = FileIndex()
+        self.spill = None
+        self.groups_done = 0
+        self.empty_dirs = []
+        self.incomplete_dirs = []
+        self.folder_duplicates = {}
+        self.folder_info = {}
+        self.hashed = {}
+        self.total_files_found = 0
+        self.duplicates = {}
+        self.file_info = {}
+        self.last_checkpoint = time.monotonic()
+        self.checkpoint_interval = self.CHECKPOINT_INTERVAL
+        self.checkpoint_saved = {}
+        # Watch mode changes index and hashed on its own thread while holding
+        # this; other threads reading them after the scan take it too
+        self.index_lock = threading.Lock()
+
+    @property
+    def algorithm(self):
+        return "md5" if self.hash_size == 0 else f"md5-first-{self.hash_size}"
+
+    def run(self, resume=False):
+        try:
+            if self.throttle:
+                self.throttle.enter_thread()
+            if resume:
+                self.load_checkpoint()
+            elif self.spill_dir:
+                self.spill = SizeSpill(self.spill_dir, self.SPILL_BUFFER_RECORDS, fresh=True)
+            if self.phase == "walk":
+                if not self.walk():
+                    return
+                self.phase = "hash"
+            if self.spill:
+                if not self.hash_spilled_groups():
+                    return
+            elif not self.hash_candidates():
+                return
+            self.finish()
+        except Exception as e:
+            traceback.print_exc()
+            self.out_queue.put(("error", str(e), self.total_files_found))
+        finally:
+            if self.archive_cache:
+                self.archive_cache.save()
+
+    def walk(self):
+        # Depth-first walk with an explicit frontier so it can be checkpointed
+        # between directories. A directory's files are only committed once it
+        # has been read completely, so a cancel mid-directory just puts it
+        # back on the frontier.
+        index = self.index
+        scan_filter = self.scan_filter
+        control = self.control
+        while self.pending_dirs:
+            if not control.checkpoint():
+                self.cancel("Scan cancelled during folder walk.")
+                return False
+
+            current = self.pending_dirs.pop()
+            try:
+                with os.scandir(current) as it:
+                    entries = list(it)
+            except OSError:
+                self.incomplete_dirs.append(current)
+                continue
+
+            # Directories holding nothing but walked subdirectories are kept
+            # as candidates for empty-folder cleanup; directories with skipped
+            # entries can never be reported as duplicate folders
+            found = []
+            subdirs = []
+            archives = []
+            has_content = False
+            skipped = False
+            for entry in entries:
+                if not control.checkpoint():
+                    self.pending_dirs.append(current)
+                    self.cancel("Scan cancelled during folder walk.")
+                    return False
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink() and not scan_filter.prune_dir(entry.path):
+                            subdirs.append(entry.path)
+                        else:
+                            has_content = skipped = True
+                        continue
+                    has_content = True
+                    if self.archive_cache and is_archive_name(entry.name):
+                        archives.append(entry.path)
+                    if not scan_filter.accepts_name(entry.path, entry.name):
+                        skipped = True
+                        continue
+                    st = entry.stat()
+                    if st.st_size < scan_filter.min_size:
+                        skipped = True
+                        continue
+                    found.append((entry, st))
+                except OSError:
+                    has_content = skipped = True
+
+            if not has_content:
+                self.empty_dirs.append(current)
+            if skipped:
+                self.incomplete_dirs.append(current)
+
+            self.total_files_found += len(found)
+            if found and self.spill:
+                for entry, st in found:
+                    self.spill.add(st.st_size, st.st_mtime, st.st_ino, st.st_dev, entry.path)
+            elif found:
+                dir_id = index.intern_dir(current, found[0][1].st_dev)
+                for entry, st in found:
+                    index.add(dir_id, entry.name, st)
+            for archive_path in archives:
+                self.add_archive_members(archive_path)
+            self.pending_dirs.extend(reversed(subdirs))
+            self.maybe_checkpoint()
+        return True
+
+    def add_archive_members(self, archive_path):
+        # Members go under the virtual folder "archive.zip!" so they are
+        # grouped with regular files of the same size
+        try:
+            st = os.stat(archive_path)
+            members = self.archive_cache.members(archive_path, st)
+        except Exception as e:
+            print(f"Error reading archive {archive_path}: {e}")
+            return
+        scan_filter = self.scan_filter
+        virtual_dir = archive_path + "!"
+        added = []
+        for name, size, mtime in members:
+            if name.startswith("/") or size < scan_filter.min_size:
+                continue
+            virtual_path = os.path.join(virtual_dir, name)
+            if scan_filter.accepts_name(virtual_path, name.rsplit("/", 1)[-1]):
+                added.append((name, virtual_path, MemberStat(size, mtime, st.st_dev)))
+
+        self.total_files_found += len(added)
+        if added and self.spill:
+            for name, virtual_path, member_st in added:
+                self.spill.add(member_st.st_size, member_st.st_mtime, 0, st.st_dev, virtual_path)
+        elif added:
+            dir_id = self.index.intern_dir(virtual_dir, st.st_dev)
+            for name, virtual_path, member_st in added:
+                self.index.add(dir_id, name, member_st)
+
+    def hash_job(self, record):
+        try:
+            return self.hash_file(record.path)
+        except Exception:
+            return None
+
+    def hash_records(self, records):
+        # Hashes in parallel through the device scheduler; yields (record, digest).
+        # Archive members are read first, one pass per archive on this thread.
+        jobs_by_device = {}
+        members_by_archive = {}
+        for record in records:
+            archive_path, member = split_archive_path(record.path) if self.archive_cache else (None, None)
+            if archive_path:
+                members_by_archive.setdefault(archive_path, []).append((member, record))
+            else:
+                jobs_by_device.setdefault(record.dev, []).append(record)
+        for archive_path, members in members_by_archive.items():
+            yield from self.hash_archive_members(archive_path, members)
+        yield from self.scheduler.run(jobs_by_device, self.hash_job, self.control,
+                                      self.throttle.enter_thread if self.throttle else None, self.report_ordering)
+
+    def report_ordering(self, done, total):
+        self.out_queue.put(("status", f"Ordering files by disk position: {done} / {total}"))
+
+    def hash_archive_members(self, archive_path, members):
+        # Cached digests are reused while the archive is unchanged; the rest
+        # are streamed through the hasher in archive order
+        wanted = {}
+        for member, record in members:
+            wanted.setdefault(member, []).append(record)
+        try:
+            cached = self.archive_cache.digests(archive_path, os.stat(archive_path), self.algorithm)
+        except OSError:
+            cached = None
+
+        if cached is not None:
+            for member in [m for m in wanted if m in cached]:
+                for record in wanted.pop(member):
+                    yield record, bytes.fromhex(cached[member])
+        if cached is not None and wanted:
+            try:
+                for member, stream in open_archive_members(archive_path, set(wanted)):
+                    if member not in wanted:
+                        continue
+                    if self.throttle:
+                        self.throttle.take_file(self.control)
+                    digest = self.hash_stream(stream, archive_path)
+                    cached[member] = digest.hex()
+                    self.archive_cache.dirty = True
+                    for record in wanted.pop(member):
+                        yield record, digest
+            except ScanCancelled:
+                return
+            except Exception as e:
+                print(f"Error reading archive {archive_path}: {e}")
+        for records in wanted.values():
+            for record in records:
+                yield record, None
+
+    def hash_candidates(self):
+        index = self.index
+        files_to_hash = [file_id for group in index.candidate_groups() for file_id in group]
+        total = len(files_to_hash)
+        self.out_queue.put(("status", f"Scanning {total} candidate files for duplicates..."))
+
+        pending = [index.record(file_id) for file_id in files_to_hash if file_id not in self.hashed]
+        done = total - len(pending)
+        for record, digest in self.hash_records(pending):
+            self.hashed[record.file_id] = digest
+            done += 1
+            self.out_queue.put(("progress", done, total))
+            self.maybe_checkpoint()
+        if done < total:
+            self.cancel("Scan cancelled during hashing.")
+            return False
+        return True
+
+    def hash_file_ids(self, file_ids):
+        # Hashes any set of indexed files, SPILL_HASH_BATCH records at a time
+        index = self.index
+        total = len(file_ids)
+        done = 0
+        for start in range(0, total, self.SPILL_HASH_BATCH):
+            batch = file_ids[start:start + self.SPILL_HASH_BATCH]
+            for record, digest in self.hash_records([index.record(file_id) for file_id in batch]):
+                self.hashed[record.file_id] = digest
+                done += 1
+                self.out_queue.put(("progress", done, total))
+            if done < start + len(batch):
+                self.cancel("Scan cancelled during hashing.")
+                return False
+        return True
+
+    def hash_spilled_groups(self):
+        # Groups stream out of the merged run files in a single pass; hashes
+        # are only kept per group, plus whatever turns out to be a duplicate.
+        # Progress is measured against every walked file, since the number
+        # of candidates is only known once the merge is over.
+        spill = self.spill
+        total = self.total_files_found
+        self.out_queue.put(("status", f"Scanning {total} files for duplicates in size order..."))
+
+        # Small groups are hashed in batches so the device pools have enough work
+        done = 0
+        batch = []
+        batch_records = 0
+        for group_num, group in enumerate(spill.groups()):
+            if group_num < self.groups_done:
+                continue
+            batch.append((group_num, group))
+            batch_records += len(group)
+            if batch_records >= self.SPILL_HASH_BATCH:
+                if self.hash_spilled_batch(batch, done, total) is None:
+                    return False
+                done = spill.records_read
+                batch = []
+                batch_records = 0
+        if batch and self.hash_spilled_batch(batch, done, total) is None:
+            return False
+        self.out_queue.put(("progress", total, total))
+        return True
+
+    def hash_spilled_batch(self, batch, done, total):
+        digests = {}
+        records = [record for _, group in batch for record in group]
+        for record, digest in self.hash_records(records):
+            digests[id(record)] = digest
+            done += 1
+            self.out_queue.put(("progress", done, total))
+        if len(digests) < len(records):
+            self.cancel("Scan cancelled during hashing.")
+            return None
+
+        for group_num, group in batch:
+            hashes = {}
+            for record in group:
+                digest = digests[id(record)]
+                if digest:
+                    hashes.setdefault(digest, []).append(record)
+            for digest, records in hashes.items():
+                if len(records) > 1:
+                    self.duplicates.setdefault(digest, []).extend(r.path for r in records)
+                    for r in records:
+                        self.file_info[r.path] = (r.size, r.mtime)
+            self.groups_done = group_num + 1
+        self.maybe_checkpoint()
+        return done
+
+    def hash_file(self, filepath):
+        throttle = self.throttle
+        if throttle:
+            throttle.take_file(self.control)
+        with open(filepath, "rb") as f:
+            digest = self.hash_stream(f, filepath)
+            if throttle:
+                throttle.release_cache(f.fileno())
+        return digest
+
+    def hash_stream(self, f, filepath):
+        # Reads in chunks so pause and cancel take effect mid-file
+        control = self.control
+        throttle = self.throttle
+        hasher = hashlib.md5()
+        remaining = self.hash_size or None
+        while remaining is None or remaining > 0:
+            if not control.checkpoint():
+                raise ScanCancelled(filepath)
+            chunk_size = self.HASH_CHUNK_SIZE if remaining is None else min(remaining, self.HASH_CHUNK_SIZE)
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+            if throttle:
+                throttle.take_bytes(len(chunk), control)
+        return hasher.digest()
+
+    def finish(self):
+        if self.spill:
+            self.spill.cleanup()
+            self.remove_checkpoint()
+            self.out_queue.put(("done", self.duplicates, self.total_files_found))
+            print("Scan completed normally.")
+            return
+
+        index = self.index
+        hashes = {}
+        for file_id, digest in self.hashed.items():
+            if digest:
+                hashes.setdefault(digest, []).append(file_id)
+
+        # Paths are only materialized for files that turned out to be duplicates
+        self.duplicates = {}
+        self.file_info = {}
+        for digest, file_ids in hashes.items():
+            if len(file_ids) < 2:
+                continue
+            paths = []
+            for file_id in file_ids:
+                filepath = index.path(file_id)
+                paths.append(filepath)
+                self.file_info[filepath] = (index.sizes[file_id], index.mtimes[file_id])
+            self.duplicates[digest] = paths
+
+        if self.find_folders:
+            self.out_queue.put(("status", "Looking for duplicate folders..."))
+            self.folder_duplicates, self.folder_info = find_duplicate_folders(
+                index, self.hashed, self.roots, self.incomplete_dirs, self.empty_dirs
+            )
+
+        self.remove_checkpoint()
+        self.out_queue.put(("done", self.duplicates, self.total_files_found))
+        print("Scan completed normally.")
+
+    def cancel(self, message):
+        print(message)
+        if self.session_path:
+            self.save_checkpoint()
+        self.out_queue.put(("cancelled", None, self.total_files_found))
+
+    # -- Checkpoints --
+
+    def maybe_checkpoint(self):
+        if self.session_path and time.monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+            self.save_checkpoint()
+        elif not self.session_path and self.spill and self.spill.retired:
+            self.spill.release_retired()
+
+    def save_checkpoint(self):
+        # The session file holds the small state; the index and the hashes go
+        # to append-only files in the session's .data folder. The session
+        # file is replaced last and records how much of each file is valid.
+        started = time.monotonic()
+        if self.spill:
+            self.spill.flush()
+        state = {
+            "version": self.SESSION_VERSION,
+            "roots": self.roots,
+            "hash_size": self.hash_size,
+            "phase": self.phase,
+            "pending_dirs": self.pending_dirs,
+            "total_files_found": self.total_files_found,
+            "spill": {"run_dir": self.spill.run_dir, "runs": self.spill.runs} if self.spill else None,
+            "groups_done": self.groups_done,
+            "empty_dirs": self.empty_dirs,
+            "incomplete_dirs": self.incomplete_dirs,
+            "spill_duplicates": [[digest.hex(), paths] for digest, paths in self.duplicates.items()] if self.spill else [],
+            "spill_file_info": [[path, size, mtime] for path, (size, mtime) in self.file_info.items()] if self.spill else [],
+            "saved_at": datetime.datetime.now().isoformat(),
+        }
+        tmp_path = self.session_path + ".tmp"
+        data_dir = self.session_path + ".data"
+        saved = {column: list(value) for column, value in self.checkpoint_saved.items()}
+        try:
+            os.makedirs(data_dir, exist_ok=True)
+            self.index.save_columns(data_dir, saved)
+            self.save_hashes(data_dir, saved)
+            state["columns"] = saved
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f, separators=(",", ":"))
+            os.replace(tmp_path, self.session_path)
+            self.checkpoint_saved = saved
+            if self.spill:
+                self.spill.release_retired()
+        except Exception as e:
+            print(f"Error saving scan checkpoint: {e}")
+            # The next checkpoint rewrites the data files from the start
+            self.checkpoint_saved = {}
+        self.last_checkpoint = time.monotonic()
+        # Keeps checkpointing a small share of the scan once saves get slow
+        self.checkpoint_interval = max(self.CHECKPOINT_INTERVAL,
+                                       (self.last_checkpoint - started) * self.CHECKPOINT_COST_RATIO)
+
+    def save_hashes(self, data_dir, saved):
+        # hashed only grows during a scan, so the entries past the saved count are new
+        record = self.HASH_RECORD
+        count, nbytes = saved.get("hashed", (0, 0))
+        data = b"".join(record.pack(file_id, digest is not None, digest or b"")
+                        for file_id, digest in islice(self.hashed.items(), count, None))
+        append_checkpoint_file(os.path.join(data_dir, "hashed.bin"), nbytes, data)
+        saved["hashed"] = [len(self.hashed), nbytes + len(data)]
+
+    def load_hashes(self, data_dir, saved):
+        raw = read_checkpoint_file(os.path.join(data_dir, "hashed.bin"), saved.get("hashed", (0, 0))[1])
+        return {file_id: digest if valid else None for file_id, valid, digest in self.HASH_RECORD.iter_unpack(raw)}
+
+    def load_checkpoint(self):
+        with open(self.session_path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("version") != self.SESSION_VERSION:
+            raise ValueError("Unsupported scan session file.")
+
+        self.roots = state["roots"]
+        self.hash_size = state["hash_size"]
+        self.phase = state["phase"]
+        self.pending_dirs = state["pending_dirs"]
+        self.total_files_found = state["total_files_found"]
+        self.empty_dirs = state.get("empty_dirs", [])
+        self.incomplete_dirs = state.get("incomplete_dirs", [])
+        data_dir = self.session_path + ".data"
+        saved = state["columns"]
+        self.index = index = FileIndex.load_columns(data_dir, saved)
+        self.checkpoint_saved = saved
+        self.out_queue.put(("status", f"Resuming scan of {'; '.join(self.roots)}..."))
+
+        spill = state.get("spill")
+        if spill:
+            # Finished groups are kept as results; the rest are re-read from the run files
+            self.spill = SizeSpill(spill["run_dir"], self.SPILL_BUFFER_RECORDS, runs=spill["runs"])
+            self.groups_done = state.get("groups_done", 0)
+            self.duplicates = {bytes.fromhex(digest): paths for digest, paths in state.get("spill_duplicates", [])}
+            self.file_info = {path: (size, mtime) for path, size, mtime in state.get("spill_file_info", [])}
+            return
+
+        # Re-check candidate files; stored sizes and hashes are only reused for
+        # files whose size and mtime are unchanged
+        hashed = self.load_hashes(data_dir, saved)
+        candidates = [file_id for group in index.candidate_groups() for file_id in group]
+        saved_mtime = os.path.getmtime(self.session_path)
+        changed = 0
+        for file_id in candidates:
+            filepath = index.path(file_id)
+            archive_path = split_archive_path(filepath)[0]
+            if archive_path:
+                # Archive members are kept while the archive is untouched since the checkpoint
+                archive_st = stat_or_none(archive_path) if self.archive_cache else None
+                if archive_st is not None and archive_st.st_mtime < saved_mtime:
+                    if file_id in hashed:
+                        self.hashed[file_id] = hashed[file_id]
+                    continue
+                changed += 1
+                index.ungroup(file_id, index.sizes[file_id])
+                continue
+            st = stat_or_none(filepath)
+            if st is not None and (st.st_size, st.st_mtime) == (index.sizes[file_id], index.mtimes[file_id]):
+                if file_id in hashed:
+                    self.hashed[file_id] = hashed[file_id]
+                continue
+            changed += 1
+            if st is None:
+                index.ungroup(file_id, index.sizes[file_id])
+            else:
+                index.update(file_id, st)
+        if changed:
+            print(f"{changed} file(s) changed since the last checkpoint and will be rehashed.")
+        # Everything kept in hashed is already in hashed.bin
+        saved["hashed"] = [len(self.hashed), saved.get("hashed", (0, 0))[1]]
+
+    def remove_checkpoint(self):
+        if not self.session_path:
+            return
+        try:
+            if os.path.exists(self.session_path):
+                os.remove(self.session_path)
+            shutil.rmtree(self.session_path + ".data", ignore_errors=True)
+        except OSError as e:
+            print(f"Error removing scan checkpoint: {e}")
+
+
+# -- Duplicate folders --
+
+def find_duplicate_folders(index, hashed, roots, incomplete_dirs, empty_dirs):
+    # Merkle digest per directory, bottom-up from its files' (name, size,
+    # digest) and its subdirectories' digests. A file that was never hashed
+    # had a unique size, so its folder (and every folder above it) cannot
+    # have a duplicate; the same goes for folders with filtered or unreadable
+    # entries. Returns ({digest: [folder paths]}, {folder path: (size, files)})
+    # keeping only the largest duplicate subtrees.
+    entries = {}
+    unique = set(incomplete_dirs)
+    for group in index.size_groups.values():
+        for file_id in (group,) if isinstance(group, int) else group:
+            dirpath = index.dir_paths[index.parents[file_id]]
+            if is_archive_dir(dirpath):
+                continue
+            digest = hashed.get(file_id)
+            if digest is None:
+                unique.add(dirpath)
+            else:
+                entries.setdefault(dirpath, []).append((b"f", index.names[file_id], index.sizes[file_id], 1, digest))
+
+    roots = set(roots)
+    digests = {}
+    info = {}
+    all_dirs = {path for path in index.dir_paths if not is_archive_dir(path)} | set(empty_dirs) | unique
+    for dirpath in sorted(all_dirs, key=lambda path: path.count(os.sep), reverse=True):
+        parent = os.path.dirname(dirpath)
+        if dirpath in unique:
+            if dirpath not in roots:
+                unique.add(parent)
+            continue
+        hasher = hashlib.md5()
+        total_size = 0
+        file_count = 0
+        for kind, name, size, count, digest in sorted(entries.get(dirpath, ())):
+            hasher.update(kind + os.fsencode(name) + b"\0" + struct.pack("<qq", size, count) + digest)
+            total_size += size
+            file_count += count
+        if dirpath not in roots:
+            entries.setdefault(parent, []).append((b"d", os.path.basename(dirpath), total_size, file_count, hasher.digest()))
+        if file_count:
+            digests.setdefault(hasher.digest(), []).append(dirpath)
+            info[dirpath] = (total_size, file_count)
+
+    groups = {digest: sorted(paths) for digest, paths in digests.items() if len(paths) > 1}
+    grouped = {path for paths in groups.values() for path in paths}
+    # Subfolders of duplicate folders are already covered by their parents' group
+    groups = {digest: paths for digest, paths in groups.items()
+              if not all(os.path.dirname(path) in grouped for path in paths)}
+    info = {path: info[path] for paths in groups.values() for path in paths}
+    return groups, info
+
+
+# -- Reference index --
+
+class BloomFilter:
+    # Bit array over MD5 digests. The digests are already uniform, so the
+    # probe positions come from double hashing their two halves.
+    def __init__(self, bits, hashes=7, data=None):
+        self.bits = max(64, bits)
+        self.hashes = hashes
+        self.data = data if data is not None else bytearray((self.bits + 7) // 8)
+
+    def positions(self, digest):
+        h1, h2 = struct.unpack_from("<QQ", digest)
+        h2 |= 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, digest):
+        for pos in self.positions(digest):
+            self.data[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, digest):
+        return all(self.data[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(digest))
+
+
+class ReferenceIndex:
+    # Saved (digest, size, mtime, path) table of a large corpus. Opening one
+    # loads only its distinct sizes and a Bloom filter over the digests;
+    # matches are found by binary search in the digest-sorted table on disk.
+    MAGIC = b"DFREF001"
+    RECORD = struct.Struct("<16sqdQI")
+    BLOOM_BITS_PER_FILE = 10
+    BLOOM_HASHES = 7
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError("Not a reference index file.")
+            (header_len,) = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(header_len).decode("utf-8"))
+            sizes = array("q")
+            sizes.frombytes(f.read(8 * header["sizes"]))
+            bloom = bytearray(f.read(header["bloom_bytes"]))
+            self.table_offset = f.tell()
+        if sys.byteorder == "big":
+            sizes.byteswap()
+        self.hash_size = header["hash_size"]
+        self.algorithm = header["algorithm"]
+        self.roots = header["roots"]
+        self.created = header["created"]
+        self.count = header["files"]
+        self.sizes = set(sizes)
+        self.bloom = BloomFilter(header["bloom_bits"], header["bloom_hashes"], bloom)
+        self.paths_offset = self.table_offset + self.count * self.RECORD.size
+
+    @classmethod
+    def write(cls, path, entries, hash_size, algorithm, roots):
+        # entries is a list of (digest, size, mtime, path) and is sorted in place
+        entries.sort()
+        bloom = BloomFilter(len(entries) * cls.BLOOM_BITS_PER_FILE, cls.BLOOM_HASHES)
+        sizes = array("q", sorted({size for _, size, _, _ in entries}))
+        if sys.byteorder == "big":
+            sizes.byteswap()
+        table = bytearray()
+        paths = bytearray()
+        for digest, size, mtime, filepath in entries:
+            bloom.add(digest)
+            raw = os.fsencode(filepath)
+            table += cls.RECORD.pack(digest, size, mtime, len(paths), len(raw))
+            paths += raw
+        header = json.dumps({
+            "hash_size": hash_size,
+            "algorithm": algorithm,
+            "roots": roots,
+            "created": datetime.datetime.now().isoformat(),
+            "files": len(entries),
+            "sizes": len(sizes),
+            "bloom_bits": bloom.bits,
+            "bloom_hashes": bloom.hashes,
+            "bloom_bytes": len(bloom.data),
+        }).encode("utf-8")
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cls.MAGIC)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            f.write(sizes.tobytes())
+            f.write(bloom.data)
+            f.write(table)
+            f.write(paths)
+        os.replace(tmp_path, path)
+
+    def lookup(self, digests):
+        # {digest: [(path, size, mtime)]} for the digests present in the table
+        record = self.RECORD
+        found = {}
+        with open(self.path, "rb") as f:
+            def read(pos):
+                f.seek(self.table_offset + pos * record.size)
+                return record.unpack(f.read(record.size))
+
+            for digest in sorted(digests):
+                lo, hi = 0, self.count
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if read(mid)[0] < digest:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                while lo < self.count:
+                    entry_digest, size, mtime, offset, length = read(lo)
+                    if entry_digest != digest:
+                        break
+                    f.seek(self.paths_offset + offset)
+                    found.setdefault(digest, []).append((os.fsdecode(f.read(length)), size, mtime))
+                    lo += 1
+        return found
+
+
+class ReferenceBuildEngine(ScanEngine):
+    # Walks the corpus and hashes every file, since any of them may match a
+    # later drop, then writes the reference index. Not checkpointed.
+    LIVE_UPDATES = False
+
+    def __init__(self, roots, hash_size, scan_filter, out_queue, control, output_path, scheduler=None, throttle=None):
+        super().__init__(roots, hash_size, scan_filter, out_queue, control, None, scheduler=scheduler, throttle=throttle)
+        self.output_path = output_path
+
+    def run(self, resume=False):
+        try:
+            if self.throttle:
+                self.throttle.enter_thread()
+            if not self.walk():
+                return
+            self.phase = "hash"
+            index = self.index
+            file_ids = [file_id for group in index.size_groups.values()
+                        for file_id in ((group,) if isinstance(group, int) else group)]
+            self.out_queue.put(("status", f"Hashing {len(file_ids)} files for the reference index..."))
+            if not self.hash_file_ids(file_ids):
+                return
+            entries = [(digest, index.sizes[file_id], index.mtimes[file_id], index.path(file_id))
+                       for file_id, digest in self.hashed.items() if digest]
+            self.out_queue.put(("status", f"Writing reference index of {len(entries)} files..."))
+            ReferenceIndex.write(self.output_path, entries, self.hash_size, self.algorithm, self.roots)
+            self.out_queue.put(("reference_built", self.output_path, len(entries)))
+            print("Reference index built.")
+        except Exception as e:
+            traceback.print_exc()
+            self.out_queue.put(("error", str(e), self.total_files_found))
+
+
+class ReferenceCompareEngine(ScanEngine):
+    # Walks and hashes only the new folders. Files whose size is not in the
+    # reference are never read, and only digests that pass the Bloom filter
+    # are looked up in the table on disk. Not checkpointed.
+    LIVE_UPDATES = False
+
+    def __init__(self, roots, scan_filter, out_queue, control, reference, scheduler=None, throttle=None):
+        super().__init__(roots, reference.hash_size, scan_filter, out_queue, control, None,
+                         scheduler=scheduler, throttle=throttle)
+        self.reference = reference
+        # Paths in the reference, listed for comparison but never changed
+        self.reference_paths = set()
+
+    def run(self, resume=False):
+        try:
+            if self.throttle:
+                self.throttle.enter_thread()
+            if not self.walk():
+                return
+            self.phase = "hash"
+            index = self.index
+            reference = self.reference
+            file_ids = [file_id for size, group in index.size_groups.items() if size in reference.sizes
+                        for file_id in ((group,) if isinstance(group, int) else group)]
+            self.out_queue.put(("status", f"Hashing {len(file_ids)} of {self.total_files_found} files "
+                                          "with sizes found in the reference..."))
+            if not self.hash_file_ids(file_ids):
+                return
+
+            candidates = {}
+            for file_id, digest in self.hashed.items():
+                if digest and digest in reference.bloom:
+                    candidates.setdefault(digest, []).append(file_id)
+            matches = reference.lookup(candidates)
+
+            # Each group lists the new files first, then their copies in the
+            # reference. A partial hash only covers the start of a file, so a
+            # match also needs the same size.
+            self.duplicates = {}
+            self.file_info = {}
+            for digest, reference_files in matches.items():
+                by_size = {}
+                for file_id in candidates[digest]:
+                    by_size.setdefault(index.sizes[file_id], ([], []))[0].append(file_id)
+                for entry in reference_files:
+                    if entry[1] in by_size:
+                        by_size[entry[1]][1].append(entry)
+                by_size = {size: group for size, group in by_size.items() if group[1]}
+                for size, (file_ids, same_size) in by_size.items():
+                    paths = []
+                    for file_id in file_ids:
+                        filepath = index.path(file_id)
+                        paths.append(filepath)
+                        self.file_info[filepath] = (size, index.mtimes[file_id])
+                    for filepath, _size, mtime in same_size:
+                        paths.append(filepath)
+                        self.file_info[filepath] = (size, mtime)
+                        self.reference_paths.add(filepath)
+                    # Rare: files of several sizes share a partial digest
+                    key = digest if len(by_size) == 1 else digest + struct.pack(">Q", size)
+                    self.duplicates[key] = paths
+            self.out_queue.put(("done", self.duplicates, self.total_files_found))
+            print("Reference comparison completed normally.")
+        except Exception as e:
+            traceback.print_exc()
+            self.out_queue.put(("error", str(e), self.total_files_found))
+
+
+# -- Near-duplicate images --
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tif", ".tiff", ".webp"}
+DCT_SIZE = 32
+_dct_matrix = None
+
+
+def dct_matrix():
+    global _dct_matrix
+    if _dct_matrix is None:
+        n = numpy.arange(DCT_SIZE)
+        _dct_matrix = numpy.cos(numpy.pi * numpy.outer(n, 2 * n + 1) / (2 * DCT_SIZE)).astype(numpy.float32)
+    return _dct_matrix
+
+
+def pack_bits(bits):
+    weights = numpy.left_shift(numpy.uint64(1), numpy.arange(63, -1, -1, dtype=numpy.uint64))
+    return (bits.astype(numpy.uint64) * weights).sum(axis=1, dtype=numpy.uint64)
+
+
+def image_hash_batch(paths):
+    # Runs in a worker process. PIL decodes and shrinks each image, then the
+    # aHash, dHash and pHash of the whole batch are computed in one numpy
+    # pass. Returns (ahash, dhash, phash) per path, or None if unreadable.
+    load_pillow()
+    load_numpy()
+    small = []
+    wide = []
+    readable = []
+    for pos, path in enumerate(paths):
+        try:
+            with Image.open(path) as img:
+                img.draft("L", (DCT_SIZE * 2, DCT_SIZE * 2))
+                gray = img.convert("L")
+                small.append(numpy.asarray(gray.resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS), dtype=numpy.float32))
+                wide.append(numpy.asarray(gray.resize((9, 8), Image.LANCZOS), dtype=numpy.float32))
+                readable.append(pos)
+        except Exception:
+            pass
+    results = [None] * len(paths)
+    if not readable:
+        return results
+
+    pixels = numpy.stack(small)
+    blocks = pixels.reshape(-1, 8, DCT_SIZE // 8, 8, DCT_SIZE // 8).mean(axis=(2, 4)).reshape(-1, 64)
+    ahash = pack_bits(blocks > blocks.mean(axis=1, keepdims=True))
+    wide = numpy.stack(wide)
+    dhash = pack_bits((wide[:, :, 1:] > wide[:, :, :-1]).reshape(-1, 64))
+    dct = dct_matrix()
+    low = (dct @ pixels @ dct.T)[:, :8, :8].reshape(-1, 64)
+    phash = pack_bits(low > numpy.median(low[:, 1:], axis=1, keepdims=True))
+    for row, pos in enumerate(readable):
+        results[pos] = (int(ahash[row]), int(dhash[row]), int(phash[row]))
+    return results
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    # Metric tree over 64-bit hashes; a radius search only descends into
+    # children whose edge distance is within radius of the query distance.
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        node = [value, item, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, value, radius):
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node_value, item, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= radius:
+                found.append(item)
+            for edge, child in children.items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+        return found
+
+
+class ImageScanEngine(ScanEngine):
+    # Near-duplicate photos: walks like ScanEngine, hashes every image with
+    # perceptual hashes on a process pool and groups them through a BK-tree
+    # at a Hamming distance threshold. Image scans are not checkpointed.
+    LIVE_UPDATES = False
+    BATCH_SIZE = 32
+
+    def __init__(self, roots, scan_filter, out_queue, control, threshold=10, workers=None):
+        super().__init__(roots, 0, scan_filter, out_queue, control, None)
+        self.threshold = threshold
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.similarity = {}
+
+    @property
+    def algorithm(self):
+        return f"phash-{self.threshold}"
+
+    def run(self, resume=False):
+        try:
+            if not self.walk():
+                return
+            self.phase = "hash"
+            hashes = self.hash_images()
+            if hashes is None:
+                return
+            self.group_images(hashes)
+            self.out_queue.put(("done", self.duplicates, self.total_files_found))
+            print("Image scan completed normally.")
+        except Exception as e:
+            traceback.print_exc()
+            self.out_queue.put(("error", str(e), self.total_files_found))
+
+    def hash_images(self):
+        index = self.index
+        file_ids = [file_id for group in index.size_groups.values()
+                    for file_id in ((group,) if isinstance(group, int) else group)
+                    if os.path.splitext(index.names[file_id])[1].lower() in IMAGE_EXTENSIONS]
+        total = len(file_ids)
+        self.out_queue.put(("status", f"Computing perceptual hashes for {total} images..."))
+
+        batches = iter([file_ids[i:i + self.BATCH_SIZE] for i in range(0, total, self.BATCH_SIZE)])
+        hashes = {}
+        done = 0
+        pool = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            pending = {}
+
+            def submit():
+                batch = next(batches, None)
+                if batch:
+                    pending[pool.submit(image_hash_batch, [index.path(file_id) for file_id in batch])] = batch
+
+            for _ in range(self.workers * 2):
+                submit()
+            while pending:
+                if not self.control.checkpoint():
+                    self.cancel("Image scan cancelled during hashing.")
+                    return None
+                finished, _ = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    batch = pending.pop(future)
+                    for file_id, result in zip(batch, future.result()):
+                        if result:
+                            hashes[file_id] = result
+                    done += len(batch)
+                    self.out_queue.put(("progress", done, total))
+                    submit()
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        return hashes
+
+    def group_images(self, hashes):
+        # Each image is searched against those added before it, so every
+        # close pair is seen once; pHash finds candidates and dHash confirms
+        index = self.index
+        threshold = self.threshold
+        tree = BKTree()
+        parent = {}
+
+        def find(file_id):
+            while parent[file_id] != file_id:
+                parent[file_id] = parent[parent[file_id]]
+                file_id = parent[file_id]
+            return file_id
+
+        for file_id, (_, dhash, phash) in hashes.items():
+            parent[file_id] = file_id
+            for other in tree.search(phash, threshold):
+                if hamming(dhash, hashes[other][1]) <= threshold:
+                    parent[find(other)] = find(file_id)
+            tree.add(phash, file_id)
+
+        groups = {}
+        for file_id in hashes:
+            groups.setdefault(find(file_id), []).append(file_id)
+
+        self.duplicates = {}
+        self.file_info = {}
+        self.similarity = {}
+        for members in groups.values():
+            if len(members) < 2:
+                continue
+            members.sort()
+            _, rep_dhash, rep_phash = hashes[members[0]]
+            paths = []
+            for file_id in members:
+                filepath = index.path(file_id)
+                paths.append(filepath)
+                self.file_info[filepath] = (index.sizes[file_id], index.mtimes[file_id])
+                distance = hamming(hashes[file_id][2], rep_phash)
+                self.similarity[filepath] = f"{round(100 * (1 - distance / 64))}%"
+            self.duplicates[struct.pack(">QQ", rep_phash, rep_dhash)] = paths
+
+
+# -- Partial overlap analysis --
+
+GEAR_TABLE = [int.from_bytes(hashlib.md5(bytes([i])).digest()[:8], "little") for i in range(256)]
+GEAR_MASK64 = (1 << 64) - 1
+
+
+class ChunkOverlapAnalyzer:
+    # Splits files into content-defined chunks with a gear rolling hash (cut
+    # points depend only on the last 64 bytes, so an edit shifts a few chunks
+    # rather than the rest of the file) and indexes chunk digests. Overlap is
+    # counted per pair of files sharing chunks; files are never compared
+    # pairwise. Chunks found in more than MAX_FANOUT files still count as
+    # reclaimable but not towards pairs.
+    MIN_CHUNK = 2 * 1024
+    MAX_CHUNK = 64 * 1024
+    CUT_MASK = (1 << 13) - 1
+    READ_SIZE = 8 * 1024 * 1024
+    MAX_FANOUT = 64
+    MAX_PAIRS = 500
+
+    def __init__(self, files, control, out_queue):
+        self.files = files
+        self.control = control
+        self.out_queue = out_queue
+
+    def cut_points(self, block, tail, last):
+        # Offsets in block after which a chunk ends. tail holds the up to 63
+        # bytes before block; last is the previous cut, relative to block.
+        if NUMPY_AVAILABLE:
+            load_numpy()
+            data = numpy.frombuffer(tail + block, dtype=numpy.uint8)
+            gear = numpy.array(GEAR_TABLE, dtype=numpy.uint64)[data]
+            # h[i] = sum of gear[i - j] << j for j < 64, built by doubling the window
+            h = gear.copy()
+            width = 1
+            while width < 64:
+                shifted = numpy.zeros_like(h)
+                shifted[width:] = h[:-width] << numpy.uint64(width)
+                h += shifted
+                width *= 2
+            hits = numpy.flatnonzero((h[len(tail):] & numpy.uint64(self.CUT_MASK)) == 0) + 1
+        else:
+            h = 0
+            for byte in tail:
+                h = ((h << 1) + GEAR_TABLE[byte]) & GEAR_MASK64
+            hits = []
+            for i, byte in enumerate(block):
+                h = ((h << 1) + GEAR_TABLE[byte]) & GEAR_MASK64
+                if not h & self.CUT_MASK:
+                    hits.append(i + 1)
+
+        cuts = []
+        for pos in hits:
+            while pos - last > self.MAX_CHUNK:
+                last += self.MAX_CHUNK
+                cuts.append(last)
+            if pos - last >= self.MIN_CHUNK:
+                cuts.append(int(pos))
+                last = int(pos)
+        while len(block) - last >= self.MAX_CHUNK:
+            last += self.MAX_CHUNK
+            cuts.append(last)
+        return cuts
+
+    def file_chunks(self, path):
+        # Yields (chunk key, length)
+        carry = b""
+        tail = b""
+        with open(path, "rb") as f:
+            while True:
+                if not self.control.checkpoint():
+                    raise ScanCancelled(path)
+                block = f.read(self.READ_SIZE)
+                if not block:
+                    break
+                start = 0
+                for cut in self.cut_points(block, tail, -len(carry)):
+                    chunk = carry + block[start:cut] if carry else block[start:cut]
+                    carry = b""
+                    start = cut
+                    yield int.from_bytes(hashlib.blake2b(chunk, digest_size=8).digest(), "little"), len(chunk)
+                carry += block[start:]
+                tail = (tail + block)[-63:]
+        if carry:
+            yield int.from_bytes(hashlib.blake2b(carry, digest_size=8).digest(), "little"), len(carry)
+
+    def run(self):
+        try:
+            report = self.analyze()
+        except ScanCancelled:
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self.out_queue.put(("overlap_failed", str(e)))
+            return
+        self.out_queue.put(("overlap_done", report))
+
+    def analyze(self):
+        chunk_files = {}
+        chunk_sizes = {}
+        total_bytes = 0
+        for file_no, (path, _) in enumerate(self.files):
+            seen = set()
+            try:
+                for key, length in self.file_chunks(path):
+                    total_bytes += length
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    chunk_sizes[key] = length
+                    owners = chunk_files.get(key)
+                    if owners is None:
+                        chunk_files[key] = file_no
+                    elif isinstance(owners, int):
+                        chunk_files[key] = array("I", (owners, file_no))
+                    else:
+                        owners.append(file_no)
+            except OSError as e:
+                print(f"Overlap analysis skipped {path}: {e}")
+            self.out_queue.put(("overlap_progress", file_no + 1, len(self.files)))
+
+        shared = {}
+        for key, owners in chunk_files.items():
+            if isinstance(owners, int) or len(owners) > self.MAX_FANOUT:
+                continue
+            length = chunk_sizes[key]
+            for i, a in enumerate(owners):
+                for b in owners[i + 1:]:
+                    shared[(a, b)] = shared.get((a, b), 0) + length
+
+        pairs = []
+        for (a, b), shared_bytes in heapq.nlargest(self.MAX_PAIRS * 2, shared.items(), key=lambda item: item[1]):
+            (path_a, size_a), (path_b, size_b) = self.files[a], self.files[b]
+            if size_a == size_b == shared_bytes:
+                continue  # exact duplicates are already reported by a normal scan
+            percent = 100 * shared_bytes / max(1, min(size_a, size_b))
+            pairs.append((path_a, path_b, shared_bytes, percent))
+        unique_bytes = sum(chunk_sizes.values())
+        return {
+            "files": len(self.files),
+            "total_bytes": total_bytes,
+            "unique_bytes": unique_bytes,
+            "reclaimable": total_bytes - unique_bytes,
+            "pairs": pairs[:self.MAX_PAIRS],
+        }
+
+
+# -- Watch mode --
+
+class InotifyWatcher:
+    # Minimal ctypes binding for Linux inotify. Watches are per directory.
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.watches = {}
+
+    def add(self, dirpath):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dirpath)
+        self.watches[wd] = dirpath
+
+    def remove_tree(self, dirpath):
+        # Drop the watches for a folder and everything below it, so events
+        # from a tree moved out of reach aren't reported under its old path
+        prefix = os.path.join(dirpath, "")
+        for wd, path in list(self.watches.items()):
+            if path == dirpath or path.startswith(prefix):
+                del self.watches[wd]
+                # Fails harmlessly when the kernel already dropped the watch
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        # Returns [(mask, path)]
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((mask, None))
+                continue
+            base = self.watches.get(wd)
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif base is not None:
+                path = os.path.join(base, name) if name else base
+                events.append((mask, path))
+                # Stop translating the rest of this buffer through watches
+                # on a folder that is gone or moved away
+                if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    self.remove_tree(base)
+                elif mask & self.IN_ISDIR and mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                    self.remove_tree(path)
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LiveIndex:
+    # Keeps a finished scan's FileIndex and digests current. Changed files are
+    # only hashed when their size matches another file, and apply() returns
+    # the duplicate groups whose membership changed. index and hashed are only
+    # changed while holding lock, and not at all once control is cancelled, so
+    # a watcher that is being stopped can't race the next one.
+    def __init__(self, index, hashed, hash_file, scan_filter, lock, control):
+        self.index = index
+        self.hashed = hashed
+        self.hash_file = hash_file
+        self.scan_filter = scan_filter
+        self.lock = lock
+        self.control = control
+        # Files that left their size group (gone on resume) are not looked up
+        self.lookup = {}
+        for group in index.size_groups.values():
+            for file_id in (group,) if isinstance(group, int) else group:
+                if not is_archive_dir(index.dir_paths[index.parents[file_id]]):
+                    self.lookup[(index.parents[file_id], index.names[file_id])] = file_id
+        self.groups = {}
+        for file_id, digest in hashed.items():
+            if digest:
+                self.groups.setdefault(digest, set()).add(file_id)
+
+    def key(self, path, create=False, dev=0):
+        dirpath, name = os.path.split(path)
+        dir_id = self.index.intern_dir(dirpath, dev) if create else self.index.dir_ids.get(dirpath)
+        return None if dir_id is None else (dir_id, name)
+
+    def forget(self, file_id, affected):
+        digest = self.hashed.pop(file_id, None)
+        if digest and digest in self.groups:
+            self.groups[digest].discard(file_id)
+            affected.add(digest)
+
+    def remove(self, path, affected):
+        file_id = self.lookup.pop(self.key(path), None)
+        if file_id is not None:
+            self.forget(file_id, affected)
+            self.index.ungroup(file_id, self.index.sizes[file_id])
+
+    def remove_tree(self, dirpath, affected):
+        prefix = dirpath.rstrip(os.sep) + os.sep
+        dir_ids = {dir_id for path, dir_id in self.index.dir_ids.items() if path == dirpath or path.startswith(prefix)}
+        for key in [key for key in self.lookup if key[0] in dir_ids]:
+            path = os.path.join(self.index.dir_paths[key[0]], key[1])
+            self.remove(path, affected)
+
+    def apply(self, changed, removed, removed_dirs=()):
+        # Files are stat'ed and hashed outside the lock
+        stats = [(path, stat_or_none(path)) for path in changed]
+        affected = set()
+        with self.lock:
+            if self.control.cancelled:
+                return {}
+            to_hash = self.update(stats, removed, removed_dirs, affected)
+        digests = []
+        for file_id, path in to_hash:
+            try:
+                digests.append(self.hash_file(path))
+            except Exception:
+                digests.append(None)
+        with self.lock:
+            if self.control.cancelled:
+                return {}
+            return self.finish(to_hash, digests, affected)
+
+    def update(self, stats, removed, removed_dirs, affected):
+        # Returns [(file_id, path)] of the files that need a digest
+        index = self.index
+        scan_filter = self.scan_filter
+        touched_sizes = set()
+        for dirpath in removed_dirs:
+            self.remove_tree(dirpath, affected)
+        for path in removed:
+            self.remove(path, affected)
+        for path, st in stats:
+            if st is None:
+                self.remove(path, affected)
+                continue
+            if not scan_filter.accepts_name(path, os.path.basename(path)) or st.st_size < scan_filter.min_size:
+                self.remove(path, affected)
+                continue
+            key = self.key(path, create=True, dev=st.st_dev)
+            file_id = self.lookup.get(key)
+            if file_id is None:
+                file_id = self.lookup[key] = index.add(key[0], key[1], st)
+            elif (st.st_size, st.st_mtime) == (index.sizes[file_id], index.mtimes[file_id]):
+                continue
+            else:
+                self.forget(file_id, affected)
+                index.update(file_id, st)
+            touched_sizes.add(st.st_size)
+
+        to_hash = []
+        for size in touched_sizes:
+            group = index.size_groups.get(size)
+            if group is None or isinstance(group, int):
+                continue
+            to_hash.extend((file_id, index.path(file_id)) for file_id in group if file_id not in self.hashed)
+        return to_hash
+
+    def finish(self, to_hash, digests, affected):
+        index = self.index
+        for (file_id, _), digest in zip(to_hash, digests):
+            self.hashed[file_id] = digest
+            if digest:
+                self.groups.setdefault(digest, set()).add(file_id)
+                affected.add(digest)
+
+        changes = {}
+        for digest in affected:
+            file_ids = self.groups.get(digest)
+            if not file_ids:
+                self.groups.pop(digest, None)
+            changes[digest] = [(index.path(file_id), index.sizes[file_id], index.mtimes[file_id])
+                               for file_id in file_ids] if file_ids and len(file_ids) > 1 else []
+        return changes
+
+    def poll(self, roots):
+        # Polling fallback: one walk of the roots, compared against the index
+        index = self.index
+        seen = set()
+        changed = []
+        pending = list(roots)
+        while pending:
+            current = pending.pop()
+            try:
+                with os.scandir(current) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            dir_id = index.dir_ids.get(current)
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink() and not self.scan_filter.prune_dir(entry.path):
+                            pending.append(entry.path)
+                        continue
+                    file_id = self.lookup.get((dir_id, entry.name)) if dir_id is not None else None
+                    if file_id is None:
+                        changed.append(entry.path)
+                        continue
+                    seen.add(file_id)
+                    st = entry.stat()
+                    if (st.st_size, st.st_mtime) != (index.sizes[file_id], index.mtimes[file_id]):
+                        changed.append(entry.path)
+                except OSError:
+                    pass
+        removed = [index.path(file_id) for file_id in self.lookup.values() if file_id not in seen]
+        return changed, removed
+
+
+class ScanWatcher:
+    # Feeds file system changes under the scan roots into a LiveIndex and
+    # reports changed groups as ("watch_update", changes). Uses inotify where
+    # available and falls back to polling.
+    DEBOUNCE_SECONDS = 1.0
+    MAX_BATCH_SECONDS = 5.0
+    POLL_INTERVAL = 60
+
+    def __init__(self, live_index, roots, scan_filter, control, out_queue):
+        self.live = live_index
+        self.roots = roots
+        self.scan_filter = scan_filter
+        self.control = control
+        self.out_queue = out_queue
+        self.notify = None
+
+    def run(self):
+        try:
+            try:
+                self.notify = InotifyWatcher()
+                for root in self.roots:
+                    self.watch_tree(root)
+                self.out_queue.put(("watch_status", "Watching for changes (inotify)."))
+            except OSError as e:
+                print(f"inotify unavailable, polling instead: {e}")
+                if self.notify:
+                    self.notify.close()
+                self.notify = None
+                self.out_queue.put(("watch_status", f"Watching for changes (polling every {self.POLL_INTERVAL}s)."))
+            if self.notify:
+                self.run_inotify()
+            else:
+                self.run_polling()
+        except Exception as e:
+            traceback.print_exc()
+            self.out_queue.put(("watch_status", f"Watch mode stopped: {e}"))
+        finally:
+            if self.notify:
+                self.notify.close()
+
+    def watch_tree(self, dirpath, files=None):
+        # Adds watches for dirpath and everything below it; files found on the
+        # way are collected for directories that appeared after the scan
+        pending = [dirpath]
+        while pending:
+            current = pending.pop()
+            try:
+                self.notify.add(current)
+                with os.scandir(current) as it:
+                    entries = list(it)
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink() and not self.scan_filter.prune_dir(entry.path):
+                            pending.append(entry.path)
+                    elif files is not None:
+                        files.add(entry.path)
+                except OSError:
+                    pass
+
+    def run_inotify(self):
+        notify = self.notify
+        changed = set()
+        removed = set()
+        removed_dirs = set()
+        batch_started = None
+        last_event = 0
+        while self.control.checkpoint():
+            events = notify.read(0.5)
+            now = time.monotonic()
+            for mask, path in events:
+                if path is None:
+                    # Event queue overflowed; resync the whole tree
+                    poll_changed, poll_removed = self.live.poll(self.roots)
+                    changed.update(poll_changed)
+                    removed.update(poll_removed)
+                elif mask & (notify.IN_DELETE_SELF | notify.IN_MOVE_SELF):
+                    # A watched folder went away without a parent event we
+                    # see (e.g. a root); its watches are already dropped
+                    removed_dirs.add(path)
+                elif mask & notify.IN_ISDIR:
+                    if mask & (notify.IN_CREATE | notify.IN_MOVED_TO):
+                        if not self.scan_filter.prune_dir(path):
+                            self.watch_tree(path, changed)
+                    elif mask & (notify.IN_DELETE | notify.IN_MOVED_FROM):
+                        removed_dirs.add(path)
+                elif mask & (notify.IN_CLOSE_WRITE | notify.IN_MOVED_TO | notify.IN_CREATE):
+                    # IN_CREATE alone covers new hard links, which are never written
+                    changed.add(path)
+                    removed.discard(path)
+                elif mask & (notify.IN_DELETE | notify.IN_MOVED_FROM):
+                    removed.add(path)
+                    changed.discard(path)
+            if events:
+                last_event = now
+                batch_started = batch_started or now
+            if batch_started and (now - last_event >= self.DEBOUNCE_SECONDS or
+                                  now - batch_started >= self.MAX_BATCH_SECONDS):
+                self.flush(changed, removed, removed_dirs)
+                batch_started = None
+
+    def run_polling(self):
+        while True:
+            self.control.sleep(self.POLL_INTERVAL)
+            if not self.control.checkpoint():
+                return
+            changed, removed = self.live.poll(self.roots)
+            self.flush(set(changed), set(removed), set())
+
+    def flush(self, changed, removed, removed_dirs):
+        if changed or removed or removed_dirs:
+            changes = self.live.apply(list(changed), list(removed), list(removed_dirs))
+            if changes:
+                self.out_queue.put(("watch_update", changes))
+            changed.clear()
+            removed.clear()
+            removed_dirs.clear()
+
+
+# -- Undo history index --
+
+class UndoHistoryIndex:
+    # Sorted view over the delete/move history lists so the undo dialog can
+    # page and filter without inserting every record into a Treeview.
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.entries = []
+        self.rebuild()
+
+    def rebuild(self):
+        entries = []
+        for type_, records in self.sources.items():
+            for record in records:
+                entries.append((
+                    str(record.get("timestamp", "")),
+                    type_,
+                    str(record.get("original", "")).lower(),
+                    record,
+                ))
+        entries.sort(key=lambda e: e[0], reverse=True)
+        self.entries = entries
+
+    def query(self, type_filter="All", path_filter="", date_from="", date_to=""):
+        path_filter = path_filter.strip().lower()
+        date_from = date_from.strip()
+        date_to = date_to.strip()
+        matches = []
+        for pos, (timestamp, type_, original_lower, _record) in enumerate(self.entries):
+            if type_filter != "All" and type_ != type_filter:
+                continue
+            if date_from and timestamp[:len(date_from)] < date_from:
+                continue
+            if date_to and timestamp[:len(date_to)] > date_to:
+                continue
+            if path_filter and path_filter not in original_lower:
+                continue
+            matches.append(pos)
+        return matches
+
+    def page(self, matches, page_num, page_size):
+        start = page_num * page_size
+        return [(pos, self.entries[pos]) for pos in matches[start:start + page_size]]
+
+
+# -- Undo backup garbage collection --
+
+# Backups are named uuid4_originalname; nothing else in the folder is touched
+BACKUP_NAME_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}_")
+
+
+def backup_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+class UndoBackupCollector:
+    # Reconciles the undo backup folder with a snapshot of the delete history:
+    #   - records whose backup is gone are dropped
+    #   - backups older than max_age_days are removed with their records
+    #   - backup files no record points to are removed
+    #   - while the rest is over quota_bytes, the least recently accessed
+    #     backups are removed with their records
+    # Runs on its own thread and pauses after every few files so it stays in
+    # the background. The records to drop are handed back through out_queue.
+    PACE_EVERY = 64
+    PACE_SECONDS = 0.02
+
+    def __init__(self, folder, records, max_age_days, quota_bytes, lock, out_queue):
+        self.folder = folder
+        self.records = records
+        self.max_age_days = max_age_days
+        self.quota_bytes = quota_bytes
+        self.lock = lock
+        self.out_queue = out_queue
+        self.started = time.time()
+        self.steps = 0
+
+    def pace(self):
+        self.steps += 1
+        if self.steps % self.PACE_EVERY == 0:
+            time.sleep(self.PACE_SECONDS)
+
+    def usage(self, path):
+        # Bytes used by a backup file or folder, and when it was last read
+        st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            return st.st_size, st.st_atime
+        size = 0
+        atime = st.st_atime
+        for dirpath, _dirnames, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    file_stat = os.lstat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                size += file_stat.st_size
+                atime = max(atime, file_stat.st_atime)
+                self.pace()
+        return size, atime
+
+    def remove(self, path):
+        # Held while removing so an undo of the same backup waits for it
+        with self.lock:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def run(self):
+        try:
+            self.out_queue.put(("backup_gc_done", self.collect()))
+        except Exception as e:
+            self.out_queue.put(("backup_gc_failed", str(e)))
+
+    def collect(self):
+        cutoff = self.started - self.max_age_days * 86400
+        dropped = []
+        evict = []
+        live = []
+        known = set()
+        for record in self.records:
+            self.pace()
+            backup = record.get("backup")
+            try:
+                size, atime = self.usage(backup)
+            except (OSError, TypeError, ValueError):
+                dropped.append(record)
+                continue
+            known.add(backup_key(backup))
+            try:
+                created = datetime.datetime.fromisoformat(record.get("timestamp")).timestamp()
+            except (TypeError, ValueError):
+                created = 0
+            if created < cutoff:
+                evict.append((backup, size, record))
+            else:
+                live.append((atime, size, backup, record))
+
+        if os.path.isdir(self.folder):
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    self.pace()
+                    if not BACKUP_NAME_PATTERN.match(entry.name) or backup_key(entry.path) in known:
+                        continue
+                    try:
+                        # Backups made after the snapshot have no record in it yet
+                        if entry.stat(follow_symlinks=False).st_ctime >= self.started:
+                            continue
+                        size, _atime = self.usage(entry.path)
+                    except OSError:
+                        continue
+                    evict.append((entry.path, size, None))
+
+        live.sort(key=lambda item: item[0])
+        kept_bytes = sum(item[1] for item in live)
+        kept = len(live)
+        for _atime, size, backup, record in live:
+            if not self.quota_bytes or kept_bytes <= self.quota_bytes:
+                break
+            evict.append((backup, size, record))
+            kept_bytes -= size
+            kept -= 1
+
+        reclaimed = 0
+        removed = 0
+        for path, size, record in evict:
+            try:
+                self.remove(path)
+                reclaimed += size
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Error removing undo backup {path}: {e}")
+                kept_bytes += size
+                kept += 1
+                continue
+            if record is not None:
+                dropped.append(record)
+            self.pace()
+        return {"reclaimed": reclaimed, "removed": removed, "dropped": dropped, "kept": kept, "kept_bytes": kept_bytes}
+
+
+# -- In-place deduplication --
+
+def reflink_file(src, dst):
+    if not FCNTL_AVAILABLE:
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform")
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+
+def replace_with_link(kept, duplicate, mode="auto"):
+    # Builds the link next to the duplicate and swaps it in with os.replace,
+    # so the duplicate path never disappears. Returns the method used.
+    tmp_path = os.path.join(os.path.dirname(duplicate), f".{uuid.uuid4().hex}.dflink")
+    try:
+        if mode in ("auto", "reflink"):
+            try:
+                reflink_file(kept, tmp_path)
+                os.replace(tmp_path, duplicate)
+                return "reflink"
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                if mode == "reflink":
+                    raise
+        os.link(kept, tmp_path)
+        os.replace(tmp_path, duplicate)
+        return "hardlink"
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# -- Move planning --
+
+class MovePlanner:
+    # Lists the target folder once and hands out conflict-free names from
+    # memory instead of probing name_1, name_2, ... on disk for every file.
+
+    def __init__(self, target_folder):
+        self.target_folder = target_folder
+        self.case_insensitive = os.path.normcase("A") == "a"
+        try:
+            names = os.listdir(target_folder)
+        except OSError:
+            names = []
+        self.taken = {self.name_key(name) for name in names}
+        self.next_counter = {}
+        try:
+            self.target_dev = os.stat(target_folder).st_dev
+        except OSError:
+            self.target_dev = None
+
+    def name_key(self, name):
+        return name.lower() if self.case_insensitive else name
+
+    def reserve(self, filename):
+        key = self.name_key(filename)
+        if key not in self.taken:
+            self.taken.add(key)
+            return os.path.join(self.target_folder, filename)
+
+        base, ext = os.path.splitext(filename)
+        counter = self.next_counter.get(key, 1)
+        while True:
+            candidate = f"{base}_{counter}{ext}"
+            counter += 1
+            if self.name_key(candidate) not in self.taken:
+                break
+        self.next_counter[key] = counter
+        self.taken.add(self.name_key(candidate))
+        return os.path.join(self.target_folder, candidate)
+
+
+# Errors from filesystems that can't make hard links
+NO_HARDLINK_ERRNOS = {errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK}
+
+
+def move_no_replace(source, target):
+    # Same-device move that fails instead of replacing anything that appeared
+    # at target after its name was reserved. Raises EXDEV when the caller
+    # has to copy instead.
+    if os.name == "nt":
+        # Windows renames never replace an existing file
+        os.rename(source, target)
+        return
+    if os.path.isdir(source) and not os.path.islink(source):
+        # Claim the name with an empty folder; a rename only replaces an empty one
+        os.mkdir(target)
+        try:
+            os.rename(source, target)
+        except OSError:
+            os.rmdir(target)
+            raise
+        return
+    try:
+        os.link(source, target, follow_symlinks=False)
+    except OSError as e:
+        if e.errno in NO_HARDLINK_ERRNOS:
+            raise OSError(errno.EXDEV, "hard links are not supported here") from e
+        raise
+    try:
+        os.unlink(source)
+    except OSError:
+        os.unlink(target)
+        raise
+
+
+def copy_file_exclusive(src, dst):
+    # shutil.copy2 that fails instead of replacing a file that appeared at dst
+    with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    shutil.copystat(src, dst)
+
+
+# -- Scan daemon --
+
+DAEMON_DEFAULT_ADDRESS = "http://127.0.0.1:8765"
+DAEMON_SESSION_FILE = "daemon_scan_session.json"
+DAEMON_TOKEN_FILE = "daemon_token"
+
+
+def write_daemon_token(path):
+    # A fresh secret per daemon run, readable only by the user who started it
+    token = secrets.token_urlsafe(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        if hasattr(os, "fchmod"):
+            os.fchmod(f.fileno(), 0o600)
+        f.write(token)
+    return token
+
+
+def read_daemon_token(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def parse_daemon_address(address):
+    # "unix:/path/to.sock" or "http://host:port"
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    url = urllib.parse.urlsplit(address if "://" in address else "http://" + address)
+    return "http", (url.hostname or "127.0.0.1", url.port or 8765)
+
+
+class ScanDaemon:
+    # Long-running owner of one scan engine and its results, shared by any
+    # number of local clients. Engine messages are folded into the state
+    # below and into a numbered event backlog that clients can stream.
+    EVENT_BACKLOG = 1000
+    PROGRESS_INTERVAL = 0.25
+    TERMINAL_MESSAGES = ("done", "cancelled", "error")
+
+    def __init__(self, settings_path):
+        self.settings_path = settings_path
+        self.lock = threading.Condition()
+        self.engine = None
+        self.control = None
+        self.state = "idle"
+        self.status = ""
+        self.progress = [0, 0]
+        self.files_found = 0
+        self.roots = []
+        self.algorithm = ""
+        self.duplicates = {}
+        self.file_info = {}
+        self.events = deque(maxlen=self.EVENT_BACKLOG)
+        self.next_event = 1
+        self.jobs = {}
+        self.claimed = set()
+
+    def load_settings(self):
+        # Read per scan so the daemon follows changes made in the GUI
+        try:
+            with open(self.settings_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def emit(self, event):
+        # Callers hold the lock
+        event["id"] = self.next_event
+        self.next_event += 1
+        self.events.append(event)
+        self.lock.notify_all()
+
+    def running(self):
+        return self.state in ("scanning", "paused") or any(job["state"] == "running" for job in self.jobs.values())
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "status": self.status,
+                "progress": list(self.progress),
+                "files_found": self.files_found,
+                "roots": self.roots,
+                "algorithm": self.algorithm,
+                "groups": len(self.duplicates),
+                "last_event": self.next_event - 1,
+            }
+
+    # -- Scans --
+
+    def start_scan(self, roots=None, resume=False, hash_size=None):
+        settings = self.load_settings()
+        if hash_size is not None and (isinstance(hash_size, bool) or not isinstance(hash_size, int) or hash_size < 0):
+            raise ValueError("hash_size must be a number of bytes, or 0 to hash whole files.")
+        if resume:
+            if not os.path.exists(DAEMON_SESSION_FILE):
+                raise ValueError("There is no interrupted scan to resume.")
+            roots = None
+        else:
+            if not isinstance(roots, list) or not all(isinstance(root, str) for root in roots):
+                raise ValueError("roots must be a list of folder paths.")
+            invalid = [root for root in roots or [] if not os.path.isdir(root)]
+            if not roots or invalid:
+                raise ValueError("Not a valid folder: " + ", ".join(invalid or ["(none given)"]))
+            roots = normalize_roots(roots)
+
+        with self.lock:
+            if self.state in ("scanning", "paused"):
+                raise RuntimeError("A scan is already running.")
+            out_queue = queue.Queue()
+            self.control = ScanControl()
+            self.engine = engine = ScanEngine(
+                roots, settings.get("hash_size", 8 * 1024 * 1024) if hash_size is None else hash_size,
+                ScanFilter.from_settings(settings), out_queue, self.control, DAEMON_SESSION_FILE,
+                spill_dir=DAEMON_SESSION_FILE + ".runs" if settings.get("spill_grouping") else None,
+                scheduler=DeviceScheduler(settings.get("device_concurrency"), settings.get("seek_order", True)),
+                throttle=ScanThrottle.from_settings(settings) if settings.get("background_scan") else None,
+                archive_cache=ArchiveCache(DuplicateFinderApp.ARCHIVE_CACHE_FILE) if settings.get("scan_archives") else None
+            )
+            self.state = "scanning"
+            self.status = "Resuming scan..." if resume else "Scanning..."
+            self.progress = [0, 0]
+            self.files_found = 0
+            self.roots = roots or []
+            self.duplicates = {}
+            self.file_info = {}
+            self.emit({"type": "started", "roots": self.roots, "resume": resume})
+        threading.Thread(target=engine.run, args=(resume,), daemon=True).start()
+        threading.Thread(target=self.pump, args=(engine, out_queue), daemon=True).start()
+
+    def pump(self, engine, out_queue):
+        last_progress = 0
+        while True:
+            item = out_queue.get()
+            kind = item[0]
+            with self.lock:
+                if kind == "progress":
+                    self.progress = [item[1], item[2]]
+                    now = time.monotonic()
+                    if now - last_progress >= self.PROGRESS_INTERVAL or item[1] == item[2]:
+                        last_progress = now
+                        self.emit({"type": "progress", "done": item[1], "total": item[2]})
+                elif kind == "status":
+                    self.status = item[1]
+                    self.emit({"type": "status", "text": item[1]})
+                elif kind == "done":
+                    self.state = "done"
+                    self.duplicates = engine.duplicates
+                    self.file_info = engine.file_info
+                    self.roots = engine.roots
+                    self.algorithm = engine.algorithm
+                    self.files_found = item[2]
+                    self.status = f"Scan complete. Found {len(self.duplicates)} duplicate groups in {item[2]} files."
+                    self.emit({"type": "done", "groups": len(self.duplicates), "files_found": item[2]})
+                elif kind == "cancelled":
+                    self.state = "cancelled"
+                    self.status = "Scan cancelled. POST /scan with resume to continue it."
+                    self.emit({"type": "cancelled"})
+                elif kind == "error":
+                    self.state = "error"
+                    self.status = f"Scan failed: {item[1]}"
+                    self.emit({"type": "error", "message": item[1]})
+            if kind in self.TERMINAL_MESSAGES:
+                return
+
+    def control_scan(self, action):
+        with self.lock:
+            if self.state not in ("scanning", "paused"):
+                raise RuntimeError("No scan is running.")
+            if action == "cancel":
+                self.control.cancel()
+            elif action == "pause":
+                self.control.pause()
+                self.state = "paused"
+            else:
+                self.control.resume()
+                self.state = "scanning"
+            self.emit({"type": action})
+
+    def wait_events(self, since, timeout):
+        # Returns (events after since, whether more may follow)
+        with self.lock:
+            self.lock.wait_for(lambda: self.next_event - 1 > since or not self.running(), timeout)
+            return [dict(event) for event in self.events if event["id"] > since], self.running()
+
+    # -- Results --
+
+    def groups(self, offset=0, limit=1000, path=None):
+        with self.lock:
+            items = list(self.duplicates.items())
+            if path:
+                items = [(digest, paths) for digest, paths in items if path in paths]
+            page = items[offset:offset + limit]
+            return {
+                "total": len(items),
+                "algorithm": self.algorithm,
+                "roots": self.roots,
+                "groups": [{
+                    "digest": digest_hex(digest),
+                    "files": [{"path": filepath, "size": self.file_info.get(filepath, (None, None))[0],
+                               "mtime": self.file_info.get(filepath, (None, None))[1]} for filepath in paths],
+                } for digest, paths in page],
+            }
+
+    def check_job_paths(self, paths):
+        # Callers hold the lock. Jobs may only touch files of the current
+        # results, and every group must keep at least one copy that no
+        # running job has claimed.
+        if not paths:
+            raise ValueError("No files given.")
+        wanted = set(paths)
+        busy = wanted & self.claimed
+        if busy:
+            raise RuntimeError("Already being handled by another job: " + ", ".join(sorted(busy)[:5]))
+        found = set()
+        for files in self.duplicates.values():
+            hits = wanted.intersection(files)
+            if not hits:
+                continue
+            found |= hits
+            if all(filepath in wanted or filepath in self.claimed for filepath in files):
+                raise ValueError("This would remove every copy of a group: " + ", ".join(sorted(hits)[:5]))
+        unknown = wanted - found
+        if unknown:
+            raise ValueError("Not in the scan results: " + ", ".join(sorted(unknown)[:5]))
+
+    def submit_job(self, kind, paths, target=None, recycle=True):
+        # Jobs bypass the GUI's undo backups and history, which the GUI owns
+        # and rewrites as a whole; each job says how it can be undone instead
+        if not isinstance(paths, list) or not all(isinstance(filepath, str) for filepath in paths):
+            raise ValueError("paths must be a list of file paths.")
+        if not isinstance(recycle, bool):
+            raise ValueError("recycle must be true or false.")
+        if kind == "move" and not (isinstance(target, str) and os.path.isdir(target)):
+            raise ValueError("The target folder does not exist.")
+        if kind == "move":
+            undo = "Not in the app's undo history; move the files back from the target folder to undo."
+        elif recycle and SEND2TRASH_AVAILABLE:
+            undo = "Not in the app's undo history; restore the files from the recycle bin to undo."
+        else:
+            recycle = False
+            undo = "Not in the app's undo history and no backup is kept; the files are deleted permanently."
+        paths = list(dict.fromkeys(paths))
+        job = {"id": uuid.uuid4().hex[:12], "kind": kind, "state": "running", "total": len(paths),
+               "done": [], "failed": [], "undo": undo}
+        with self.lock:
+            if self.state in ("scanning", "paused"):
+                raise RuntimeError("A scan is running.")
+            self.check_job_paths(paths)
+            self.claimed.update(paths)
+            self.jobs[job["id"]] = job
+        threading.Thread(target=self.run_job, args=(job, paths, target, recycle), daemon=True).start()
+        return job["id"]
+
+    def run_job(self, job, paths, target, recycle):
+        # Deletes go to the recycle bin when send2trash is available
+        planner = MovePlanner(target) if job["kind"] == "move" else None
+        for filepath in paths:
+            try:
+                if split_archive_path(filepath)[0]:
+                    raise ValueError("File is inside an archive.")
+                if planner:
+                    target_path = planner.reserve(os.path.basename(filepath))
+                    try:
+                        move_no_replace(filepath, target_path)
+                    except OSError as e:
+                        if e.errno != errno.EXDEV:
+                            raise
+                        copy_file_exclusive(filepath, target_path)
+                        os.remove(filepath)
+                elif recycle and SEND2TRASH_AVAILABLE:
+                    send_to_trash(filepath)
+                else:
+                    os.remove(filepath)
+                with self.lock:
+                    job["done"].append(filepath)
+            except Exception as e:
+                with self.lock:
+                    job["failed"].append([filepath, str(e)])
+        with self.lock:
+            self.forget_paths(job["done"])
+            self.claimed.difference_update(paths)
+            job["state"] = "done"
+            self.emit({"type": "job", "job": job["id"], "state": "done"})
+
+    def forget_paths(self, paths):
+        gone = set(paths)
+        for digest in list(self.duplicates):
+            files = [filepath for filepath in self.duplicates[digest] if filepath not in gone]
+            if len(files) < 2:
+                del self.duplicates[digest]
+            else:
+                self.duplicates[digest] = files
+        for filepath in gone:
+            self.file_info.pop(filepath, None)
+
+    def job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job else None
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    # JSON API; /events streams newline-delimited JSON until the daemon goes idle
+    server_version = "OwNaG3sDuplicateFinder"
+    KEEPALIVE_SECONDS = 15
+
+    def log_message(self, fmt, *args):
+        print(f"daemon: {fmt % args}")
+
+    def authorized(self):
+        # Every request needs the token from the daemon's token file. Browsers
+        # are shut out twice over: they always send Origin on cross-site
+        # requests, and a rebound DNS name shows up as a foreign Host.
+        allowed_hosts = self.server.allowed_hosts
+        if self.headers.get("Origin") is not None:
+            self.send_json(403, {"error": "Cross-origin requests are not allowed."})
+        elif allowed_hosts is not None and (self.headers.get("Host") or "").lower() not in allowed_hosts:
+            self.send_json(403, {"error": "Unexpected Host header."})
+        elif not hmac.compare_digest((self.headers.get("Authorization") or "").encode("utf-8"),
+                                     ("Bearer " + self.server.token).encode("utf-8")):
+            self.send_json(401, {"error": f"Missing or wrong token; it is in the daemon's {DAEMON_TOKEN_FILE} file."})
+        else:
+            return True
+        return False
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        if self.headers.get_content_type() != "application/json":
+            raise ValueError("Request bodies must be application/json.")
+        body = json.loads(self.rfile.read(length))
+        if not isinstance(body, dict):
+            raise ValueError("Request bodies must be JSON objects.")
+        return body
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        daemon = self.server.scan_daemon
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            if url.path == "/status":
+                self.send_json(200, daemon.snapshot())
+            elif url.path == "/groups":
+                self.send_json(200, daemon.groups(int(query.get("offset", 0)), int(query.get("limit", 1000)),
+                                                  query.get("path")))
+            elif url.path == "/events":
+                self.stream_events(daemon, int(query.get("since", 0)))
+            elif url.path.startswith("/jobs/"):
+                job = daemon.job(url.path[len("/jobs/"):])
+                if job:
+                    self.send_json(200, job)
+                else:
+                    self.send_json(404, {"error": "Unknown job."})
+            else:
+                self.send_json(404, {"error": "Not found."})
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        daemon = self.server.scan_daemon
+        path = urllib.parse.urlsplit(self.path).path
+        try:
+            body = self.read_json()
+            if path == "/scan":
+                daemon.start_scan(body.get("roots"), body.get("resume", False), body.get("hash_size"))
+                self.send_json(202, daemon.snapshot())
+            elif path in ("/cancel", "/pause", "/resume"):
+                daemon.control_scan(path[1:])
+                self.send_json(200, daemon.snapshot())
+            elif path in ("/delete", "/move"):
+                job_id = daemon.submit_job(path[1:], body.get("paths", []), body.get("target"), body.get("recycle", True))
+                self.send_json(202, {"job": job_id, "undo": daemon.job(job_id)["undo"]})
+            else:
+                self.send_json(404, {"error": "Not found."})
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+        except RuntimeError as e:
+            self.send_json(409, {"error": str(e)})
+
+    def stream_events(self, daemon, since):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            while True:
+                events, active = daemon.wait_events(since, self.KEEPALIVE_SECONDS)
+                for event in events:
+                    self.wfile.write(json.dumps(event).encode("utf-8") + b"\n")
+                    since = event["id"]
+                if not events:
+                    if not active:
+                        break
+                    self.wfile.write(b"\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # Unix socket peers have no address; the request handler expects one
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+
+def run_daemon(address, settings_path, token_path=DAEMON_TOKEN_FILE):
+    kind, target = parse_daemon_address(address)
+    if kind == "unix":
+        if os.path.exists(target) and stat.S_ISSOCK(os.stat(target).st_mode):
+            os.remove(target)
+        old_umask = os.umask(0o177)
+        try:
+            server = UnixHTTPServer(target, DaemonRequestHandler)
+        finally:
+            os.umask(old_umask)
+        server.allowed_hosts = None
+    else:
+        server = ThreadingHTTPServer(target, DaemonRequestHandler)
+        host, port = target
+        server.allowed_hosts = {f"{name}:{port}" for name in ("127.0.0.1", "localhost", "[::1]", host.lower())}
+    server.token = write_daemon_token(token_path)
+    server.scan_daemon = daemon = ScanDaemon(settings_path)
+    print(f"Scan daemon listening on {address}; clients authenticate with the token in {os.path.abspath(token_path)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if daemon.control:
+            daemon.control.cancel()
+        server.server_close()
+        if kind == "unix" and os.path.exists(target):
+            os.remove(target)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DaemonClient:
+    # Thin client for the scan daemon, used by the GUI and by scripts
+    PAGE_SIZE = 1000
+
+    def __init__(self, address=DAEMON_DEFAULT_ADDRESS, timeout=30, token_path=DAEMON_TOKEN_FILE):
+        self.kind, self.target = parse_daemon_address(address)
+        self.timeout = timeout
+        self.token_path = token_path
+
+    def headers(self, json_body=False):
+        # Read per request so a restarted daemon's new token is picked up
+        headers = {"Authorization": f"Bearer {read_daemon_token(self.token_path) or ''}"}
+        if json_body:
+            headers["Content-Type"] = "application/json"
+        return headers
+
+    def connection(self, timeout):
+        if self.kind == "unix":
+            return UnixHTTPConnection(self.target, timeout)
+        return http.client.HTTPConnection(*self.target, timeout=timeout)
+
+    def request(self, method, path, body=None):
+        conn = self.connection(self.timeout)
+        try:
+            data = json.dumps(body).encode("utf-8") if body is not None else None
+            conn.request(method, path, body=data, headers=self.headers(data is not None))
+            response = conn.getresponse()
+            result = json.loads(response.read() or b"{}")
+        finally:
+            conn.close()
+        if response.status >= 400:
+            raise RuntimeError(result.get("error", f"Daemon returned HTTP {response.status}"))
+        return result
+
+    def status(self):
+        return self.request("GET", "/status")
+
+    def start_scan(self, roots, hash_size=None):
+        body = {"roots": list(roots)}
+        if hash_size is not None:
+            body["hash_size"] = hash_size
+        return self.request("POST", "/scan", body)
+
+    def resume_scan(self):
+        return self.request("POST", "/scan", {"resume": True})
+
+    def cancel(self):
+        return self.request("POST", "/cancel", {})
+
+    def pause(self):
+        return self.request("POST", "/pause", {})
+
+    def resume(self):
+        return self.request("POST", "/resume", {})
+
+    def groups(self, offset=0, limit=PAGE_SIZE, path=None):
+        query = {"offset": offset, "limit": limit}
+        if path:
+            query["path"] = path
+        return self.request("GET", "/groups?" + urllib.parse.urlencode(query))
+
+    def all_groups(self):
+        result = self.groups()
+        while len(result["groups"]) < result["total"]:
+            page = self.groups(len(result["groups"]))
+            if not page["groups"]:
+                break
+            result["groups"].extend(page["groups"])
+        return result
+
+    def delete(self, paths, recycle=True):
+        return self.request("POST", "/delete", {"paths": list(paths), "recycle": recycle})["job"]
+
+    def move(self, paths, target):
+        return self.request("POST", "/move", {"paths": list(paths), "target": target})["job"]
+
+    def job(self, job_id):
+        return self.request("GET", f"/jobs/{job_id}")
+
+    def events(self, since=0):
+        # Yields events until the daemon has nothing left running
+        conn = self.connection(None)
+        try:
+            conn.request("GET", f"/events?since={since}", headers=self.headers())
+            response = conn.getresponse()
+            if response.status >= 400:
+                result = json.loads(response.read() or b"{}")
+                raise RuntimeError(result.get("error", f"Daemon returned HTTP {response.status}"))
+            for line in response:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        finally:
+            conn.close()
+
+
+# -- Distributed scanning --
+
+# Workers and the coordinator talk through files in a shared exchange folder:
+#   1. each worker walks its local roots and writes NODE.sizes, a histogram
+#   2. the coordinator sums the histograms and writes plan, the sizes that
+#      occur at least twice across all nodes
+#   3. each worker hashes only files with those sizes and writes NODE.manifest
+#   4. the coordinator merges the manifests into a JSON Lines report
+# Every exchange file is MAGIC, a JSON header and a binary payload. Headers
+# carry the run id given to every process of a run, so files left over from
+# another run are ignored rather than trusted by their timestamps.
+EXCHANGE_POLL_SECONDS = 1.0
+SIZES_MAGIC = b"DFSZ0001"
+PLAN_MAGIC = b"DFPL0001"
+MANIFEST_MAGIC = b"DFMF0001"
+MANIFEST_RECORD = struct.Struct("<qd16sI")
+
+
+class ConsoleReporter:
+    # Stands in for the scan queue when an engine runs from the command line
+    PROGRESS_EVERY = 1000
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def put(self, item):
+        if item[0] == "status":
+            print(f"{self.prefix}{item[1]}")
+        elif item[0] == "progress" and (item[1] == item[2] or item[1] % self.PROGRESS_EVERY == 0):
+            print(f"{self.prefix}Hashed {item[1]} / {item[2]} files")
+        elif item[0] == "error":
+            print(f"{self.prefix}Error: {item[1]}")
+
+
+def pack_int64s(values):
+    data = array("q", values)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data.tobytes()
+
+
+def unpack_int64s(raw):
+    data = array("q")
+    data.frombytes(raw)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data
+
+
+def write_exchange_file(path, magic, header, payload):
+    # Written under a temporary name so readers never see a partial file
+    raw_header = json.dumps(header).encode("utf-8")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(magic)
+        f.write(struct.pack("<I", len(raw_header)))
+        f.write(raw_header)
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+
+def read_exchange_file(path, magic, header_only=False):
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f"Unexpected exchange file: {path}")
+        (header_len,) = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+        return header, None if header_only else f.read()
+
+
+def exchange_run(path, magic):
+    # The run id in an exchange file's header, or None if it can't be read yet
+    try:
+        return read_exchange_file(path, magic, header_only=True)[0].get("run")
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def wait_for_exchange(check, timeout, what):
+    deadline = time.monotonic() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Timed out waiting for {what}.")
+        time.sleep(EXCHANGE_POLL_SECONDS)
+
+
+def run_worker(node, roots, exchange_dir, timeout, run_id):
+    prefix = f"[{node}] "
+    sizes_path = os.path.join(exchange_dir, node + ".sizes")
+    manifest_path = os.path.join(exchange_dir, node + ".manifest")
+    plan_path = os.path.join(exchange_dir, "plan")
+    for path in (sizes_path, manifest_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    roots = normalize_roots(roots)
+    engine = ScanEngine(roots, 0, ScanFilter(), ConsoleReporter(prefix), ScanControl(), None)
+    print(f"{prefix}Walking {'; '.join(roots)}...")
+    engine.walk()
+    index = engine.index
+    histogram = []
+    for size, group in index.size_groups.items():
+        histogram.extend((size, 1 if isinstance(group, int) else len(group)))
+    write_exchange_file(sizes_path, SIZES_MAGIC, {"run": run_id, "node": node, "files": len(index)},
+                        pack_int64s(histogram))
+    print(f"{prefix}Wrote size histogram of {len(index)} files.")
+
+    def fresh_plan():
+        if exchange_run(plan_path, PLAN_MAGIC) != run_id:
+            return None
+        header, payload = read_exchange_file(plan_path, PLAN_MAGIC)
+        return (header, payload) if header.get("run") == run_id and node in header["nodes"] else None
+
+    header, payload = wait_for_exchange(fresh_plan, timeout, "the coordinator's plan")
+    engine.hash_size = header["hash_size"]
+    colliding = set(unpack_int64s(payload))
+    file_ids = [file_id for size, group in index.size_groups.items() if size in colliding
+                for file_id in ((group,) if isinstance(group, int) else group)]
+    print(f"{prefix}Hashing {len(file_ids)} of {len(index)} files with colliding sizes...")
+    engine.hash_file_ids(file_ids)
+
+    records = bytearray()
+    count = 0
+    for file_id, digest in engine.hashed.items():
+        if digest:
+            raw = os.fsencode(index.path(file_id))
+            records += MANIFEST_RECORD.pack(index.sizes[file_id], index.mtimes[file_id], digest, len(raw))
+            records += raw
+            count += 1
+    write_exchange_file(manifest_path, MANIFEST_MAGIC,
+                        {"run": run_id, "node": node, "roots": roots, "algorithm": engine.algorithm, "files": count},
+                        bytes(records))
+    print(f"{prefix}Wrote manifest of {count} files.")
+
+
+def run_coordinator(exchange_dir, node_count, output_path, hash_size, timeout, run_id):
+    plan_path = os.path.join(exchange_dir, "plan")
+    if exchange_run(plan_path, PLAN_MAGIC) != run_id and os.path.exists(plan_path):
+        os.remove(plan_path)
+
+    # Histograms from other runs are ignored until their workers overwrite them
+    def histograms():
+        paths = [os.path.join(exchange_dir, name) for name in os.listdir(exchange_dir) if name.endswith(".sizes")]
+        paths = [path for path in paths if exchange_run(path, SIZES_MAGIC) == run_id]
+        return paths if len(paths) >= node_count else None
+
+    totals = {}
+    nodes = []
+    for path in wait_for_exchange(histograms, timeout, f"{node_count} size histograms"):
+        header, payload = read_exchange_file(path, SIZES_MAGIC)
+        nodes.append(header["node"])
+        pairs = unpack_int64s(payload)
+        for size, count in zip(pairs[::2], pairs[1::2]):
+            totals[size] = totals.get(size, 0) + count
+    colliding = sorted(size for size, count in totals.items() if count > 1)
+    write_exchange_file(plan_path, PLAN_MAGIC, {"run": run_id, "nodes": nodes, "hash_size": hash_size},
+                        pack_int64s(colliding))
+    print(f"Plan: {len(colliding)} of {len(totals)} distinct sizes occur on more than one file across {len(nodes)} nodes.")
+
+    def manifests():
+        paths = [os.path.join(exchange_dir, node + ".manifest") for node in nodes]
+        return paths if all(exchange_run(path, MANIFEST_MAGIC) == run_id for path in paths) else None
+
+    groups = {}
+    roots = {}
+    algorithm = ""
+    for path in wait_for_exchange(manifests, timeout, "worker manifests"):
+        header, payload = read_exchange_file(path, MANIFEST_MAGIC)
+        node = header["node"]
+        roots[node] = header["roots"]
+        algorithm = header["algorithm"]
+        pos = 0
+        while pos < len(payload):
+            size, mtime, digest, length = MANIFEST_RECORD.unpack_from(payload, pos)
+            pos += MANIFEST_RECORD.size
+            groups.setdefault((size, digest), []).append((node, os.fsdecode(payload[pos:pos + length]), mtime))
+            pos += length
+
+    # Same columns as the JSON Lines export, plus the node, so the report can be imported
+    group_num = 0
+    cross_node = 0
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    with open_export_stream(output_path) as f:
+        for (size, digest), files in groups.items():
+            if len(files) < 2:
+                continue
+            group_num += 1
+            if len({node for node, _, _ in files}) > 1:
+                cross_node += 1
+            for node, filepath, mtime in files:
+                f.write(encoder.encode({
+                    "group": group_num, "path": filepath, "size": size, "mtime": mtime, "digest": digest.hex(),
+                    "algorithm": algorithm, "root": root_of(filepath, roots[node]), "node": node
+                }))
+                f.write("\n")
+    print(f"Found {group_num} duplicate groups, {cross_node} of them across nodes. Report written to {output_path}")
 
 
 class DuplicateFinderApp:
     SETTINGS_FILE = "settings.json"
     DELETE_HISTORY_MAX = 999999999
     DELETE_AUTO_CLEAN_DAYS_DEFAULT = 5
+    BACKUP_GC_DELAY_MS = 60 * 1000
+    BACKUP_GC_INTERVAL_MS = 60 * 60 * 1000
     DEFAULT_AUTO_SELECT_MODE = "newest"
+    UNDO_PAGE_SIZE = 200
+    MOVE_COPY_WORKERS = 4
+    UNDO_TARGET_KEYS = {"Delete": "backup", "Move": "moved_to", "Link": "linked_to"}
+    EXPORT_CSV_HEADER = ["Group", "File Path", "Size", "Modified", "Digest", "Algorithm", "Root"]
+    IMPORT_BATCH_SIZE = 2000
+    IMPORT_STAT_WORKERS = 8
+    TASK_ITEMS_PER_TICK = 20
+    SCAN_SESSION_FILE = "scan_session.json"
+    UNAVAILABLE_ROOT = "not on this machine"
+    ARCHIVE_CACHE_FILE = "archive_cache.json"
 
     def __init__(self, root):
         self.root = root
@@ -71,20 +3599,48 @@ class DuplicateFinderApp:
 
         self.auto_cleanup_enabled = tk.BooleanVar(value=True)
         self.auto_cleanup_days = tk.IntVar(value=7)
+        self.undo_backup_quota_mb = tk.IntVar(value=2048)
+        self.backup_lock = threading.Lock()
+        self.backup_gc_thread = None
+        self.backup_gc_manual = False
 
         self.scanning_thread = None
-        self.scan_stop_event = threading.Event()
-        self.scan_pause_event = threading.Event()  
+        self.scan_engine = None
+        self.scan_roots = []
+        self.empty_dir_candidates = set()
+        self.scan_control = ScanControl()
 
         self.duplicates = {}
+        self.file_info = {}
+        self.duplicate_folders = {}
+        self.folder_info = {}
+        self.similarity = {}
+        self.reference_paths = set()
+        self.unavailable_paths = set()
+        self.scan_hash_algorithm = ""
+        self.import_generation = 0
+        self.import_group_numbers = {}
+        self.tree_group_numbers = {}
+        self.next_tree_group = 1
+        self.watch_enabled = tk.BooleanVar(value=False)
+        self.watch_control = None
+        self.overlap_control = None
         self.selected_files = set()
         self.delete_history = []  
         self.delete_to_recycle = tk.BooleanVar(value=True)
         self.hash_size = tk.IntVar(value=8 * 1024 * 1024)
+        self.spill_grouping = tk.BooleanVar(value=False)
+        self.seek_order = tk.BooleanVar(value=True)
+        self.background_scan = tk.BooleanVar(value=False)
+        self.detect_folders = tk.BooleanVar(value=True)
+        self.image_mode = tk.BooleanVar(value=False)
+        self.scan_archives = tk.BooleanVar(value=False)
         self.hash_dict = {}
         self.tree_items = {}
         self.scan_queue = queue.Queue()
+        self.task_queue = queue.Queue()
         self.move_history = []
+        self.link_history = []
         self.total_files_to_scan = 0
         self.files_scanned = 0
 
@@ -108,24 +3664,14 @@ class DuplicateFinderApp:
         self.filepath_sort_descending = False
         self.group_sort_descending = False
 
-        if PYGAME_AVAILABLE:
-            pygame.mixer.init()
-            pygame.mixer.music.set_volume(self.volume_level.get())
-
-        if THEMES_AVAILABLE:
-            self.style = ThemedStyle(self.root)
-            available = list(self.style.theme_names())
-            if "equilux" in available:
-                default_theme = "equilux"
-            else:
-                default_theme = self.style.theme_use()
-            self.available_themes = sorted(available)
-            self.theme_var = tk.StringVar(value=default_theme)
-            self.style.set_theme(self.theme_var.get())
-        else:
-            self.style = ttk.Style(self.root)
-            self.available_themes = sorted(self.style.theme_names())
-            self.theme_var = tk.StringVar(value=self.style.theme_use())
+        # Opened with the first song, see music_mixer
+        self.mixer = None
+
+        # ttkthemes is loaded when one of its themes is applied or the Themes
+        # menu is opened; until then the built-in ttk style is used
+        self.style = ttk.Style(self.root)
+        self.themed_style = None
+        self.theme_var = tk.StringVar(value="equilux" if THEMES_AVAILABLE else self.style.theme_use())
 
         self.checkbox_vars = {}
         self.tree_items = {}
@@ -147,13 +3693,22 @@ class DuplicateFinderApp:
         self.settings.setdefault("filter_extensions", "")
         self.settings.setdefault("filter_excluded_folders", [])
         self.settings.setdefault("default_auto_select_mode", self.DEFAULT_AUTO_SELECT_MODE)
+        self.settings.setdefault("link_mode", "auto")
+        self.settings.setdefault("device_concurrency", {})
+        self.settings.setdefault("background_mb_per_sec", 20)
+        self.settings.setdefault("background_files_per_sec", 200)
+        self.settings.setdefault("background_lower_priority", True)
+        self.settings.setdefault("image_threshold", 10)
+        self.settings.setdefault("daemon_address", DAEMON_DEFAULT_ADDRESS)
 
         # Undo backup folder: fallback to default if not set in settings
         self.undo_backup_folder = self.settings.get(
             "undo_backup_folder", os.path.join(os.getcwd(), "undo_backups")
         )
 
-        self.load_delete_history_and_cleanup()
+        self.start_history_load()
+        # Applied once the window has been drawn
+        self.root.after_idle(self.apply_startup_theme)
 
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         self.root.after(100, self.process_scan_results)
@@ -165,18 +3720,26 @@ class DuplicateFinderApp:
 
         file_menu = tk.Menu(menubar, tearoff=0)
         file_menu.add_command(label="Select Folder", command=self.select_folder)
+        file_menu.add_command(label="Resume Last Scan", command=self.resume_last_scan)
+        file_menu.add_checkbutton(label="Watch for Changes", variable=self.watch_enabled, command=self.toggle_watch_mode)
+        file_menu.add_command(label="Analyze Partial Overlap...", command=self.start_overlap_analysis)
+        file_menu.add_command(label="Build Reference Index...", command=self.build_reference_index)
+        file_menu.add_command(label="Compare Against Reference...", command=self.compare_against_reference)
+        file_menu.add_command(label="Load Results from Daemon", command=self.load_daemon_results)
         file_menu.add_command(label="Undo Move/Delete", command=self.show_undo_dialog)
+        file_menu.add_command(label="Clean Up Undo Backups", command=lambda: self.start_backup_gc(manual=True))
         file_menu.add_separator()
 
         # Export submenu
         export_menu = tk.Menu(file_menu, tearoff=0)
         export_menu.add_command(label="Export as CSV", command=self.export_scan_csv)
-        export_menu.add_command(label="Export as JSON", command=self.export_scan_json)
+        export_menu.add_command(label="Export as JSON Lines", command=self.export_scan_jsonl)
         file_menu.add_cascade(label="Export Scan", menu=export_menu)
 
         # Import submenu
         import_menu = tk.Menu(file_menu, tearoff=0)
         import_menu.add_command(label="Import from CSV", command=self.import_scan_csv)
+        import_menu.add_command(label="Import from JSON Lines", command=self.import_scan_jsonl)
         import_menu.add_command(label="Import from JSON", command=self.import_scan_json)
         file_menu.add_cascade(label="Import Scan", menu=import_menu)
 
@@ -191,14 +3754,27 @@ class DuplicateFinderApp:
         settings_menu.add_cascade(label="Hash Read Size", menu=hash_menu)
         settings_menu.add_checkbutton(label="Delete to Recycle Bin", variable=self.delete_to_recycle,
                                       command=self.sync_delete_recycle_checkbox)
+        settings_menu.add_checkbutton(label="Low-Memory Grouping (spill to disk)", variable=self.spill_grouping,
+                                      command=self.save_settings)
+        settings_menu.add_checkbutton(label="Seek-Minimizing Read Order (HDD)", variable=self.seek_order,
+                                      command=self.save_settings)
+        settings_menu.add_checkbutton(label="Background Priority Scan", variable=self.background_scan,
+                                      command=self.save_settings)
+        settings_menu.add_command(label="Background Scan Limits...", command=self.set_background_limits)
+        settings_menu.add_checkbutton(label="Detect Duplicate Folders", variable=self.detect_folders,
+                                      command=self.save_settings)
+        settings_menu.add_checkbutton(label="Similar Images Mode", variable=self.image_mode,
+                                      command=self.save_settings)
+        settings_menu.add_command(label="Image Similarity Threshold...", command=self.set_image_threshold)
+        settings_menu.add_checkbutton(label="Look Inside Archives (zip/tar)", variable=self.scan_archives,
+                                      command=self.save_settings)
         menubar.add_cascade(label="Settings", menu=settings_menu)
         settings_menu.add_command(label="Preferences", command=self.show_preferences_dialog)
         settings_menu.add_command(label="Move Duplicates to Folder", command=self.move_selected_files)
+        settings_menu.add_command(label="Replace Duplicates with Links", command=self.link_selected_files)
 
-        theme_menu = tk.Menu(menubar, tearoff=0)
-        for theme in self.available_themes:
-            theme_menu.add_radiobutton(label=theme.title(), variable=self.theme_var, value=theme, command=self.change_theme)
-        menubar.add_cascade(label="Themes", menu=theme_menu)
+        self.theme_menu = tk.Menu(menubar, tearoff=0, postcommand=self.fill_theme_menu)
+        menubar.add_cascade(label="Themes", menu=self.theme_menu)
 
         filters_menu = tk.Menu(menubar, tearoff=0)
         filters_menu.add_command(label="Set Advanced Filters...", command=self.show_filter_dialog)
@@ -225,6 +3801,33 @@ class DuplicateFinderApp:
     def on_hash_size_change(self):
         self.save_settings()
 
+    def set_background_limits(self):
+        mb_per_sec = simpledialog.askfloat(
+            "Background Scan Limits", "Maximum read rate in MB/s (0 = unlimited):",
+            initialvalue=self.settings.get("background_mb_per_sec", 20), minvalue=0, parent=self.root
+        )
+        if mb_per_sec is None:
+            return
+        files_per_sec = simpledialog.askfloat(
+            "Background Scan Limits", "Maximum files hashed per second (0 = unlimited):",
+            initialvalue=self.settings.get("background_files_per_sec", 200), minvalue=0, parent=self.root
+        )
+        if files_per_sec is None:
+            return
+        self.settings["background_mb_per_sec"] = mb_per_sec
+        self.settings["background_files_per_sec"] = files_per_sec
+        self.background_scan.set(True)
+        self.save_settings()
+
+    def set_image_threshold(self):
+        threshold = simpledialog.askinteger(
+            "Image Similarity Threshold", "Maximum differing hash bits (0-32; lower is stricter):",
+            initialvalue=self.settings.get("image_threshold", 10), minvalue=0, maxvalue=32, parent=self.root
+        )
+        if threshold is not None:
+            self.settings["image_threshold"] = threshold
+            self.save_settings()
+
     def sync_delete_recycle_checkbox(self):
         val = self.delete_to_recycle.get()
         self.delete_to_recycle.set(val)
@@ -241,6 +3844,9 @@ class DuplicateFinderApp:
         browse_btn = ttk.Button(top_frame, text="Browse...", command=self.select_folder)
         browse_btn.pack(side=tk.LEFT, padx=5)
 
+        add_folder_btn = ttk.Button(top_frame, text="Add Folder...", command=self.add_scan_folder)
+        add_folder_btn.pack(side=tk.LEFT)
+
         self.select_dupes_var = tk.BooleanVar()
         select_dupes_chk = ttk.Checkbutton(
             top_frame, text="Select all duplicates except one", variable=self.select_dupes_var,
@@ -270,7 +3876,7 @@ class DuplicateFinderApp:
         tree_frame = ttk.Frame(self.root)
         tree_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
 
-        columns = ("Select", "File Path", "Size", "Group")
+        columns = ("Select", "File Path", "Size", "Group", "Root", "Similarity")
         self.tree = ttk.Treeview(tree_frame, columns=columns, show="headings", selectmode="extended")
         vsb = ttk.Scrollbar(tree_frame, orient="vertical", command=self.tree.yview)
         self.tree.configure(yscrollcommand=vsb.set)
@@ -304,6 +3910,12 @@ class DuplicateFinderApp:
         self.tree.heading("Group", text="Group", anchor=tk.CENTER, command=self.sort_by_group)
         self.tree.column("Group", width=20, anchor=tk.CENTER)
 
+        self.tree.heading("Root", text="Root", anchor=tk.CENTER)
+        self.tree.column("Root", width=120, anchor=tk.W)
+
+        self.tree.heading("Similarity", text="Similarity", anchor=tk.CENTER)
+        self.tree.column("Similarity", width=70, anchor=tk.CENTER)
+
         self.tree.bind("<Button-1>", self.handle_click)
         self.tree.bind("<ButtonRelease-1>", self.handle_drag_release)
         self.tree.bind("<B1-Motion>", self.handle_drag_motion)
@@ -326,6 +3938,9 @@ class DuplicateFinderApp:
         move_btn = ttk.Button(btn_frame, text="Move Duplicates", command=self.move_selected_files)
         move_btn.pack(side=tk.LEFT, padx=5)
 
+        link_btn = ttk.Button(btn_frame, text="Link Duplicates", command=self.link_selected_files)
+        link_btn.pack(side=tk.LEFT, padx=5)
+
         undo_history_btn = ttk.Button(btn_frame, text="Undo Move/Delete", command=self.show_undo_dialog)
         undo_history_btn.pack(side=tk.LEFT, padx=5)
 
@@ -367,7 +3982,7 @@ class DuplicateFinderApp:
     def show_preferences_dialog(self):
         pref_win = tk.Toplevel(self.root)
         pref_win.title("Preferences")
-        pref_win.geometry("400x200")
+        pref_win.geometry("400x280")
         pref_win.resizable(True, True)  
 
         frame = ttk.Frame(pref_win, padding=10)
@@ -391,6 +4006,13 @@ class DuplicateFinderApp:
         )
         days_spin.grid(row=2, column=0, sticky="w", pady=5)
 
+        ttk.Label(frame, text="Undo backup space limit in MB (0 = no limit):").grid(row=3, column=0, sticky="w", pady=(10, 0))
+
+        quota_spin = ttk.Spinbox(
+            frame, from_=0, to=1024 * 1024, increment=256, textvariable=self.undo_backup_quota_mb, width=8
+        )
+        quota_spin.grid(row=4, column=0, sticky="w", pady=5)
+
         def choose_folder():
             path = filedialog.askdirectory(title="Select Undo Backup Folder")
             if path:
@@ -403,7 +4025,7 @@ class DuplicateFinderApp:
 
         # Button Frame
         button_frame = ttk.Frame(frame)
-        button_frame.grid(row=3, column=0, pady=(15, 0), sticky="e")
+        button_frame.grid(row=5, column=0, pady=(15, 0), sticky="e")
 
         ttk.Button(
             button_frame,
@@ -478,13 +4100,18 @@ class DuplicateFinderApp:
         file_info_cache = {}
 
         for row_id in self.tree.get_children():
-            vals = self.tree.item(row_id)["values"]
-            file_path = vals[0]
-            group_number = vals[2]
+            file_path = self.tree.set(row_id, "File Path")
+            group_number = self.tree.set(row_id, "Group")
 
             if group_number not in groups:
                 groups[group_number] = []
 
+            if file_path in self.reference_paths:
+                # Groups with a reference copy keep that copy
+                groups[group_number].append(None)
+                continue
+            if file_path in self.unavailable_paths:
+                continue
             if file_path not in file_info_cache:
                 try:
                     file_info_cache[file_path] = os.path.getmtime(file_path)
@@ -498,6 +4125,9 @@ class DuplicateFinderApp:
         for group, entries in groups.items():
             if len(entries) <= 1:
                 continue
+            if None in entries:
+                to_select.extend(entry[0] for entry in entries if entry)
+                continue
 
             if mode == "newest":
                 entries.sort(key=lambda tup: (-file_info_cache[tup[1]], len(tup[1])))
@@ -533,6 +4163,13 @@ class DuplicateFinderApp:
             self.folder_path_var.set(folder)
             self.start_scan()
 
+    def add_scan_folder(self):
+        folder = filedialog.askdirectory(title="Add Folder to Scan", initialdir=self.last_scan_folder)
+        if folder:
+            self.last_scan_folder = folder
+            current = self.folder_path_var.get().strip()
+            self.folder_path_var.set(f"{current}; {folder}" if current else folder)
+
     # -- Music Player Logic --
 
     def choose_song(self):
@@ -550,20 +4187,34 @@ class DuplicateFinderApp:
                 self.music_index = 0
             self.play_music()
 
+    def music_mixer(self):
+        # pygame is imported and its mixer opened for the first song
+        if self.mixer is None:
+            try:
+                import pygame
+                pygame.mixer.init()
+                pygame.mixer.music.set_volume(self.volume_level.get())
+                self.mixer = pygame.mixer
+            except Exception as e:
+                messagebox.showerror("Music Unavailable", f"Failed to start the music player:\n{e}")
+        return self.mixer
+
     def play_music(self):
         if not self.music_files:
             messagebox.showinfo("No Music", "No music loaded. Please choose a song first.")
             return
+        if not self.music_mixer():
+            return
         if self.is_paused:
-            pygame.mixer.music.unpause()
+            self.mixer.music.unpause()
             self.is_paused = False
             self.is_stopped = False
             self.pause_btn.config(text="Pause")
             self.update_current_song_label()
             return
         try:
-            pygame.mixer.music.load(self.music_files[self.music_index])
-            pygame.mixer.music.play()
+            self.mixer.music.load(self.music_files[self.music_index])
+            self.mixer.music.play()
             self.is_paused = False
             self.is_stopped = False
             self.pause_btn.config(text="Pause")
@@ -576,19 +4227,19 @@ class DuplicateFinderApp:
             self.play_music()
             return
         if self.is_paused:
-            pygame.mixer.music.unpause()
+            self.mixer.music.unpause()
             self.is_paused = False
             self.pause_btn.config(text="Pause")
             self.status_label.config(text="Music resumed.")
         else:
-            pygame.mixer.music.pause()
+            self.mixer.music.pause()
             self.is_paused = True
             self.pause_btn.config(text="Resume")
             self.status_label.config(text="Music paused.")
 
     def stop_music(self):
-        if PYGAME_AVAILABLE:
-            pygame.mixer.music.stop()
+        if self.mixer:
+            self.mixer.music.stop()
             self.is_paused = False
             self.is_stopped = True
             self.pause_btn.config(text="Pause")
@@ -605,8 +4256,8 @@ class DuplicateFinderApp:
         self.play_music()
 
     def check_music_end(self):
-        if PYGAME_AVAILABLE and not self.is_stopped and not self.is_paused:
-            if not pygame.mixer.music.get_busy():
+        if self.mixer and not self.is_stopped and not self.is_paused:
+            if not self.mixer.music.get_busy():
                 if self.repeat_current.get():
                     self.play_music()
                 else:
@@ -615,8 +4266,8 @@ class DuplicateFinderApp:
 
     def change_volume(self, _event=None):
         vol = self.volume_level.get()
-        if PYGAME_AVAILABLE:
-            pygame.mixer.music.set_volume(vol)
+        if self.mixer:
+            self.mixer.music.set_volume(vol)
 
     def update_current_song_label(self):
         if self.music_files:
@@ -627,96 +4278,138 @@ class DuplicateFinderApp:
 
     # -- Scanning Logic --
 
+    def get_scan_folders(self):
+        # Several folders can be scanned together, separated by ";"
+        folders = [f.strip() for f in self.folder_path_var.get().split(";") if f.strip()]
+        invalid = [f for f in folders if not os.path.isdir(f)]
+        if not folders or invalid:
+            detail = "\n".join(invalid)
+            messagebox.showwarning("Invalid Folder", f"Please select a valid folder to scan.\n{detail}".strip())
+            return None
+        return folders
+
     def start_scan(self):
-        folder = self.folder_path_var.get()
-        if not folder or not os.path.isdir(folder):
-            messagebox.showwarning("Invalid Folder", "Please select a valid folder to scan.")
+        folders = self.get_scan_folders()
+        if not folders:
+            return
+        if self.image_mode.get() and not (PIL_AVAILABLE and NUMPY_AVAILABLE):
+            messagebox.showerror("Similar Images Mode", "Similar images mode needs Pillow and numpy:\npip install pillow numpy")
+            return
+        roots = normalize_roots(folders)
+        self.last_scan_folder = roots[0]
+        if not self.launch_scan(self.create_scan_engine(roots)):
             return
+        skipped = len(folders) - len(roots)
+        if skipped:
+            self.status_label.config(text=f"Scanning... Skipped {skipped} duplicate or nested folder(s).")
+
+    def build_reference_index(self):
+        # Indexes the folders in the folder field once, so later drops can be
+        # checked against them without rescanning
+        folders = self.get_scan_folders()
+        if not folders:
+            return
+        path = filedialog.asksaveasfilename(title="Save Reference Index", defaultextension=".dfref",
+                                            filetypes=[("Reference index", "*.dfref"), ("All Files", "*.*")],
+                                            initialdir=self.last_export_folder)
+        if not path:
+            return
+        self.last_export_folder = os.path.dirname(path)
+        engine = ReferenceBuildEngine(
+            normalize_roots(folders), self.hash_size.get(), ScanFilter.from_settings(self.settings),
+            self.scan_queue, self.scan_control, path,
+            scheduler=DeviceScheduler(self.settings.get("device_concurrency"), self.seek_order.get()),
+            throttle=ScanThrottle.from_settings(self.settings) if self.background_scan.get() else None
+        )
+        if self.launch_scan(engine):
+            self.status_label.config(text="Building reference index...")
 
+    def compare_against_reference(self):
+        # Lists the files in the folder field that already exist in the reference
+        folders = self.get_scan_folders()
+        if not folders:
+            return
+        path = filedialog.askopenfilename(title="Open Reference Index",
+                                          filetypes=[("Reference index", "*.dfref"), ("All Files", "*.*")],
+                                          initialdir=self.last_export_folder)
+        if not path:
+            return
+        try:
+            reference = ReferenceIndex(path)
+        except Exception as e:
+            messagebox.showerror("Reference Index", f"Failed to open reference index:\n{path}\n{e}")
+            return
+        self.last_export_folder = os.path.dirname(path)
+        engine = ReferenceCompareEngine(
+            normalize_roots(folders), ScanFilter.from_settings(self.settings), self.scan_queue, self.scan_control,
+            reference,
+            scheduler=DeviceScheduler(self.settings.get("device_concurrency"), self.seek_order.get()),
+            throttle=ScanThrottle.from_settings(self.settings) if self.background_scan.get() else None
+        )
+        if self.launch_scan(engine):
+            self.status_label.config(text=f"Comparing against reference of {reference.count} files...")
+
+    def resume_last_scan(self):
+        if not os.path.exists(self.SCAN_SESSION_FILE):
+            messagebox.showinfo("Resume Scan", "There is no interrupted scan to resume.")
+            return
+        self.launch_scan(self.create_scan_engine(None), resume=True)
+
+    def create_scan_engine(self, roots):
+        if self.image_mode.get() and roots is not None:
+            return ImageScanEngine(roots, ScanFilter.from_settings(self.settings), self.scan_queue, self.scan_control,
+                                   threshold=self.settings.get("image_threshold", 10))
+        return ScanEngine(
+            roots, self.hash_size.get(), ScanFilter.from_settings(self.settings), self.scan_queue,
+            self.scan_control, self.SCAN_SESSION_FILE,
+            spill_dir=self.SCAN_SESSION_FILE + ".runs" if self.spill_grouping.get() else None,
+            scheduler=DeviceScheduler(self.settings.get("device_concurrency"), self.seek_order.get()),
+            throttle=ScanThrottle.from_settings(self.settings) if self.background_scan.get() else None,
+            find_folders=self.detect_folders.get(),
+            archive_cache=ArchiveCache(self.ARCHIVE_CACHE_FILE) if self.scan_archives.get() else None
+        )
+
+    def launch_scan(self, engine, resume=False):
+        # The engine was built with the current control and queue, so swap in
+        # fresh ones only after any running scan (which stops within a chunk)
+        # has ended. Until then it may still checkpoint to the session file or
+        # post its last messages, so a new scan isn't started next to it.
+        self.stop_watch()
         if self.scanning_thread and self.scanning_thread.is_alive():
-            self.scan_stop_event.set()
+            self.scan_control.cancel()
             self.scanning_thread.join(timeout=5)
+            if self.scanning_thread.is_alive():
+                messagebox.showwarning("Scan Still Stopping",
+                                       "The previous scan is still stopping. Try again in a moment.")
+                return False
             self.scanning_thread = None
 
-        self.clear_scan_queue()
-        self.scan_stop_event.clear()
-        self.scan_pause_event.clear()
+        # Anything the old engine posted stays in its own queue
+        self.scan_queue = engine.out_queue = queue.Queue()
+        self.scan_control = engine.control = ScanControl()
 
+        self.import_generation += 1
         self.duplicates = {}
+        self.duplicate_folders = {}
+        self.similarity = {}
+        self.reference_paths = set()
+        self.unavailable_paths = set()
         self.selected_files.clear()
         self.tree.delete(*self.tree.get_children())
         self.tree_items.clear()
         self.files_scanned = 0
         self.total_files_to_scan = 0
         self.progress_var.set(0)
-        self.status_label.config(text="Scanning...")
+        self.status_label.config(text="Resuming scan..." if resume else "Scanning...")
 
         self.pause_scan_btn.config(state=tk.NORMAL, text="Pause Scan")
         self.cancel_scan_btn.config(state=tk.NORMAL)
 
-        self.scanning_thread = threading.Thread(target=self.scan_folder, args=(folder,))
+        self.scan_engine = engine
+        self.scanning_thread = threading.Thread(target=engine.run, args=(resume,))
         self.scanning_thread.daemon = True
         self.scanning_thread.start()
-
-    def scan_folder(self, folder):
-        self.last_scan_folder = folder 
-
-        size_dict = {}
-        total_files_found = 0
-
-        for root_dir, dirs, files in os.walk(folder):
-            if self.scan_stop_event.is_set():
-                self.scan_queue.put(("cancelled", None, total_files_found))
-                print("Scan cancelled during folder walk.")
-                return
-
-            for file in files:
-                if self.scan_stop_event.is_set():
-                    self.scan_queue.put(("cancelled", None, total_files_found))
-                    print("Scan cancelled during file iteration.")
-                    return
-
-                filepath = os.path.join(root_dir, file)
-                if not self.passes_advanced_filters(filepath):
-                    continue
-                total_files_found += 1
-                try:
-                    size = os.path.getsize(filepath)
-                    size_dict.setdefault(size, []).append(filepath)
-                except Exception:
-                    pass
-
-        self.total_files_found = total_files_found
-
-        candidates = [files for files in size_dict.values() if len(files) > 1]
-        files_to_hash = [f for group in candidates for f in group]
-        total_files_hashed = len(files_to_hash)
-
-        self.total_files_hashed = total_files_hashed
-        self.total_files_to_scan = total_files_hashed
-        self.files_scanned = 0
-        self.status_label.config(text=f"Scanning {total_files_hashed} candidate files for duplicates...")
-
-        hashes = {}
-        for filepath in files_to_hash:
-            if self.scan_stop_event.is_set():
-                self.scan_queue.put(("cancelled", None, self.total_files_found))
-                print("Scan cancelled during hashing.")
-                return
-            while self.scan_pause_event.is_set():
-                time.sleep(0.1)
-            try:
-                file_hash = self.hash_file(filepath, self.hash_size.get())
-            except Exception:
-                file_hash = None
-            if file_hash:
-                hashes.setdefault(file_hash, []).append(filepath)
-            self.files_scanned += 1
-            self.scan_queue.put(("progress", self.files_scanned, self.total_files_to_scan))
-
-        self.duplicates = {h: files for h, files in hashes.items() if len(files) > 1}
-        self.scan_queue.put(("done", self.duplicates, self.total_files_found))
-        print("Scan completed normally.")
+        return True
 
     def clear_scan_queue(self):
         try:
@@ -734,126 +4427,408 @@ class DuplicateFinderApp:
                     percent = (scanned / total) * 100 if total else 0
                     self.progress_var.set(percent)
                     self.status_label.config(text=f"Scanning files: {scanned} / {total}")
+                elif item[0] == "status":
+                    self.status_label.config(text=item[1])
+                elif item[0] == "cancelled":
+                    self.clear_scan_queue()
+                    self.progress_var.set(0)
+                    self.pause_scan_btn.config(state=tk.DISABLED)
+                    self.cancel_scan_btn.config(state=tk.DISABLED)
+                    self.status_label.config(text="Scan cancelled. Use File > Resume Last Scan to continue it later.")
+                elif item[0] == "error":
+                    self.pause_scan_btn.config(state=tk.DISABLED)
+                    self.cancel_scan_btn.config(state=tk.DISABLED)
+                    self.status_label.config(text=f"Scan failed: {item[1]}")
+                elif item[0] == "reference_built":
+                    self.progress_var.set(100)
+                    self.pause_scan_btn.config(state=tk.DISABLED)
+                    self.cancel_scan_btn.config(state=tk.DISABLED)
+                    self.status_label.config(text=f"Reference index of {item[2]} files saved to {item[1]}")
                 elif item[0] == "done":
                     duplicates = item[1]
                     total_files_found = item[2] if len(item) > 2 else 0
+                    self.duplicates = duplicates
+                    self.file_info = self.scan_engine.file_info
+                    self.duplicate_folders = self.scan_engine.folder_duplicates
+                    self.similarity = getattr(self.scan_engine, "similarity", {})
+                    self.reference_paths = getattr(self.scan_engine, "reference_paths", set())
+                    self.folder_info = self.scan_engine.folder_info
+                    self.scan_hash_algorithm = self.scan_engine.algorithm
+                    self.scan_roots = self.scan_engine.roots
+                    self.empty_dir_candidates = set(self.scan_engine.empty_dirs)
+                    self.last_scan_folder = self.scan_roots[0]
+                    self.folder_path_var.set("; ".join(self.scan_roots))
                     duplicate_count = sum(len(v) for v in duplicates.values())
                     group_count = len(duplicates)
+                    folder_count = len(self.duplicate_folders)
+
+                    self.progress_var.set(100)
+                    self.populate_tree(duplicates)
+                    self.pause_scan_btn.config(state=tk.DISABLED)
+                    self.cancel_scan_btn.config(state=tk.DISABLED)
+                    status_text = (
+                        f"Scan complete. Scanned: {total_files_found} files. "
+                        f"Found {duplicate_count} duplicate files in {group_count} groups."
+                    )
+                    if folder_count:
+                        status_text += f" Found {folder_count} duplicate folder groups."
+
+                    self.status_label.config(text=status_text)
+                    self.start_empty_folder_cleanup()
+        except queue.Empty:
+            pass
+        self.process_task_results()
+        if not self.is_closing:
+            self.root.after(100, self.process_scan_results)
+
+    def process_task_results(self):
+        # Results from background file operations; kept apart from scan_queue
+        # so clearing scan progress never drops a finished move.
+        try:
+            for _ in range(self.TASK_ITEMS_PER_TICK):
+                item = self.task_queue.get_nowait()
+                if item[0] == "move_done":
+                    self.finish_move(item[1], item[2], item[3])
+                elif item[0] == "link_done":
+                    self.finish_link(item[1], item[2])
+                elif item[0] == "watch_update":
+                    self.apply_watch_update(item[1])
+                elif item[0] == "overlap_progress":
+                    self.status_label.config(text=f"Analyzing partial overlap: {item[1]} / {item[2]} files")
+                elif item[0] == "overlap_done":
+                    self.overlap_control = None
+                    self.show_overlap_report(item[1])
+                elif item[0] == "overlap_failed":
+                    self.overlap_control = None
+                    self.status_label.config(text="Partial overlap analysis failed.")
+                    messagebox.showerror("Partial Overlap", f"Analysis failed:\n{item[1]}")
+                elif item[0] == "watch_status":
+                    self.status_label.config(text=item[1])
+                elif item[0] == "histories_loaded":
+                    self.finish_history_load()
+                    self.root.after(self.BACKUP_GC_DELAY_MS, self.auto_backup_gc)
+                elif item[0] == "backup_gc_done":
+                    self.finish_backup_gc(item[1])
+                elif item[0] == "backup_gc_failed":
+                    self.backup_gc_thread = None
+                    print(f"Undo backup cleanup failed: {item[1]}")
+                    if self.backup_gc_manual:
+                        messagebox.showerror("Undo Backups", f"Cleanup failed:\n{item[1]}")
+                elif item[0] == "daemon_results":
+                    self.show_daemon_results(item[1], item[2])
+                elif item[0] == "daemon_failed":
+                    self.status_label.config(text="Could not load results from the daemon.")
+                    messagebox.showerror("Scan Daemon", f"Failed to load results from {item[1]}:\n{item[2]}")
+                elif item[0] == "cleanup_done":
+                    if item[1]:
+                        self.status_label.config(text=f"{self.status_label.cget('text')} Removed {item[1]} empty folders.")
+                elif item[0] == "export_done":
+                    self.status_label.config(text=f"Exported {item[2]} rows.")
+                    messagebox.showinfo("Export Complete", f"Scan results exported to:\n{item[1]}")
+                elif item[0] == "export_failed":
+                    self.status_label.config(text="Export failed.")
+                    messagebox.showerror("Export Failed", f"Failed to export scan results:\n{item[2]}")
+                elif item[0].startswith("import_") and item[1] != self.import_generation:
+                    continue
+                elif item[0] == "import_batch":
+                    self.add_import_batch(item[2])
+                elif item[0] == "import_done":
+                    self.finish_import(item[2], item[3], item[4], item[5])
+                elif item[0] == "import_failed":
+                    self.status_label.config(text="Import failed.")
+                    messagebox.showerror("Import Failed", f"Failed to import scan results:\n{item[3]}")
+        except queue.Empty:
+            pass
+
+    # -- Scan daemon client --
+
+    def load_daemon_results(self):
+        # Shows the daemon's current groups instead of scanning in this window
+        address = self.settings.get("daemon_address", DAEMON_DEFAULT_ADDRESS)
+        self.status_label.config(text=f"Loading results from {address}...")
+        threading.Thread(target=self.fetch_daemon_results, args=(address,), daemon=True).start()
+
+    def fetch_daemon_results(self, address):
+        try:
+            self.task_queue.put(("daemon_results", address, DaemonClient(address).all_groups()))
+        except Exception as e:
+            self.task_queue.put(("daemon_failed", address, e))
+
+    def show_daemon_results(self, address, result):
+        self.stop_watch()
+        self.import_generation += 1
+        self.scan_engine = None
+        self.duplicates = {}
+        self.file_info = {}
+        self.duplicate_folders = {}
+        self.folder_info = {}
+        self.similarity = {}
+        self.reference_paths = set()
+        self.unavailable_paths = set()
+        self.selected_files.clear()
+        for group in result["groups"]:
+            paths = []
+            for entry in group["files"]:
+                paths.append(entry["path"])
+                self.file_info[entry["path"]] = (entry["size"], entry["mtime"])
+            self.duplicates[bytes.fromhex(group["digest"])] = paths
+        self.scan_hash_algorithm = result["algorithm"]
+        self.scan_roots = result["roots"]
+        self.populate_tree(self.duplicates)
+        self.status_label.config(text=f"Loaded {len(self.duplicates)} duplicate groups from {address}.")
+
+    # -- Watch mode --
+
+    def toggle_watch_mode(self):
+        if not self.watch_enabled.get():
+            self.stop_watch()
+            self.status_label.config(text="Watch mode stopped.")
+            return
+        engine = self.scan_engine
+        scanning = self.scanning_thread and self.scanning_thread.is_alive()
+        if engine is None or engine.spill or not engine.LIVE_UPDATES or scanning or not self.scan_roots:
+            self.watch_enabled.set(False)
+            messagebox.showinfo("Watch Mode", "Watch mode needs a finished duplicate scan made without low-memory grouping.")
+            return
+        self.watch_control = ScanControl()
+        with engine.index_lock:
+            live = LiveIndex(engine.index, engine.hashed, engine.hash_file, engine.scan_filter,
+                             engine.index_lock, self.watch_control)
+        watcher = ScanWatcher(live, list(self.scan_roots), engine.scan_filter, self.watch_control, self.task_queue)
+        threading.Thread(target=watcher.run, daemon=True).start()
+
+    def stop_watch(self):
+        if self.watch_control:
+            self.watch_control.cancel()
+            self.watch_control = None
+        self.watch_enabled.set(False)
+
+    def apply_watch_update(self, changes):
+        # Rows of every changed group are dropped first, since a modified file
+        # can move from one group to another in the same update
+        if not self.watch_control:
+            return
+        for digest in changes:
+            for filepath in self.duplicates.pop(digest, []):
+                self.selected_files.discard(filepath)
+                self.file_info.pop(filepath, None)
+                row_id = self.tree_items.pop(filepath, None)
+                if row_id:
+                    self.tree.delete(row_id)
+
+        for digest, entries in changes.items():
+            if not entries:
+                self.tree_group_numbers.pop(digest, None)
+                continue
+            group_num = self.tree_group_numbers.get(digest)
+            if group_num is None:
+                group_num = self.tree_group_numbers[digest] = self.next_tree_group
+                self.next_tree_group += 1
+            self.duplicates[digest] = [filepath for filepath, _, _ in entries]
+            for filepath, size, mtime in entries:
+                self.file_info[filepath] = (size, mtime)
+                root = root_of(filepath, self.scan_roots)
+                row_id = self.tree.insert("", "end", values=("", filepath, self.format_size(size), group_num, root, ""))
+                self.tree_items[filepath] = row_id
 
-                    self.progress_var.set(100)
-                    self.populate_tree(duplicates)
-                    self.pause_scan_btn.config(state=tk.DISABLED)
-                    self.cancel_scan_btn.config(state=tk.DISABLED)
-                    status_text = (
-                        f"Scan complete. Scanned: {total_files_found} files. "
-                        f"Found {duplicate_count} duplicate files in {group_count} groups."
-                    )
+        duplicate_count = sum(len(v) for v in self.duplicates.values())
+        self.status_label.config(
+            text=f"Watch: updated {len(changes)} group(s). {duplicate_count} duplicate files in {len(self.duplicates)} groups."
+        )
 
-                    if self.clean_empty_folders_var.get() and self.last_scan_folder:
-                        cleaned = self.clean_empty_folders(self.last_scan_folder)
-                        status_text += f" Removed {cleaned} empty folders."
-                    self.status_label.config(text=status_text)
-        except queue.Empty:
-            pass
-        if not self.is_closing:
-            self.root.after(100, self.process_scan_results)
+    # -- Partial overlap analysis --
+
+    OVERLAP_MIN_FILE_SIZE = 1024 * 1024
+
+    def start_overlap_analysis(self):
+        # Works on the files of the last scan; small files are left out
+        engine = self.scan_engine
+        if engine is None or engine.spill or not self.scan_roots or len(engine.index) == 0:
+            messagebox.showinfo("Partial Overlap", "Run a scan (without low-memory grouping) first.")
+            return
+        if self.overlap_control:
+            messagebox.showinfo("Partial Overlap", "An analysis is already running.")
+            return
+        index = engine.index
+        # Watch mode may be changing the index on its thread
+        with engine.index_lock:
+            files = [(index.path(file_id), index.sizes[file_id])
+                     for group in index.size_groups.values()
+                     for file_id in ((group,) if isinstance(group, int) else group)
+                     if index.sizes[file_id] >= self.OVERLAP_MIN_FILE_SIZE]
+        if not files:
+            messagebox.showinfo("Partial Overlap", "No files of 1 MB or more in the last scan.")
+            return
+        total_size = sum(size for _, size in files)
+        if not messagebox.askyesno("Partial Overlap",
+                                   f"Read {len(files)} files ({self.format_size(total_size)}) to find shared content?"):
+            return
+        self.overlap_control = ScanControl()
+        analyzer = ChunkOverlapAnalyzer(files, self.overlap_control, self.task_queue)
+        threading.Thread(target=analyzer.run, daemon=True).start()
+
+    def show_overlap_report(self, report):
+        self.status_label.config(
+            text=f"Partial overlap: {self.format_size(report['reclaimable'])} reclaimable by block-level dedup."
+        )
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Partial Overlap")
+        dialog.geometry("900x500")
+
+        summary = (
+            f"Files analyzed: {report['files']}    Total: {self.format_size(report['total_bytes'])}    "
+            f"Unique: {self.format_size(report['unique_bytes'])}    "
+            f"Estimated reclaimable: {self.format_size(report['reclaimable'])}"
+        )
+        ttk.Label(dialog, text=summary, padding=(10, 8)).pack(anchor="w")
+
+        frame = ttk.Frame(dialog)
+        frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+        columns = ("File A", "File B", "Shared", "Shared %")
+        tree = ttk.Treeview(frame, columns=columns, show="headings")
+        vsb = ttk.Scrollbar(frame, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=vsb.set)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        vsb.pack(side=tk.RIGHT, fill=tk.Y)
+        for col, width in zip(columns, (340, 340, 90, 70)):
+            tree.heading(col, text=col)
+            tree.column(col, width=width, anchor=tk.W if col.startswith("File") else tk.CENTER)
+        for path_a, path_b, shared_bytes, percent in report["pairs"]:
+            tree.insert("", "end", values=(path_a, path_b, self.format_size(shared_bytes), f"{percent:.1f}%"))
+        if not report["pairs"]:
+            tree.insert("", "end", values=("No partially overlapping files found.", "", "", ""))
+
+    # -- Empty folder cleanup --
+
+    def note_removed_files(self, filepaths):
+        # Folders that lost files become cleanup candidates
+        for filepath in filepaths:
+            self.empty_dir_candidates.add(os.path.dirname(os.path.normpath(filepath)))
 
-    def clean_empty_folders(self, root_folder):
+    def start_empty_folder_cleanup(self):
+        if not self.clean_empty_folders_var.get() or not self.scan_roots or not self.empty_dir_candidates:
+            return
+        candidates = self.empty_dir_candidates
+        self.empty_dir_candidates = set()
+        threading.Thread(target=self.run_empty_folder_cleanup, args=(candidates, list(self.scan_roots)),
+                         daemon=True).start()
+
+    def run_empty_folder_cleanup(self, candidates, roots):
+        # Only candidate folders are visited, deepest first. rmdir fails on a
+        # folder that still has anything in it, and a removed folder makes its
+        # parent a candidate. The scan roots themselves are never removed.
+        skip_keywords = [".git", "windows", "system", "program files", "appdata", "temp", "cache"]
+        heap = [(-dirpath.count(os.sep), dirpath) for dirpath in candidates]
+        heapq.heapify(heap)
+        seen = set(candidates)
         removed_count = 0
-        for dirpath, dirnames, filenames in os.walk(root_folder, topdown=False):
+        while heap:
+            _, dirpath = heapq.heappop(heap)
+            if dirpath in roots or not root_of(dirpath, roots):
+                continue
+            if any(skip_word in dirpath.lower() for skip_word in skip_keywords):
+                continue
             try:
-                if not os.listdir(dirpath):
-                    lower_path = dirpath.lower()
-                    skip_keywords = [".git", "windows", "system", "program files", "appdata", "temp", "cache"]
-                    if any(skip_word in lower_path for skip_word in skip_keywords):
-                        continue
-                    os.rmdir(dirpath)
-                    removed_count += 1
-            except Exception as e:
-                print(f"Failed to remove {dirpath}: {e}")
-        return removed_count
+                os.rmdir(dirpath)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    print(f"Failed to remove {dirpath}: {e}")
+                continue
+            removed_count += 1
+            parent = os.path.dirname(dirpath)
+            if parent not in seen:
+                seen.add(parent)
+                heapq.heappush(heap, (-parent.count(os.sep), parent))
+        self.task_queue.put(("cleanup_done", removed_count))
 
     def cancel_scan(self):
+        # The engine saves its checkpoint and reports "cancelled" on its own
         if messagebox.askyesno("Cancel Scan", "Are you sure you want to cancel the ongoing scan?"):
-            self.scan_stop_event.set()  
+            self.scan_control.cancel()
             self.pause_scan_btn.config(state=tk.DISABLED)
             self.cancel_scan_btn.config(state=tk.DISABLED)
-            self.status_label.config(text="Scan cancelled.")
-            self.progress_var.set(0)
-
-            if self.scanning_thread and self.scanning_thread.is_alive():
-                self.scanning_thread.join(timeout=5)
-                self.scanning_thread = None
-
-            self.clear_scan_queue()
+            self.status_label.config(text="Cancelling scan...")
 
     def toggle_pause_resume_scan(self):
-        if self.scan_pause_event.is_set():
-            self.scan_pause_event.clear()
+        if self.scan_control.paused:
+            self.scan_control.resume()
             self.pause_scan_btn.config(text="Pause Scan")
             self.status_label.config(text="Resuming scan...")
         else:
-            self.scan_pause_event.set()
+            self.scan_control.pause()
             self.pause_scan_btn.config(text="Resume Scan")
             self.status_label.config(text="Scan paused.")
 
-    def hash_file(self, filepath, hash_size):
-        hasher = hashlib.md5()
-        with open(filepath, "rb") as f:
-            if hash_size == 0:
-                while True:
-                    chunk = f.read(8192)
-                    if not chunk:
-                        break
-                    hasher.update(chunk)
-            else:
-                data = f.read(hash_size)
-                hasher.update(data)
-        return hasher.hexdigest()
-
-    def passes_advanced_filters(self, file_path):
-        if not self.settings.get("use_filters", False):
-            return True
-
-        for folder in self.settings.get("filter_excluded_folders", []):
-            if folder.strip() and folder.lower() in file_path.lower():
-                return False
-
-        try:
-            min_kb = int(self.settings.get("filter_min_size_kb", 0))
-            if os.path.getsize(file_path) < (min_kb * 1024):
-                return False
-        except Exception:
-            return False
-
-        ext_list = self.settings.get("filter_extensions", "").strip().lower().replace(" ", "").split(",")
-        if ext_list != ['']: 
-            ext = os.path.splitext(file_path)[1].lower().lstrip(".")
-            if ext not in ext_list:
-                return False
-
-        return True
-
     def populate_tree(self, duplicates):
         self.tree.delete(*self.tree.get_children())
         self.tree_items.clear()
+        self.tree_group_numbers = {}
         group_num = 1
+
+        # Duplicate folders come first, shown with a trailing separator; file
+        # groups lying entirely inside them are not listed again
+        covered = set()
+        for group_id, folders in self.duplicate_folders.items():
+            self.tree_group_numbers[("folder", group_id)] = group_num
+            for dirpath in folders:
+                covered.add(dirpath)
+                size_bytes = self.folder_info.get(dirpath, (0, 0))[0]
+                folder_row = dirpath.rstrip(os.sep) + os.sep
+                root = root_of(dirpath, self.scan_roots)
+                row_id = self.tree.insert("", "end", values=("", folder_row, self.format_size(size_bytes), group_num, root,
+                                                             ""))
+                self.tree_items[folder_row] = row_id
+            group_num += 1
+
+        collapsed = 0
         for group_id, files in duplicates.items():
+            if covered and all(self.in_duplicate_folder(filepath, covered) for filepath in files):
+                collapsed += 1
+                continue
+            self.tree_group_numbers[group_id] = group_num
             for i, filepath in enumerate(files):
                 size_bytes = 0
-                try:
-                    size_bytes = os.path.getsize(filepath)
-                except Exception:
-                    pass
+                info = self.file_info.get(filepath)
+                if info:
+                    size_bytes = info[0]
+                else:
+                    try:
+                        size_bytes = os.path.getsize(filepath)
+                    except Exception:
+                        pass
                 size_str = self.format_size(size_bytes)
                 select_val = ""
                 tags = ()
-                row_id = self.tree.insert("", "end", values=(select_val, filepath, size_str, group_num), tags=tags)
+                if filepath in self.reference_paths:
+                    root = "reference"
+                elif filepath in self.unavailable_paths:
+                    root = self.UNAVAILABLE_ROOT
+                else:
+                    root = root_of(filepath, self.scan_roots)
+                similarity = self.similarity.get(filepath, "")
+                row_id = self.tree.insert("", "end", values=(select_val, filepath, size_str, group_num, root, similarity),
+                                          tags=tags)
                 self.tree_items[filepath] = row_id
             group_num += 1
-        self.status_label.config(text=f"Loaded {sum(len(v) for v in duplicates.values())} duplicates in {len(duplicates)} groups.")
+        self.next_tree_group = group_num
+        status_text = f"Loaded {sum(len(v) for v in duplicates.values())} duplicates in {len(duplicates)} groups."
+        if self.duplicate_folders:
+            status_text += (f" {len(self.duplicate_folders)} duplicate folder groups"
+                            f" cover {collapsed} of the file groups.")
+        self.status_label.config(text=status_text)
         self.toggle_select_dupes() 
 
+    def in_duplicate_folder(self, filepath, folders):
+        dirpath = os.path.dirname(filepath)
+        while dirpath not in folders:
+            parent = os.path.dirname(dirpath)
+            if parent == dirpath:
+                return False
+            dirpath = parent
+        return True
+
     def format_size(self, size_bytes):
         try:
             if size_bytes < 1024:
@@ -870,18 +4845,28 @@ class DuplicateFinderApp:
     def toggle_select_dupes(self):
         if self.select_dupes_var.get():
             groups = {}
+            referenced = set()
             for filepath, row_id in self.tree_items.items():
                 group = self.tree.set(row_id, "Group")
+                if filepath in self.reference_paths or filepath in self.unavailable_paths:
+                    if filepath in self.reference_paths:
+                        referenced.add(group)
+                    self.tree.set(row_id, "Select", "")
+                    self.tree.item(row_id, tags=())
+                    continue
                 groups.setdefault(group, []).append((filepath, row_id))
             self.selected_files.clear()
-            for group_files in groups.values():
-                for filepath, row_id in group_files[1:]:
+            for group, group_files in groups.items():
+                # The reference copy is the one kept when a group has one
+                keep = 0 if group in referenced else 1
+                for filepath, row_id in group_files[keep:]:
                     self.selected_files.add(filepath)
                     self.tree.set(row_id, "Select", "✔")
                     self.tree.item(row_id, tags=("selected",))
-                filepath, row_id = group_files[0]
-                self.tree.set(row_id, "Select", "")
-                self.tree.item(row_id, tags=())
+                if keep:
+                    filepath, row_id = group_files[0]
+                    self.tree.set(row_id, "Select", "")
+                    self.tree.item(row_id, tags=())
         else:
             self.selected_files.clear()
             for row_id in self.tree.get_children():
@@ -903,6 +4888,12 @@ class DuplicateFinderApp:
         filepath = self.tree.set(row_id, "File Path")
         ctrl_pressed = (event.state & 0x0004) != 0
         shift_pressed = (event.state & 0x0001) != 0
+        if filepath in self.reference_paths:
+            self.status_label.config(text=f"Reference copies can't be selected:\n{filepath}")
+            return "break"
+        if filepath in self.unavailable_paths:
+            self.status_label.config(text=f"Not on this machine, can't be selected:\n{filepath}")
+            return "break"
 
         if col == "#1":  
             current_val = self.tree.set(row_id, "Select")
@@ -938,7 +4929,7 @@ class DuplicateFinderApp:
                     anchor_index = self.tree.index(selected[0])
                     low = min(anchor_index, current_index)
                     high = max(anchor_index, current_index)
-                    range_ids = self.tree.get_children()[low:high+1]
+                    range_ids = self.selectable_rows(self.tree.get_children()[low:high+1])
                     self.tree.selection_set(range_ids)
                     for item in self.tree.get_children():
                         if item in range_ids:
@@ -984,7 +4975,7 @@ class DuplicateFinderApp:
         low = min(start_index, current_index)
         high = max(start_index, current_index)
 
-        range_ids = self.tree.get_children()[low:high+1]
+        range_ids = self.selectable_rows(self.tree.get_children()[low:high+1])
 
         for item in self.tree.get_children():
             if item in range_ids:
@@ -1000,6 +4991,11 @@ class DuplicateFinderApp:
 
         self.tree.selection_set(range_ids)
 
+    def selectable_rows(self, row_ids):
+        return [row_id for row_id in row_ids
+                if self.tree.set(row_id, "File Path") not in self.reference_paths
+                and self.tree.set(row_id, "File Path") not in self.unavailable_paths]
+
     def handle_drag_release(self, event):
         self.drag_select_start = None
 
@@ -1043,6 +5039,7 @@ class DuplicateFinderApp:
         menu.add_command(label="Delete File(s)", command=self.delete_selected_files)
         menu.add_separator()
         menu.add_command(label="Move File(s)", command=self.move_selected_files)
+        menu.add_command(label="Replace with Link(s)", command=self.link_selected_files)
 
         try:
             menu.tk_popup(event.x_root, event.y_root)
@@ -1085,7 +5082,7 @@ class DuplicateFinderApp:
 
     def on_tree_select(self, event):
         selected_items = self.tree.selection()
-        self.selected_files = set(self.tree.set(item, "File Path") for item in selected_items)
+        self.selected_files = set(self.tree.set(item, "File Path") for item in self.selectable_rows(selected_items))
         for item in self.tree.get_children():
             self.tree.item(item, tags=())
         for item in selected_items:
@@ -1098,6 +5095,7 @@ class DuplicateFinderApp:
             messagebox.showinfo("No Selection", "No files selected to open folder.")
             return
         filepath = next(iter(self.selected_files))
+        filepath = split_archive_path(filepath)[0] or filepath
         if not os.path.exists(filepath):
             messagebox.showwarning("File Not Found", f"File does not exist:\n{filepath}")
             return
@@ -1128,6 +5126,35 @@ class DuplicateFinderApp:
                 except Exception as e:
                     messagebox.showwarning("Open Failed", f"Failed to open file:\n{filepath}\n{e}")
 
+    def unselect_protected_files(self, action):
+        # Files inside archives can't be changed in place, reference copies
+        # are never changed, and imported files on other machines can't be
+        # reached; they are unselected and the action goes ahead with the rest
+        members = [path for path in self.selected_files if split_archive_path(path)[0]]
+        references = [path for path in self.selected_files
+                      if path in self.reference_paths and not split_archive_path(path)[0]]
+        unavailable = [path for path in self.selected_files if path in self.unavailable_paths]
+        for path in members + references + unavailable:
+            self.selected_files.discard(path)
+            row_id = self.tree_items.get(path)
+            if row_id and self.tree.exists(row_id):
+                self.tree.set(row_id, "Select", "")
+                self.tree.item(row_id, tags=())
+                self.tree.selection_remove(row_id)
+        if members:
+            messagebox.showinfo("Archive Members Skipped",
+                                f"{len(members)} selected file(s) are inside archives and can't be {action}. "
+                                "They were unselected.")
+        if references:
+            messagebox.showinfo("Reference Copies Skipped",
+                                f"{len(references)} selected file(s) are in the reference and can't be {action}. "
+                                "They were unselected.")
+        if unavailable:
+            messagebox.showinfo("Files Not on This Machine",
+                                f"{len(unavailable)} selected file(s) are not on this machine and can't be {action}. "
+                                "They were unselected.")
+        return bool(self.selected_files)
+
     # -- Delete single file --
 	
     def normalize_path(self, path):
@@ -1146,7 +5173,7 @@ class DuplicateFinderApp:
                 return
             if self.delete_to_recycle.get() and SEND2TRASH_AVAILABLE:
                 try:
-                    send2trash.send2trash(safe_path)
+                    send_to_trash(safe_path)
                 except Exception as e:
                     messagebox.showerror("Delete Failed", f"Failed to delete file:\n{filepath}\n{e}")
                     return
@@ -1175,9 +5202,12 @@ class DuplicateFinderApp:
         if not self.selected_files:
             messagebox.showinfo("No Selection", "No files selected to delete.")
             return
+        if not self.unselect_protected_files("deleted"):
+            return
         confirm = messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete {len(self.selected_files)} selected file(s)?")
         if not confirm:
             return
+        self.finish_history_load()
         failed = []
         deleted = []
         for filepath in list(self.selected_files):
@@ -1189,19 +5219,26 @@ class DuplicateFinderApp:
                 backup_filename = f"{uuid.uuid4()}_{os.path.basename(safe_path)}"
                 backup_path = os.path.join(self.undo_backup_folder, backup_filename)
                 os.makedirs(self.undo_backup_folder, exist_ok=True)
-                shutil.copy2(safe_path, backup_path)
+                is_folder = os.path.isdir(safe_path)
+                if is_folder:
+                    shutil.copytree(safe_path, backup_path, symlinks=True)
+                else:
+                    shutil.copy2(safe_path, backup_path)
 
                 # Delete logic
                 if self.delete_to_recycle.get() and SEND2TRASH_AVAILABLE:
                     try:
-                        send2trash.send2trash(safe_path)
+                        send_to_trash(safe_path)
                     except Exception as e:
                         failed.append(filepath)
                         print(f"Failed to send to trash: {filepath}\n{e}")
                         continue
                 else:
                     try:
-                        os.remove(safe_path)
+                        if is_folder:
+                            shutil.rmtree(safe_path)
+                        else:
+                            os.remove(safe_path)
                     except Exception as e:
                         failed.append(filepath)
                         print(f"Failed to remove file: {filepath}\n{e}")
@@ -1227,6 +5264,8 @@ class DuplicateFinderApp:
 
         if deleted:
             self.save_delete_history()
+            self.note_removed_files(deleted)
+            self.start_empty_folder_cleanup()
 
         if failed:
             messagebox.showwarning("Delete Failed", f"Failed to delete {len(failed)} file(s). Check console for details.")
@@ -1236,6 +5275,7 @@ class DuplicateFinderApp:
         self.status_label.config(text=f"Deleted {len(deleted)} files.")
 
     def undo_delete(self):
+        self.finish_history_load()
         if not self.delete_history:
             messagebox.showinfo("Undo Delete", "No delete history to undo.")
             return
@@ -1250,7 +5290,8 @@ class DuplicateFinderApp:
 
         try:
             os.makedirs(os.path.dirname(original_path), exist_ok=True)
-            shutil.move(backup_path, original_path)
+            with self.backup_lock:
+                shutil.move(backup_path, original_path)
 
             # START - Rehash and update duplicates list
             file_hash = self.get_file_hash(original_path)
@@ -1279,7 +5320,7 @@ class DuplicateFinderApp:
             with open(filepath, 'rb') as f:
                 for chunk in iter(lambda: f.read(block_size), b""):
                     hasher.update(chunk)
-            return hasher.hexdigest()
+            return hasher.digest()
         except Exception as e:
             print(f"Hashing failed for {filepath}: {e}")
             return None
@@ -1290,61 +5331,229 @@ class DuplicateFinderApp:
         if not self.selected_files:
             messagebox.showinfo("No Selection", "No files selected to move.")
             return
+        if not self.unselect_protected_files("moved"):
+            return
 
         target_folder = filedialog.askdirectory(title="Select Folder to Move Files To")
         if not target_folder:
             return
 
+        filepaths = list(self.selected_files)
+        self.status_label.config(text=f"Moving {len(filepaths)} file(s)...")
+        threading.Thread(target=self.run_move_plan, args=(filepaths, target_folder), daemon=True).start()
+
+    def run_move_plan(self, filepaths, target_folder):
+        planner = MovePlanner(target_folder)
         moved = []
         failed = []
+        missing = []
+        copies = []
 
-        for filepath in list(self.selected_files):
-            if not os.path.exists(filepath):
-                self.selected_files.discard(filepath)
+        for filepath in filepaths:
+            # Duplicate-folder rows end in a separator
+            source = os.path.normpath(filepath)
+            try:
+                st = os.stat(source)
+            except FileNotFoundError:
+                missing.append(filepath)
+                continue
+            except OSError as e:
+                failed.append(filepath)
+                print(f"Failed to move file: {filepath}\n{e}")
                 continue
 
-            try:
-                filename = os.path.basename(filepath)
-                target_path = os.path.join(target_folder, filename)
-
-                if os.path.exists(target_path):
-                    base, ext = os.path.splitext(filename)
-                    counter = 1
-                    while os.path.exists(target_path):
-                        filename = f"{base}_{counter}{ext}"
-                        target_path = os.path.join(target_folder, filename)
-                        counter += 1
-
-                shutil.move(filepath, target_path)
-
-                self.move_history.append({
-                    "original": filepath,
-                    "moved_to": target_path,
-                    "timestamp": datetime.datetime.now().isoformat()
-                })
-                if len(self.move_history) > self.DELETE_HISTORY_MAX:
-                    self.move_history.pop(0)
+            target_path = planner.reserve(os.path.basename(source))
 
-                moved.append(filepath)
-                self.selected_files.discard(filepath)
+            # Same device: a rename never copies data
+            if st.st_dev == planner.target_dev:
+                try:
+                    move_no_replace(source, target_path)
+                    moved.append((filepath, target_path))
+                    continue
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        failed.append(filepath)
+                        print(f"Failed to move file: {filepath}\n{e}")
+                        continue
+            copies.append((filepath, target_path))
 
-                row_id = self.tree_items.get(filepath)
-                if row_id:
-                    self.tree.delete(row_id)
-                    self.tree_items.pop(filepath, None)
+        if copies:
+            with ThreadPoolExecutor(max_workers=self.MOVE_COPY_WORKERS) as pool:
+                futures = {pool.submit(self.copy_and_verify, os.path.normpath(src), dst): (src, dst) for src, dst in copies}
+                for future in as_completed(futures):
+                    src, dst = futures[future]
+                    try:
+                        future.result()
+                        moved.append((src, dst))
+                    except Exception as e:
+                        failed.append(src)
+                        print(f"Failed to move file: {src}\n{e}")
 
-            except Exception as e:
-                failed.append(filepath)
-                print(f"Failed to move file: {filepath}\n{e}")
+        self.task_queue.put(("move_done", moved, failed, missing))
+
+    def copy_and_verify(self, src, dst):
+        if os.path.isdir(src):
+            shutil.copytree(src, dst, symlinks=True)
+            try:
+                self.verify_tree_copy(src, dst)
+            except Exception:
+                shutil.rmtree(dst, ignore_errors=True)
+                raise
+            shutil.rmtree(src)
+            return
+        copy_file_exclusive(src, dst)
+        try:
+            if os.path.getsize(src) != os.path.getsize(dst):
+                raise IOError("size mismatch after copy")
+            src_hash = self.get_file_hash(src)
+            if src_hash is None or src_hash != self.get_file_hash(dst):
+                raise IOError("checksum mismatch after copy")
+        except Exception:
+            try:
+                os.remove(dst)
+            except OSError:
+                pass
+            raise
+        os.remove(src)
+
+    def verify_tree_copy(self, src, dst):
+        for dirpath, _, filenames in os.walk(src):
+            for name in filenames:
+                src_file = os.path.join(dirpath, name)
+                if os.path.islink(src_file):
+                    continue
+                dst_file = os.path.join(dst, os.path.relpath(src_file, src))
+                if os.path.getsize(src_file) != os.path.getsize(dst_file):
+                    raise IOError(f"size mismatch after copy: {dst_file}")
+                src_hash = self.get_file_hash(src_file)
+                if src_hash is None or src_hash != self.get_file_hash(dst_file):
+                    raise IOError(f"checksum mismatch after copy: {dst_file}")
+
+    def finish_move(self, moved, failed, missing):
+        self.finish_history_load()
+        for filepath in missing:
+            self.selected_files.discard(filepath)
+
+        for filepath, target_path in moved:
+            self.move_history.append({
+                "original": os.path.normpath(filepath),
+                "moved_to": target_path,
+                "timestamp": datetime.datetime.now().isoformat()
+            })
+            if len(self.move_history) > self.DELETE_HISTORY_MAX:
+                self.move_history.pop(0)
+
+            self.selected_files.discard(filepath)
+
+            row_id = self.tree_items.get(filepath)
+            if row_id:
+                self.tree.delete(row_id)
+                self.tree_items.pop(filepath, None)
 
         if moved:
+            self.save_move_history()
+            self.note_removed_files(filepath for filepath, _ in moved)
+            self.start_empty_folder_cleanup()
             messagebox.showinfo("Move Success", f"Moved {len(moved)} file(s).")
             self.status_label.config(text=f"Moved {len(moved)} file(s).")
 
         if failed:
             messagebox.showwarning("Move Failed", f"Failed to move {len(failed)} file(s). Check console for details.")
 
+    # -- Replace Duplicates with Links Logic --
+
+    def link_selected_files(self):
+        if not self.selected_files:
+            messagebox.showinfo("No Selection", "No files selected to link.")
+            return
+        if not self.unselect_protected_files("replaced with links"):
+            return
+
+        # Pair every selected file with an unselected member of its group to keep
+        pairs = []
+        no_keeper = []
+        for files in self.duplicates.values():
+            selected = [f for f in files if f in self.selected_files]
+            if not selected:
+                continue
+            keepers = [f for f in files if f not in self.selected_files and not split_archive_path(f)[0]
+                       and f not in self.reference_paths and f not in self.unavailable_paths]
+            if not keepers:
+                no_keeper.extend(selected)
+                continue
+            pairs.extend((keepers[0], f) for f in selected)
+
+        if not pairs:
+            messagebox.showinfo("Nothing to Link", "Leave at least one file unselected in each group to link the others to.")
+            return
+
+        confirm = messagebox.askyesno(
+            "Confirm Link",
+            f"Replace {len(pairs)} selected file(s) with links to the kept file in their group?"
+        )
+        if not confirm:
+            return
+
+        mode = self.settings.get("link_mode", "auto")
+        self.status_label.config(text=f"Linking {len(pairs)} file(s)...")
+        threading.Thread(target=self.run_link_plan, args=(pairs, mode, no_keeper), daemon=True).start()
+
+    def run_link_plan(self, pairs, mode, no_keeper):
+        linked = []
+        failed = list(no_keeper)
+        for kept, duplicate in pairs:
+            try:
+                kept_stat = os.stat(kept)
+                dup_stat = os.stat(duplicate)
+                if kept_stat.st_dev != dup_stat.st_dev:
+                    raise OSError(errno.EXDEV, "files are on different devices")
+                if kept_stat.st_ino != dup_stat.st_ino:
+                    if not filecmp.cmp(kept, duplicate, shallow=False):
+                        raise ValueError("file contents differ")
+                    method = replace_with_link(kept, duplicate, mode)
+                else:
+                    method = "hardlink"
+                linked.append((duplicate, kept, method))
+            except Exception as e:
+                failed.append(duplicate)
+                print(f"Failed to link file: {duplicate}\n{e}")
+        self.task_queue.put(("link_done", linked, failed))
+
+    def finish_link(self, linked, failed):
+        self.finish_history_load()
+        linked_paths = set()
+        for duplicate, kept, method in linked:
+            self.link_history.append({
+                "original": duplicate,
+                "linked_to": kept,
+                "method": method,
+                "timestamp": datetime.datetime.now().isoformat()
+            })
+            if len(self.link_history) > self.DELETE_HISTORY_MAX:
+                self.link_history.pop(0)
+
+            linked_paths.add(duplicate)
+            self.selected_files.discard(duplicate)
+            row_id = self.tree_items.pop(duplicate, None)
+            if row_id:
+                self.tree.delete(row_id)
+
+        if linked_paths:
+            for group_id in list(self.duplicates):
+                remaining = [f for f in self.duplicates[group_id] if f not in linked_paths]
+                if len(remaining) > 1:
+                    self.duplicates[group_id] = remaining
+                else:
+                    del self.duplicates[group_id]
+            self.save_link_history()
+            messagebox.showinfo("Link Success", f"Replaced {len(linked)} file(s) with links.")
+            self.status_label.config(text=f"Linked {len(linked)} file(s).")
+
+        if failed:
+            messagebox.showwarning("Link Failed", f"Failed to link {len(failed)} file(s). Check console for details.")
+
     def undo_move(self):
+        self.finish_history_load()
         if not self.move_history:
             messagebox.showinfo("Undo Move", "No move history to undo.")
             return
@@ -1384,9 +5593,10 @@ class DuplicateFinderApp:
     # -- Undo and Delete History Logic -- 
 	
     def show_undo_dialog(self):
+        self.finish_history_load()
         dialog = tk.Toplevel(self.root)
         dialog.title("Undo Move/Delete History")
-        dialog.geometry("800x400")
+        dialog.geometry("800x450")
         dialog.resizable(True, True)
         dialog.grab_set()
 
@@ -1394,6 +5604,68 @@ class DuplicateFinderApp:
         dialog.dragging = False
         dialog.selected_rows = set()
 
+        history_index = UndoHistoryIndex({
+            "Delete": self.delete_history, "Move": self.move_history, "Link": self.link_history
+        })
+        dialog.matches = history_index.query()
+        dialog.page_num = 0
+
+        type_var = tk.StringVar(value="All")
+        path_var = tk.StringVar()
+        from_var = tk.StringVar()
+        to_var = tk.StringVar()
+        select_all_var = tk.BooleanVar()
+        dialog.select_all_var = select_all_var
+
+        def show_page():
+            tree.delete(*tree.get_children())
+            page_count = max(1, (len(dialog.matches) + self.UNDO_PAGE_SIZE - 1) // self.UNDO_PAGE_SIZE)
+            dialog.page_num = max(0, min(dialog.page_num, page_count - 1))
+            tags = ("selected",) if select_all_var.get() else ()
+            for pos, (timestamp, type_, _original_lower, record) in history_index.page(
+                    dialog.matches, dialog.page_num, self.UNDO_PAGE_SIZE):
+                target = record.get(self.UNDO_TARGET_KEYS[type_])
+                tree.insert("", "end", iid=str(pos), values=(type_, record.get("original", ""), target, timestamp), tags=tags)
+            if select_all_var.get():
+                tree.selection_set(tree.get_children())
+            page_label.config(text=f"Page {dialog.page_num + 1} of {page_count} ({len(dialog.matches)} matching)")
+
+        def apply_filters(_event=None):
+            dialog.matches = history_index.query(type_var.get(), path_var.get(), from_var.get(), to_var.get())
+            dialog.page_num = 0
+            show_page()
+
+        def change_page(step):
+            dialog.page_num += step
+            show_page()
+
+        # Filter bar
+        filter_frame = ttk.Frame(dialog)
+        filter_frame.pack(fill=tk.X, padx=10, pady=(10, 0))
+
+        ttk.Label(filter_frame, text="Type:").pack(side=tk.LEFT)
+        type_combo = ttk.Combobox(filter_frame, textvariable=type_var, values=("All", "Delete", "Move", "Link"),
+                                  state="readonly", width=8)
+        type_combo.pack(side=tk.LEFT, padx=(2, 8))
+        type_combo.bind("<<ComboboxSelected>>", apply_filters)
+
+        ttk.Label(filter_frame, text="Path contains:").pack(side=tk.LEFT)
+        path_entry = ttk.Entry(filter_frame, textvariable=path_var)
+        path_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(2, 8))
+        path_entry.bind("<Return>", apply_filters)
+
+        ttk.Label(filter_frame, text="From (YYYY-MM-DD):").pack(side=tk.LEFT)
+        from_entry = ttk.Entry(filter_frame, textvariable=from_var, width=11)
+        from_entry.pack(side=tk.LEFT, padx=(2, 8))
+        from_entry.bind("<Return>", apply_filters)
+
+        ttk.Label(filter_frame, text="To:").pack(side=tk.LEFT)
+        to_entry = ttk.Entry(filter_frame, textvariable=to_var, width=11)
+        to_entry.pack(side=tk.LEFT, padx=(2, 8))
+        to_entry.bind("<Return>", apply_filters)
+
+        ttk.Button(filter_frame, text="Filter", command=apply_filters).pack(side=tk.LEFT)
+
         tree_frame = ttk.Frame(dialog)
         tree_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
@@ -1417,71 +5689,63 @@ class DuplicateFinderApp:
         tree.column("Original", width=250)
         tree.column("Backup/Moved To", width=250)
         tree.column("Timestamp", width=150)
+        tree.tag_configure("selected", background="#cce6ff")
 
         tree.bind("<Button-1>", lambda e: self.undo_tree_click(e, tree, dialog))
         tree.bind("<B1-Motion>", lambda e: self.undo_tree_drag(e, tree, dialog))
         tree.bind("<ButtonRelease-1>", lambda e: self.undo_tree_release(e, tree, dialog))
 
-        # Load data
-        for item in self.delete_history:
-            tree.insert("", "end", values=("Delete", item["original"], item["backup"], item["timestamp"]))
+        # Pager
+        pager_frame = ttk.Frame(dialog)
+        pager_frame.pack(fill=tk.X, padx=10)
 
-        for item in self.move_history:
-            tree.insert("", "end", values=("Move", item["original"], item["moved_to"], item["timestamp"]))
+        ttk.Button(pager_frame, text="< Prev", command=lambda: change_page(-1)).pack(side=tk.LEFT)
+        page_label = ttk.Label(pager_frame, text="")
+        page_label.pack(side=tk.LEFT, padx=10)
+        ttk.Button(pager_frame, text="Next >", command=lambda: change_page(1)).pack(side=tk.LEFT)
 
         def restore_selected():
-            selected = tree.selection()
-            if not selected:
+            if select_all_var.get():
+                positions = list(dialog.matches)
+                if positions and not messagebox.askyesno(
+                        "Restore", f"Restore all {len(positions)} matching item(s)?", parent=dialog):
+                    return
+            else:
+                positions = [int(row_id) for row_id in tree.selection()]
+            if not positions:
                 messagebox.showinfo("Restore", "No items selected to restore.")
                 return
 
-            restored = 0
-            to_delete_ids = []
-
-            for row_id in selected:
-                vals = tree.item(row_id)["values"]
-                type_, original, backup_or_moved, timestamp = vals
-
-                try:
-                    if os.path.exists(backup_or_moved):
-                        os.makedirs(os.path.dirname(original), exist_ok=True)
-                        shutil.move(backup_or_moved, original)
-                        restored += 1
-                        to_delete_ids.append(row_id)
-
-                        # Remove from delete_history or move_history
-                        if type_ == "Delete":
-                            self.delete_history = [
-                                h for h in self.delete_history if not (
-                                    h["original"] == original and h["backup"] == backup_or_moved
-                                )
-                            ]
-                        elif type_ == "Move":
-                            self.move_history = [
-                                h for h in self.move_history if not (
-                                    h["original"] == original and h["moved_to"] == backup_or_moved
-                                )
-                            ]
-                except Exception as e:
-                    print(f"Failed to restore: {original}\n{e}")
-                    continue
+            restored_ids = set()
+            for pos in positions:
+                _timestamp, type_, _original_lower, record = history_index.entries[pos]
+                if self.restore_history_record(type_, record):
+                    restored_ids.add(id(record))
 
-            for row_id in to_delete_ids:
-                tree.delete(row_id)
+            # Remove restored records in place so the index keeps pointing at the live lists
+            if restored_ids:
+                self.delete_history[:] = [h for h in self.delete_history if id(h) not in restored_ids]
+                self.move_history[:] = [h for h in self.move_history if id(h) not in restored_ids]
+                self.link_history[:] = [h for h in self.link_history if id(h) not in restored_ids]
 
             self.save_delete_history()
+            self.save_move_history()
+            self.save_link_history()
+
+            history_index.rebuild()
+            select_all_var.set(False)
+            apply_filters()
 
-            if restored:
-                messagebox.showinfo("Restore Complete", f"Restored {restored} item(s).")
+            if restored_ids:
+                messagebox.showinfo("Restore Complete", f"Restored {len(restored_ids)} item(s).")
                 self.populate_tree(self.duplicates)
 
         # Bottom Frame
         btn_frame = ttk.Frame(dialog)
         btn_frame.pack(fill=tk.X, padx=10, pady=5)
 
-        select_all_var = tk.BooleanVar()
-
         def toggle_select_all():
+            # Only the visible page is tagged; restore works from the filter result.
             if select_all_var.get():
                 tree.selection_set(tree.get_children())
                 for item in tree.get_children():
@@ -1491,7 +5755,7 @@ class DuplicateFinderApp:
                 for item in tree.get_children():
                     tree.item(item, tags=())
 
-        ttk.Checkbutton(btn_frame, text="Select All", variable=select_all_var, command=toggle_select_all).pack(side=tk.LEFT)
+        ttk.Checkbutton(btn_frame, text="Select All Matching", variable=select_all_var, command=toggle_select_all).pack(side=tk.LEFT)
 
         restore_btn = ttk.Button(btn_frame, text="Restore Selected", command=restore_selected)
         restore_btn.pack(side=tk.RIGHT, padx=5)
@@ -1499,14 +5763,39 @@ class DuplicateFinderApp:
         close_btn = ttk.Button(btn_frame, text="Close", command=dialog.destroy)
         close_btn.pack(side=tk.RIGHT)
 
+        show_page()
+
+    def restore_history_record(self, type_, record):
+        original = record.get("original")
+        source = record.get(self.UNDO_TARGET_KEYS[type_])
+        try:
+            if type_ == "Link":
+                # Give the linked path its own copy of the data again
+                if source and os.path.exists(source) and os.path.exists(original):
+                    tmp_path = os.path.join(os.path.dirname(original), f".{uuid.uuid4().hex}.dfrestore")
+                    shutil.copy2(source, tmp_path)
+                    os.replace(tmp_path, original)
+                    return True
+            elif source and os.path.exists(source):
+                os.makedirs(os.path.dirname(original), exist_ok=True)
+                with self.backup_lock:
+                    shutil.move(source, original)
+                return True
+        except Exception as e:
+            print(f"Failed to restore: {original}\n{e}")
+        return False
+
     def undo_tree_click(self, event, tree, dialog):
         row = tree.identify_row(event.y)
         if not row:
             return
+        if dialog.select_all_var.get():
+            dialog.select_all_var.set(False)
+            for item in tree.get_children():
+                tree.item(item, tags=())
         dialog.drag_start_row = row
         dialog.dragging = True
         dialog.selected_rows = {row}
-        tree.tag_configure("selected", background="#cce6ff")
         tree.selection_set(row)
         tree.item(row, tags=("selected",))
 
@@ -1535,92 +5824,184 @@ class DuplicateFinderApp:
     # -- Export and Import CSV / JSON --
 
     def export_scan_csv(self):
-        if not self.duplicates:
-            messagebox.showinfo("No Data", "No scan results to export.")
-            return
-        path = filedialog.asksaveasfilename(title="Export Scan as CSV", defaultextension=".csv",
-                                            filetypes=[("CSV files", "*.csv")],
-                                            initialdir=self.last_export_folder)
-        if not path:
-            return
-        try:
-            with open(path, "w", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(["Group", "File Path", "Size"])
-                group_id = 1
-                for files in self.duplicates.values():
-                    for filepath in files:
-                        try:
-                            size_bytes = os.path.getsize(filepath) if os.path.exists(filepath) else 0
-                        except Exception:
-                            size_bytes = 0
-                        size_str = self.format_size(size_bytes)
-                        writer.writerow([group_id, filepath, size_str])
-                    group_id += 1
-            self.last_export_folder = os.path.dirname(path)
-            messagebox.showinfo("Export Complete", f"Scan results exported to:\n{path}")
-        except Exception as e:
-            messagebox.showerror("Export Failed", f"Failed to export CSV:\n{e}")
+        self.export_scan("csv")
+
+    def export_scan_jsonl(self):
+        self.export_scan("jsonl")
 
-    def export_scan_json(self):
+    def export_scan(self, fmt):
         if not self.duplicates:
             messagebox.showinfo("No Data", "No scan results to export.")
             return
-        path = filedialog.asksaveasfilename(title="Export Scan as JSON", defaultextension=".json",
-                                            filetypes=[("JSON files", "*.json")],
+        if fmt == "csv":
+            title, ext, filetypes = "Export Scan as CSV", ".csv", [
+                ("CSV files", "*.csv"), ("Compressed CSV", "*.csv.gz *.csv.zst")]
+        else:
+            title, ext, filetypes = "Export Scan as JSON Lines", ".jsonl", [
+                ("JSON Lines files", "*.jsonl"), ("Compressed JSON Lines", "*.jsonl.gz *.jsonl.zst")]
+        path = filedialog.asksaveasfilename(title=title, defaultextension=ext, filetypes=filetypes,
                                             initialdir=self.last_export_folder)
         if not path:
             return
+
+        # Snapshot the result model; the writer thread never touches the filesystem for it
+        groups = list(self.duplicates.items())
+        self.last_export_folder = os.path.dirname(path)
+        self.status_label.config(text=f"Exporting {len(groups)} groups...")
+        threading.Thread(
+            target=self.write_scan_export,
+            args=(path, fmt, groups, self.file_info, self.scan_hash_algorithm, list(self.scan_roots)),
+            daemon=True
+        ).start()
+
+    def write_scan_export(self, path, fmt, groups, file_info, algorithm, roots=()):
+        rows = 0
         try:
-            export_data = {}
-            group_id = 1
-            for files in self.duplicates.values():
-                export_data[str(group_id)] = files
-                group_id += 1
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(export_data, f, indent=2)
-            self.last_export_folder = os.path.dirname(path)
-            messagebox.showinfo("Export Complete", f"Scan results exported to:\n{path}")
+            with open_export_stream(path) as f:
+                if fmt == "csv":
+                    writer = csv.writer(f)
+                    writer.writerow(self.EXPORT_CSV_HEADER)
+                else:
+                    encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+                for group_num, (digest, files) in enumerate(groups, 1):
+                    digest_str = digest_hex(digest) if algorithm else ""
+                    for filepath in files:
+                        size, mtime = file_info.get(filepath, (None, None))
+                        root = root_of(filepath, roots)
+                        if fmt == "csv":
+                            writer.writerow([group_num, filepath, size, mtime, digest_str, algorithm, root])
+                        else:
+                            f.write(encoder.encode({
+                                "group": group_num, "path": filepath, "size": size,
+                                "mtime": mtime, "digest": digest_str, "algorithm": algorithm, "root": root
+                            }))
+                            f.write("\n")
+                        rows += 1
+            self.task_queue.put(("export_done", path, rows))
         except Exception as e:
-            messagebox.showerror("Export Failed", f"Failed to export JSON:\n{e}")
+            self.task_queue.put(("export_failed", path, e))
 
     def import_scan_csv(self):
-        path = filedialog.askopenfilename(title="Import Scan CSV",
-                                          filetypes=[("CSV files", "*.csv"), ("All Files", "*.*")],
-                                          initialdir=self.last_import_folder)
-        if not path:
-            return
-        try:
-            with open(path, newline="", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                duplicates = {}
-                for row in reader:
-                    group = row.get("Group")
-                    filepath = row.get("File Path")
-                    duplicates.setdefault(group, []).append(filepath)
-            self.duplicates = {str(i): files for i, files in enumerate(duplicates.values(), 1)}
-            self.populate_tree(self.duplicates)
-            self.last_import_folder = os.path.dirname(path)
-            messagebox.showinfo("Import Complete", "Scan results imported successfully.")
-        except Exception as e:
-            messagebox.showerror("Import Failed", f"Failed to import CSV:\n{e}")
+        self.import_scan("csv")
+
+    def import_scan_jsonl(self):
+        self.import_scan("jsonl")
 
     def import_scan_json(self):
-        path = filedialog.askopenfilename(title="Import Scan JSON",
-                                          filetypes=[("JSON files", "*.json"), ("All Files", "*.*")],
+        self.import_scan("json")
+
+    def import_scan(self, fmt):
+        filetypes = {
+            "csv": [("CSV files", "*.csv *.csv.gz *.csv.zst")],
+            "jsonl": [("JSON Lines files", "*.jsonl *.jsonl.gz *.jsonl.zst")],
+            "json": [("JSON files", "*.json")],
+        }[fmt] + [("All Files", "*.*")]
+        path = filedialog.askopenfilename(title=f"Import Scan {fmt.upper()}", filetypes=filetypes,
                                           initialdir=self.last_import_folder)
         if not path:
             return
+
+        self.stop_watch()
+        self.import_generation += 1
+        self.duplicates = {}
+        self.file_info = {}
+        self.duplicate_folders = {}
+        self.folder_info = {}
+        self.similarity = {}
+        self.reference_paths = set()
+        self.unavailable_paths = set()
+        self.scan_hash_algorithm = ""
+        self.selected_files.clear()
+        self.tree.delete(*self.tree.get_children())
+        self.tree_items.clear()
+        self.import_group_numbers = {}
+        self.scan_roots = []
+        self.last_import_folder = os.path.dirname(path)
+        self.status_label.config(text="Importing scan results...")
+        threading.Thread(target=self.read_scan_import, args=(path, fmt, self.import_generation), daemon=True).start()
+
+    def read_scan_import(self, path, fmt, generation):
+        # Parses and validates in batches so rows reach the tree while the file is still being read
+        loaded = 0
+        changed = 0
+        algorithms = set()
+        batch = []
+
+        def flush(pool):
+            nonlocal loaded, changed
+            valid = []
+            stats = pool.map(stat_or_none, [row[1] for row in batch])
+            for (group_key, filepath, size, mtime), st in zip(batch, stats):
+                # Files that can't be found here are kept as listed, since a
+                # report from another machine or a distributed scan names
+                # files on other hosts; files that changed size are dropped
+                if st is None:
+                    valid.append((group_key, filepath, size or 0, mtime or 0, False))
+                    continue
+                if size is not None and size != st.st_size:
+                    changed += 1
+                    continue
+                valid.append((group_key, filepath, st.st_size, st.st_mtime, True))
+            loaded += len(valid)
+            batch.clear()
+            if valid:
+                self.task_queue.put(("import_batch", generation, valid))
+
         try:
-            with open(path, encoding="utf-8") as f:
-                duplicates = json.load(f)
-            self.duplicates = duplicates
-            self.populate_tree(self.duplicates)
-            self.last_import_folder = os.path.dirname(path)
-            messagebox.showinfo("Import Complete", "Scan results imported successfully.")
+            with ThreadPoolExecutor(max_workers=self.IMPORT_STAT_WORKERS) as pool:
+                for group_key, filepath, size, mtime, algorithm in iter_import_records(path, fmt):
+                    if generation != self.import_generation:
+                        return
+                    if not filepath:
+                        continue
+                    if algorithm:
+                        algorithms.add(algorithm)
+                    batch.append((group_key, filepath, size, mtime))
+                    if len(batch) >= self.IMPORT_BATCH_SIZE:
+                        flush(pool)
+                if batch:
+                    flush(pool)
+            algorithm = algorithms.pop() if len(algorithms) == 1 else ""
+            self.task_queue.put(("import_done", generation, path, loaded, changed, algorithm))
         except Exception as e:
-            messagebox.showerror("Import Failed", f"Failed to import JSON:\n{e}")
+            self.task_queue.put(("import_failed", generation, path, e))
 
+    def add_import_batch(self, rows):
+        for group_key, filepath, size, mtime, local in rows:
+            if filepath in self.tree_items:
+                continue
+            group_num = self.import_group_numbers.setdefault(group_key, len(self.import_group_numbers) + 1)
+            self.duplicates.setdefault(group_key, []).append(filepath)
+            self.file_info[filepath] = (size, mtime)
+            root = ""
+            if not local:
+                self.unavailable_paths.add(filepath)
+                root = self.UNAVAILABLE_ROOT
+            row_id = self.tree.insert("", "end", values=("", filepath, self.format_size(size), group_num, root, ""))
+            self.tree_items[filepath] = row_id
+        self.status_label.config(text=f"Importing scan results... {len(self.tree_items)} files loaded.")
+
+    def finish_import(self, path, loaded, changed, algorithm):
+        # Groups left with one valid file are no longer duplicates
+        for group_key in list(self.duplicates):
+            files = self.duplicates[group_key]
+            if len(files) < 2:
+                for filepath in files:
+                    row_id = self.tree_items.pop(filepath, None)
+                    if row_id:
+                        self.tree.delete(row_id)
+                    self.file_info.pop(filepath, None)
+                    self.unavailable_paths.discard(filepath)
+                del self.duplicates[group_key]
+        self.scan_hash_algorithm = algorithm
+        self.toggle_select_dupes()
+        status_text = f"Imported {len(self.tree_items)} files in {len(self.duplicates)} groups."
+        if self.unavailable_paths:
+            status_text += f" {len(self.unavailable_paths)} files are not on this machine and can't be selected."
+        if changed:
+            status_text += f" Skipped {changed} files that changed size since the export."
+        self.status_label.config(text=status_text)
+        messagebox.showinfo("Import Complete", "Scan results imported successfully.")
 
     ## Filter Dialog
 
@@ -1647,7 +6028,7 @@ class DuplicateFinderApp:
         ext_var = tk.StringVar(value=self.settings.get("filter_extensions", ""))
         ttk.Entry(frame, textvariable=ext_var).pack(fill=tk.X, pady=(0, 12))
 
-        ttk.Label(frame, text="Excluded Folders (one per line):").pack(anchor="w")
+        ttk.Label(frame, text="Excluded Folders (one per line, * and ? wildcards allowed):").pack(anchor="w")
         exclude_text = tk.Text(frame, height=6, wrap=tk.WORD)
         exclude_folders = self.settings.get("filter_excluded_folders", [])
         exclude_text.insert("1.0", "\n".join(exclude_folders))
@@ -1689,8 +6070,15 @@ class DuplicateFinderApp:
             "last_music_folder": self.last_music_folder,
             "delete_to_recycle": self.delete_to_recycle.get(),
             "hash_size": self.hash_size.get(),
+            "spill_grouping": self.spill_grouping.get(),
+            "seek_order": self.seek_order.get(),
+            "background_scan": self.background_scan.get(),
+            "detect_folders": self.detect_folders.get(),
+            "image_mode": self.image_mode.get(),
+            "scan_archives": self.scan_archives.get(),
             "auto_cleanup_enabled": self.auto_cleanup_enabled.get(),
             "auto_cleanup_days": self.auto_cleanup_days.get(),
+            "undo_backup_quota_mb": self.undo_backup_quota_mb.get(),
             "undo_backup_folder": self.undo_backup_folder,
             "theme": self.theme_var.get(),
             "repeat_current": self.repeat_current.get(),
@@ -1701,6 +6089,13 @@ class DuplicateFinderApp:
             "filter_min_size_kb": self.settings.get("filter_min_size_kb", 0),
             "filter_extensions": self.settings.get("filter_extensions", ""),
             "filter_excluded_folders": self.settings.get("filter_excluded_folders", []),
+            "link_mode": self.settings.get("link_mode", "auto"),
+            "device_concurrency": self.settings.get("device_concurrency", {}),
+            "background_mb_per_sec": self.settings.get("background_mb_per_sec", 20),
+            "background_files_per_sec": self.settings.get("background_files_per_sec", 200),
+            "background_lower_priority": self.settings.get("background_lower_priority", True),
+            "image_threshold": self.settings.get("image_threshold", 10),
+            "daemon_address": self.settings.get("daemon_address", DAEMON_DEFAULT_ADDRESS),
         }
 		
         try:
@@ -1725,27 +6120,29 @@ class DuplicateFinderApp:
             self.last_music_folder = data.get("last_music_folder", self.last_music_folder)
             self.delete_to_recycle.set(data.get("delete_to_recycle", True))
             self.hash_size.set(data.get("hash_size", 8 * 1024 * 1024))
+            self.spill_grouping.set(data.get("spill_grouping", False))
+            self.seek_order.set(data.get("seek_order", True))
+            self.background_scan.set(data.get("background_scan", False))
+            self.detect_folders.set(data.get("detect_folders", True))
+            self.image_mode.set(data.get("image_mode", False))
+            self.scan_archives.set(data.get("scan_archives", False))
             self.auto_cleanup_enabled.set(data.get("auto_cleanup_enabled", True))
             self.auto_cleanup_days.set(data.get("auto_cleanup_days", 7))
+            self.undo_backup_quota_mb.set(data.get("undo_backup_quota_mb", 2048))
 
             path = data.get("undo_backup_folder")
             self.undo_backup_folder = os.path.normpath(path) if path else os.path.join(os.getcwd(), "undo_backups")
             print(f"Loaded undo backup folder: {self.undo_backup_folder}")
 
             theme = data.get("theme")
-            if theme and theme in self.available_themes:
+            if theme:
                 self.theme_var.set(theme)
-                if THEMES_AVAILABLE:
-                    self.style.set_theme(theme)
 
             self.repeat_current.set(data.get("repeat_current", False))
             self.shuffle_enabled.set(data.get("shuffle_enabled", False))
             self.volume_level.set(data.get("volume_level", 0.25))
             self.delete_auto_clean_days = data.get("delete_auto_clean_days", self.DELETE_AUTO_CLEAN_DAYS_DEFAULT)
 
-            if PYGAME_AVAILABLE:
-                pygame.mixer.music.set_volume(self.volume_level.get())
-
             self.settings = data
             return data
         except Exception as e:
@@ -1761,43 +6158,80 @@ class DuplicateFinderApp:
 
         # -- Delete and Move history persistence --
 
+    # The history files are read and pruned on a background thread so a long
+    # history never delays the window. Anything that reads, changes or saves
+    # a history calls finish_history_load first.
+
+    def start_history_load(self):
+        self.history_load_seconds = None
+        self.history_thread = threading.Thread(
+            target=self.load_histories, args=(self.delete_auto_clean_days,), daemon=True
+        )
+        self.history_thread.start()
+
+    def load_histories(self, clean_days):
+        started = time.perf_counter()
+        self.loaded_histories = (
+            self.load_delete_history_and_cleanup(clean_days), self.load_move_history(), self.load_link_history()
+        )
+        self.history_load_seconds = time.perf_counter() - started
+        self.task_queue.put(("histories_loaded",))
+
+    def finish_history_load(self):
+        if self.history_thread is None:
+            return
+        self.history_thread.join()
+        self.history_thread = None
+        # Merged in place so open views keep the same lists; anything recorded
+        # before the load finished is newer and stays last
+        delete_history, move_history, link_history = self.loaded_histories
+        self.loaded_histories = None
+        self.delete_history[:0] = delete_history
+        self.move_history[:0] = move_history
+        self.link_history[:0] = link_history
+
     def save_delete_history(self):
+        self.finish_history_load()
+        self.write_delete_history(self.delete_history)
+
+    def write_delete_history(self, history):
         path = "delete_history.json"
         try:
             with open(path, "w", encoding="utf-8") as f:
-                json.dump(self.delete_history, f, indent=2)
+                json.dump(history, f, indent=2)
         except Exception:
             pass
 
-    def load_delete_history_and_cleanup(self):
+    def load_delete_history_and_cleanup(self, clean_days):
+        # Runs on the history thread, which is the only writer until it is joined
         path = "delete_history.json"
         if not os.path.exists(path):
-            self.delete_history = []
-            return
+            return []
         try:
             with open(path, encoding="utf-8") as f:
                 history = json.load(f)
-            self.delete_history = history
-            self.clean_old_delete_history()
         except Exception:
-            self.delete_history = []
+            return []
+        kept = self.clean_old_delete_history(history, clean_days)
+        if len(kept) != len(history):
+            self.write_delete_history(kept)
+        return kept
 
-    def clean_old_delete_history(self):
+    def clean_old_delete_history(self, history, clean_days):
         now = datetime.datetime.now()
-        cutoff = now - datetime.timedelta(days=self.delete_auto_clean_days)
+        cutoff = now - datetime.timedelta(days=clean_days)
         new_history = []
-        for record in self.delete_history:
+        for record in history:
             try:
                 ts = datetime.datetime.fromisoformat(record.get("timestamp"))
                 if ts > cutoff:
                     new_history.append(record)
             except Exception:
                 pass
-        if len(new_history) != len(self.delete_history):
-            self.delete_history = new_history
-            self.save_delete_history()
+        return new_history
 	
     def save_move_history(self):
+        self.finish_history_load()
         try:
             with open("move_history.json", "w", encoding="utf-8") as f:
                 json.dump(self.move_history, f, indent=2)
@@ -1808,10 +6242,71 @@ class DuplicateFinderApp:
         try:
             if os.path.exists("move_history.json"):
                 with open("move_history.json", "r", encoding="utf-8") as f:
-                    self.move_history = json.load(f)
+                    return json.load(f)
         except Exception as e:
             print(f"Error loading move history: {e}")
-            self.move_history = []
+        return []
+
+    def save_link_history(self):
+        self.finish_history_load()
+        try:
+            with open("link_history.json", "w", encoding="utf-8") as f:
+                json.dump(self.link_history, f, indent=2)
+        except Exception as e:
+            print(f"Error saving link history: {e}")
+
+    def load_link_history(self):
+        try:
+            if os.path.exists("link_history.json"):
+                with open("link_history.json", "r", encoding="utf-8") as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"Error loading link history: {e}")
+        return []
+
+    # -- Undo backup cleanup --
+
+    def auto_backup_gc(self):
+        if self.is_closing:
+            return
+        if self.auto_cleanup_enabled.get():
+            self.start_backup_gc()
+        self.root.after(self.BACKUP_GC_INTERVAL_MS, self.auto_backup_gc)
+
+    def start_backup_gc(self, manual=False):
+        if self.backup_gc_thread and self.backup_gc_thread.is_alive():
+            if manual:
+                messagebox.showinfo("Undo Backups", "Undo backup cleanup is already running.")
+            return
+        self.finish_history_load()
+        try:
+            max_age_days = max(1, int(self.auto_cleanup_days.get()))
+            quota_bytes = max(0, int(self.undo_backup_quota_mb.get())) * 1024 * 1024
+        except (tk.TclError, ValueError):
+            messagebox.showerror("Undo Backups", "The undo backup days and space limit must be whole numbers.")
+            return
+        collector = UndoBackupCollector(self.undo_backup_folder, list(self.delete_history), max_age_days,
+                                        quota_bytes, self.backup_lock, self.task_queue)
+        self.backup_gc_manual = manual
+        if manual:
+            self.status_label.config(text="Cleaning up undo backups...")
+        self.backup_gc_thread = threading.Thread(target=collector.run, daemon=True)
+        self.backup_gc_thread.start()
+
+    def finish_backup_gc(self, report):
+        self.backup_gc_thread = None
+        dropped = {id(record) for record in report["dropped"]}
+        if dropped:
+            self.delete_history[:] = [h for h in self.delete_history if id(h) not in dropped]
+            self.save_delete_history()
+        text = (f"Undo backup cleanup reclaimed {self.format_size(report['reclaimed'])}: "
+                f"removed {report['removed']} backups and {len(dropped)} history records, "
+                f"kept {report['kept']} backups ({self.format_size(report['kept_bytes'])}).")
+        print(text)
+        if report["removed"] or dropped or self.backup_gc_manual:
+            self.status_label.config(text=text)
+        if self.backup_gc_manual:
+            messagebox.showinfo("Undo Backups", text)
 
     # -- Sorting --
 
@@ -1872,25 +6367,59 @@ class DuplicateFinderApp:
             self.tree.move(c, "", index)
         self.group_sort_descending = not self.group_sort_descending
 
+    def load_themes(self):
+        # ThemedStyle registers every theme ttkthemes ships, so it is only
+        # created once one of them is needed
+        if THEMES_AVAILABLE and self.themed_style is None:
+            from ttkthemes import ThemedStyle
+            self.themed_style = ThemedStyle(self.root)
+            self.style = self.themed_style
+
+    def fill_theme_menu(self):
+        if self.theme_menu.index(tk.END) is not None:
+            return
+        try:
+            self.load_themes()
+        except Exception as e:
+            print(f"Error loading themes: {e}")
+        for theme in sorted(self.style.theme_names()):
+            self.theme_menu.add_radiobutton(label=theme.title(), variable=self.theme_var, value=theme, command=self.change_theme)
+
+    def apply_theme(self):
+        # Built-in ttk themes need nothing more; any other comes from ttkthemes
+        theme = self.theme_var.get()
+        if theme not in self.style.theme_names():
+            self.load_themes()
+        self.style.theme_use(theme)
+
+    def apply_startup_theme(self):
+        try:
+            self.apply_theme()
+        except Exception as e:
+            print(f"Error applying theme: {e}")
+            self.theme_var.set(self.style.theme_use())
+
     def change_theme(self):
-        new_theme = self.theme_var.get()
-        if THEMES_AVAILABLE:
-            try:
-                self.style.set_theme(new_theme)
-            except Exception as e:
-                messagebox.showwarning("Theme Change Failed", f"Failed to apply theme:\n{e}")
+        try:
+            self.apply_theme()
+        except Exception as e:
+            messagebox.showwarning("Theme Change Failed", f"Failed to apply theme:\n{e}")
         self.save_settings()
 
     def on_close(self):
         self.is_closing = True
-        if hasattr(self, 'scan_stop_event'):
-            self.scan_stop_event.set()
+        if getattr(self, 'watch_control', None):
+            self.watch_control.cancel()
+        if getattr(self, 'overlap_control', None):
+            self.overlap_control.cancel()
+        if hasattr(self, 'scan_control'):
+            self.scan_control.cancel()
         if hasattr(self, 'scanning_thread') and self.scanning_thread and self.scanning_thread.is_alive():
             self.scanning_thread.join(timeout=5)
-        if PYGAME_AVAILABLE:
+        if self.mixer:
             try:
-                pygame.mixer.music.stop()
-                pygame.mixer.quit()
+                self.mixer.music.stop()
+                self.mixer.quit()
             except Exception as e:
                 print(f"Error stopping pygame: {e}")
         try:
@@ -1901,7 +6430,78 @@ class DuplicateFinderApp:
         self.root.destroy()
 
 
+def benchmark_startup(runs):
+    # Starts the app in a fresh interpreter each run and times it from launch
+    # until the window has been drawn and can take input. The child reports
+    # its timestamps through --startup-probe and closes itself.
+    results = []
+    for _ in range(runs):
+        launched = time.time()
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--startup-probe"],
+                              capture_output=True, text=True, timeout=120)
+        probe = [line.split()[1:] for line in proc.stdout.splitlines() if line.startswith("startup-probe ")]
+        if proc.returncode or not probe:
+            print(f"Startup probe failed:\n{proc.stderr.strip()}")
+            return
+        imported, ready, history = (float(value) for value in probe[-1])
+        results.append((imported - launched, ready - launched, history))
+    for label, pos in (("Module imported", 0), ("Window interactive", 1), ("History loaded (background)", 2)):
+        times = sorted(result[pos] * 1000 for result in results)
+        print(f"{label:<28} median {times[len(times) // 2]:7.1f} ms   best {times[0]:7.1f} ms   worst {times[-1]:7.1f} ms")
+
+
+def startup_probe():
+    imported = time.time()
+    root = tk.Tk()
+    app = DuplicateFinderApp(root)
+    root.update()
+    ready = time.time()
+    app.history_thread.join()
+    print(f"startup-probe {imported} {ready} {app.history_load_seconds}", flush=True)
+    root.destroy()
+
+
 def main():
+    parser = argparse.ArgumentParser(description="OwNaG3's Duplicate Finder")
+    parser.add_argument("--daemon", action="store_true", help="run the scan daemon instead of the window")
+    parser.add_argument("--listen", default=DAEMON_DEFAULT_ADDRESS,
+                        help="daemon address, http://127.0.0.1:8765 or unix:/path/to.sock")
+    parser.add_argument("--worker", metavar="NODE", help="run as a distributed-scan worker named NODE")
+    parser.add_argument("--coordinator", action="store_true", help="run as the distributed-scan coordinator")
+    parser.add_argument("--roots", default="", help="folders a worker scans, separated by ;")
+    parser.add_argument("--exchange", help="folder shared by the coordinator and its workers")
+    parser.add_argument("--run", help="id shared by the coordinator and workers of one distributed run")
+    parser.add_argument("--nodes", type=int, default=1, help="number of workers the coordinator waits for")
+    parser.add_argument("--output", default="distributed_duplicates.jsonl", help="coordinator report (JSON Lines)")
+    parser.add_argument("--hash-size", type=int, default=0, help="bytes hashed per file, 0 for whole files")
+    parser.add_argument("--timeout", type=float, default=24 * 3600, help="seconds to wait for the other side")
+    parser.add_argument("--benchmark-startup", type=int, nargs="?", const=5, metavar="RUNS",
+                        help="time cold starts of the window (default 5 runs)")
+    parser.add_argument("--startup-probe", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.benchmark_startup:
+        benchmark_startup(args.benchmark_startup)
+        return
+    if args.startup_probe:
+        startup_probe()
+        return
+    if args.daemon:
+        run_daemon(args.listen, DuplicateFinderApp.SETTINGS_FILE)
+        return
+    if args.worker or args.coordinator:
+        if not args.exchange or not os.path.isdir(args.exchange):
+            parser.error("--exchange must name an existing folder")
+        if not args.run:
+            parser.error("--run must give the id shared by this run's coordinator and workers")
+        if args.worker:
+            roots = [root.strip() for root in args.roots.split(";") if root.strip()]
+            if not roots or not all(os.path.isdir(root) for root in roots):
+                parser.error("--roots must list existing folders")
+            run_worker(args.worker, roots, args.exchange, args.timeout, args.run)
+        else:
+            run_coordinator(args.exchange, args.nodes, args.output, args.hash_size, args.timeout, args.run)
+        return
+
     root = tk.Tk()
     app = DuplicateFinderApp(root)
     icon_path = os.path.join(os.path.dirname(__file__), "ownages_duplicate_finder.ico")
@@ -1910,4 +6510,7 @@ def main():
 
 
 if __name__ == "__main__":
+    # Lets the image-hash worker processes start in a frozen Windows build
+    # instead of running main() and opening another window
+    multiprocessing.freeze_support()
     main()